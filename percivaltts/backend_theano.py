@@ -22,7 +22,14 @@ import percivaltts  # Always include this first to setup a few things
 from percivaltts import colored
 
 import os
+import sys
 import re
+import time
+import json
+import hashlib
+import cPickle
+import StringIO
+import functools
 
 import numpy as np
 percivaltts.numpy_force_random_seed()
@@ -48,6 +55,284 @@ def th_cuda_available():
     """Returns True if CUDA is available"""
     return theano.config.cuda.root!=''
 
+# Persistent cache of the compiled functions -----------------------------------
+#
+# Theano's base_compiledir only caches the C modules; the graph optimisation
+# and linking of each function are still done at every start, which takes
+# most of the time for the bigger graphs (e.g. the training functions of the
+# WGAN). th_function(.) saves the whole compiled function in a cache directory,
+# under the fingerprint of its graph, so that the next run building the same
+# graph only has to unpickle it and relink it to its own shared variables.
+# For a shared cache across machines/users, base_compiledir should also point
+# to a shared directory (see setenv.sh), since the functions refer to its C modules.
+
+_compilecache_dir = os.getenv('PERCIVALTTS_COMPILECACHE', None)
+_compilecache_report = []
+_compilecache_recursionlimit = 100000    # The graphs are pickled recursively
+
+def th_compilecache(dirpath):
+    """Set the directory of the compiled functions cache (None disables it, as when PERCIVALTTS_COMPILECACHE is not set)."""
+    global _compilecache_dir
+    _compilecache_dir = dirpath
+
+def th_compilecache_report():
+    """Return the list of the functions compiled by th_function(.) so far, with their cold and warm start times."""
+    return list(_compilecache_report)
+
+def _th_sharedvars(outputs, updates):
+    """The shared variables of a graph, in the order of the graph traversal (i.e. the same order for the same graph)."""
+    shared = []
+    done = set()
+    for v in [var for var, _ in updates]+list(theano.gof.graph.inputs(outputs+[upd for _, upd in updates])):
+        if isinstance(v, theano.compile.SharedVariable) and not v in done:
+            shared.append(v)
+            done.add(v)
+    return shared
+
+def th_graph_fingerprint(inputs, outputs, updates=None, **kwargs):
+    """
+    Fingerprint of a graph to compile, which is stable across runs building the same architecture.
+
+    It covers the structure of the graph (including the names, types and shapes
+    of the shared variables, but not their values), the values of the
+    constants (e.g. the learning rates), the arguments of theano.function(.)
+    and the Theano configuration used for the compilation.
+    """
+    if updates is None: updates=[]
+    if isinstance(outputs, theano.Variable): outputs=[outputs]
+    variables = list(outputs)+[upd for _, upd in updates]
+
+    h = hashlib.sha1()
+    h.update(str((theano.__version__, theano.config.floatX, theano.config.device, theano.config.mode, theano.config.optimizer, theano.config.optimizer_including, theano.config.optimizer_excluding)))
+    h.update(str(sorted(kwargs.items())))
+    h.update(str([(str(v), v.type) for v in inputs]))
+    h.update(str([(str(var), var.type) for var, _ in updates]))
+    graph = StringIO.StringIO()
+    theano.printing.debugprint(variables, file=graph, ids='CHAR', print_type=True)
+    h.update(graph.getvalue())
+    for v in theano.gof.graph.ancestors(variables):
+        if isinstance(v, theano.gof.Constant):
+            h.update(np.asarray(v.data).tobytes())
+        elif isinstance(v, theano.compile.SharedVariable):
+            h.update(str((str(v), v.type, np.shape(v.get_value(borrow=True)))))
+
+    return h.hexdigest()
+
+def th_function(inputs, outputs, updates=None, name=None, **kwargs):
+    """
+    Same as theano.function(.), but re-using the compiled functions of the previous runs.
+
+    If the cache directory is set (see th_compilecache(.)), the compiled
+    function is loaded from the cache if the same graph has already been
+    compiled (warm start), otherwise it is compiled and saved in the cache
+    (cold start). In both cases the function works on the shared variables of
+    the given graph.
+    """
+    if updates is None:         updates=[]
+    elif hasattr(updates, 'items'): updates=list(updates.items())   # Keep the order of OrderedDict
+    if name is None: name='function'
+
+    if _profile:
+        _th_profile_inherit(list(outputs) if isinstance(outputs, (list, tuple)) else [outputs], updates)
+        return theano.function(inputs, outputs, updates=updates, name=name, profile=theano.compile.ProfileStats(atexit_print=False, message=name), **kwargs)
+
+    if _compilecache_dir is None:
+        return theano.function(inputs, outputs, updates=updates, name=name, **kwargs)
+
+    timestart = time.time()
+    fingerprint = th_graph_fingerprint(inputs, outputs, updates, **kwargs)
+    fcache = os.path.join(_compilecache_dir, fingerprint+'.pkl')
+    finfo = os.path.join(_compilecache_dir, fingerprint+'.json')
+    shared = _th_sharedvars(list(outputs) if isinstance(outputs, (list, tuple)) else [outputs], updates)
+
+    fn = None
+    if os.path.isfile(fcache) and os.path.isfile(finfo):
+        try:
+            reoptimize = theano.config.reoptimize_unpickled_function
+            theano.config.reoptimize_unpickled_function = False
+            recursionlimit = sys.getrecursionlimit()
+            sys.setrecursionlimit(max(recursionlimit, _compilecache_recursionlimit))
+            try:
+                with open(fcache, 'rb') as f:
+                    maker, sharedcached = cPickle.load(f)
+            finally:
+                theano.config.reoptimize_unpickled_function = reoptimize
+                sys.setrecursionlimit(recursionlimit)
+            if len(sharedcached)!=len(shared) or any([sc.type!=s.type or str(sc)!=str(s) for sc, s in zip(sharedcached, shared)]):
+                raise ValueError('the shared variables do not match')
+            # Link the function to our shared variables, as theano.function(.) does, but without re-optimising the graph
+            # (Function.copy(swap=.) cannot be used, it ignores the inplace operations when re-linking)
+            live = dict(zip(sharedcached, shared))
+            for i in maker.inputs:
+                if i.variable in live:
+                    i.value = live[i.variable].container
+                    i.variable = live[i.variable]
+            fn = maker.create([i.value for i in maker.inputs])
+            fn.name = name
+            with open(finfo) as f: info = json.load(f)
+            timewarm = time.time()-timestart
+            print('    {}: warm start from the compile cache in {:.2f}s (cold start took {:.2f}s)'.format(name, timewarm, info['coldtime']))
+            _compilecache_report.append({'name':name, 'fingerprint':fingerprint, 'start':'warm', 'time':timewarm, 'coldtime':info['coldtime']})
+        except Exception as e:  # Whatever happened, the function can still be compiled
+            print(colored('    {}: cannot use the compile cache ({}), compiling it'.format(name, e), 'red'))
+            fn = None
+
+    if fn is None:
+        fn = theano.function(inputs, outputs, updates=updates, name=name, **kwargs)
+        timecold = time.time()-timestart
+        fnshared = [i.variable for i in fn.maker.inputs if isinstance(i.variable, theano.compile.SharedVariable)]
+        if set(fnshared)<=set(shared):
+            import tempfile
+            percivaltts.makedirs(_compilecache_dir)
+            fd, ftmp = tempfile.mkstemp(dir=_compilecache_dir, prefix=fingerprint+'.', suffix='.tmp')
+            recursionlimit = sys.getrecursionlimit()
+            sys.setrecursionlimit(max(recursionlimit, _compilecache_recursionlimit))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    cPickle.dump((fn.maker, shared), f, cPickle.HIGHEST_PROTOCOL)
+                os.rename(ftmp, fcache)   # Other processes might use the same cache
+                with open(finfo, 'w') as f:
+                    json.dump({'name':name, 'coldtime':timecold, 'theano':theano.__version__}, f)
+            except Exception as e:
+                print(colored('    {}: cannot save it in the compile cache ({})'.format(name, e), 'red'))
+            finally:
+                sys.setrecursionlimit(recursionlimit)
+                if os.path.exists(ftmp): os.remove(ftmp)
+        print('    {}: cold start, compiled in {:.2f}s (fingerprint {})'.format(name, timecold, fingerprint[:12]))
+        _compilecache_report.append({'name':name, 'fingerprint':fingerprint, 'start':'cold', 'time':timecold, 'coldtime':timecold})
+
+    return fn
+
+# Profiling per layer ---------------------------------------------------------
+#
+# Theano's profiler reports the time of each operation of the optimised graph,
+# which hardly tells which layer they come from. In profiling mode (see
+# th_profile(.)), lasagne.layers.get_output(.) tags the variables computed by
+# each layer with the layer's name, in the stack trace of the variables, which
+# the graph optimisations carry over to the variables they create. The
+# variables which are not computed by any layer (the costs, gradients and
+# updates) inherit the tag of the variables they are computed from, as the
+# "backward" part of this layer. So do the operations of the compiled graph
+# whose variables lost their tag in the optimisations (e.g. the scans).
+
+_PROFILE_TAG = '<layer>'
+_profile = False
+_profile_get_output = lasagne.layers.get_output
+_profile_order = [0]     # Order of the layers, to inherit the tag of the last one
+
+def _th_profile_tag(var, tag):
+    var.tag.trace = list(getattr(var.tag, 'trace', [])) + [[(_PROFILE_TAG,)+tag]]
+
+def _th_profile_gettag(var):
+    """Returns the (order, layer name, part) of var, or None if it is not tagged"""
+    for stack in getattr(var.tag, 'trace', []):
+        for frame in stack:
+            if len(frame)==4 and frame[0]==_PROFILE_TAG: return frame[1:]
+    return None
+
+def _th_profile_inherittag(node, part=None):
+    """
+    The tag inherited by node from its inputs, None if none is tagged: the
+    last layer among the forward inputs (e.g. the activations used by a
+    gradient), otherwise among the backward inputs, and the backward part if
+    any input is backward (or the given part).
+    """
+    tags = [t for t in [_th_profile_gettag(i) for i in node.inputs] if not t is None]
+    if len(tags)==0: return None
+    forward = [t for t in tags if t[2]=='forward']
+    order, layername, _ = max(forward) if len(forward)>0 else max(tags)
+    if part is None: part = 'forward' if len(forward)==len(tags) else 'backward'
+    return (order, layername, part)
+
+def _th_profile_get_output(layer_or_layers, inputs=None, **kwargs):
+    """Same as lasagne.layers.get_output(.), but tagging the variables computed by each layer"""
+    ll = lasagne.layers
+    treat_as_input = inputs.keys() if isinstance(inputs, dict) else []
+    layers = ll.get_all_layers(layer_or_layers, treat_as_input)
+    outputs = dict(zip(layers, _profile_get_output(layers, inputs, **kwargs)))   # Build all the layers in the same graph
+    for layer in layers:
+        if layer in treat_as_input or isinstance(layer, ll.InputLayer): continue
+        incomings = layer.input_layers if isinstance(layer, ll.MergeLayer) else [layer.input_layer]
+        _profile_order[0] += 1
+        for var in theano.gof.graph.ancestors([outputs[layer]], blockers=[outputs[l] for l in incomings if l in outputs]):
+            if not var.owner is None and _th_profile_gettag(var) is None: _th_profile_tag(var, (_profile_order[0], str(layer.name), 'forward'))
+    if isinstance(layer_or_layers, (list, tuple)): return [outputs[l] for l in layer_or_layers]
+    else:                                          return outputs[layer_or_layers]
+
+def _th_profile_inherit(outputs, updates):
+    """Tag the variables which are not computed by a layer as the backward part of the last layer they are computed from"""
+    variables = outputs+[upd for _, upd in updates]
+    for node in theano.gof.graph.io_toposort(theano.gof.graph.inputs(variables), variables):
+        if any([not _th_profile_gettag(o) is None for o in node.outputs]): continue
+        tag = _th_profile_inherittag(node, 'backward')
+        if not tag is None:
+            for o in node.outputs: _th_profile_tag(o, tag)
+
+def th_profile(enable=True):
+    """
+    Enable (or disable) the profiling mode.
+
+    In profiling mode, the graphs built by lasagne.layers.get_output(.) are
+    tagged per layer and th_function(.) compiles the functions with Theano's
+    profiler (without using the compile cache), so that th_profile_run(.)
+    can report the time spent in each layer. It has thus to be enabled before
+    building the model.
+    """
+    global _profile
+    _profile = enable
+    lasagne.layers.get_output = _th_profile_get_output if enable else _profile_get_output
+
+def th_profile_run(fn, args, nbiters=10, nbwarmups=2):
+    """
+    Run a function compiled in profiling mode nbiters times (after nbwarmups
+    runs) on the arguments args and report the time spent in each layer.
+
+    Returns
+    -------
+    A dict with the name of the function, the mean time per call (in
+    seconds) and the list of the layers with their mean forward and
+    backward times per call (in seconds), the most time consuming first.
+    The operations which could not be related to any layer are reported
+    under '(other)'.
+    """
+    for _ in xrange(nbwarmups): fn(*args)
+
+    def nodetimes():
+        return dict([(key[1] if isinstance(key, tuple) else key, t) for key, t in fn.profile.apply_time.items()])  # Keys are (fgraph, node) in some versions of Theano
+    timesbefore = nodetimes()
+    timestart = time.time()
+    for _ in xrange(nbiters): fn(*args)
+    calltime = (time.time()-timestart)/nbiters
+
+    nodetags = dict()
+    for node in fn.maker.fgraph.toposort():
+        tags = [t for t in [_th_profile_gettag(o) for o in node.outputs] if not t is None]
+        if len(tags)>0: nodetags[node] = tags[0]
+        else:
+            nodetags[node] = _th_profile_inherittag(node)
+            if not nodetags[node] is None:
+                for o in node.outputs: _th_profile_tag(o, nodetags[node])
+
+    layers = dict()
+    for node, t in nodetimes().items():
+        _, layername, part = (None, '(other)', 'forward') if nodetags.get(node) is None else nodetags[node]
+        layers.setdefault(layername, {'layer':layername, 'forward':0.0, 'backward':0.0})
+        layers[layername][part] += (t-timesbefore.get(node, 0.0))/nbiters
+    layers = sorted(layers.values(), key=lambda l: -(l['forward']+l['backward']))
+
+    return {'name':fn.name, 'time':calltime, 'layers':layers}
+
+def th_profile_print(reports, fjson=None):
+    """Print the reports of th_profile_run(.) as tables (and save them in the JSON file fjson)."""
+    for report in reports:
+        optime = sum([l['forward']+l['backward'] for l in report['layers']])
+        print('    {}: {:.2f}ms per call ({:.2f}ms in the operations)'.format(report['name'], 1e3*report['time'], 1e3*optime))
+        print('        {:<40} {:>12} {:>12} {:>7}'.format('layer', 'forward[ms]', 'backward[ms]', '%'))
+        for l in report['layers']:
+            print('        {:<40} {:>12.3f} {:>12.3f} {:>6.1f}%'.format(l['layer'], 1e3*l['forward'], 1e3*l['backward'], 100.0*(l['forward']+l['backward'])/optime if optime>0.0 else 0.0))
+    if not fjson is None:
+        with open(fjson, 'w') as f: json.dump(reports, f, indent=4)
+
 def th_print(msg, op):
     """Print the content of a theano variable with a message"""
     print_shape = theano.printing.Print(msg, attrs = [ 'shape' ])
@@ -110,6 +395,14 @@ def print_network(net, params=None):
             if (params!=None) and (p in params): istrainedstr=colored('TRAINING', 'green')
             print('            {}({}) [{}] {}'.format(p.name, X.shape, hash(str(X)), istrainedstr))
 
+def params_quantisable(net):
+    """Returns the list of (parameter, axis of its channels) of the weights of the Dense and Conv2D layers of net, which can be quantised per channel (see checkpoint.quantise(.))."""
+    params = []
+    for layer in lasagne.layers.get_all_layers(net):
+        if isinstance(layer, lasagne.layers.DenseLayer):    params.append((layer.W, 1))
+        elif isinstance(layer, lasagne.layers.Conv2DLayer): params.append((layer.W, 0))
+    return params
+
 def params_keeponly(params, regexp, reverse=False):
     paramstotrain = []
     for p in params:
@@ -167,3 +460,142 @@ def layers_transfer(netfrom, netto, regexp, strictnames=True):
                     pto.set_value(pfrom.get_value())
                 else:
                     print('            {} SKIPPED {}'.format(str(pto), str(pfrom)))
+
+# Export of the networks for the NumPy runtime (see inference.py) --------------
+
+_INFERENCE_NONLINEARITIES = [
+    (lasagne.nonlinearities.linear, 'linear'),
+    (lasagne.nonlinearities.identity, 'linear'),
+    (lasagne.nonlinearities.rectify, 'rectify'),
+    (lasagne.nonlinearities.sigmoid, 'sigmoid'),
+    (T.nnet.sigmoid, 'sigmoid'),
+    (lasagne.nonlinearities.tanh, 'tanh'),
+    (T.tanh, 'tanh'),
+    (lasagne.nonlinearities.softplus, 'softplus'),
+    (lasagne.nonlinearities.elu, 'elu'),
+    (nonlin_tanh_saturated, 'tanh_saturated'),
+    (nonlin_saturatedsigmoid, 'saturatedsigmoid'),
+    (nonlin_tanh_bysigmoid, 'tanh_bysigmoid'),
+    (nonlin_tanhcm11, 'tanhcm11'),
+    (nonlin_softsign, 'softsign'),
+    (nonlin_sigmoidparm, 'sigmoidparm'),
+    ]
+_INFERENCE_NONLINEARITIES_DEFAULTS = {'tanh_saturated':{'coef':1.01}, 'saturatedsigmoid':{'coef':1.01}, 'sigmoidparm':{'c':0.0, 'f':1.0}}
+
+def inference_nonlinearity(fn):
+    """Returns the description of the nonlinearity fn used by inference.nonlinearity(.)"""
+    if fn is None: return {'name':'linear'}
+    if isinstance(fn, lasagne.nonlinearities.LeakyRectify): return {'name':'leaky_rectify', 'leakiness':float(fn.leakiness)}
+    if isinstance(fn, lasagne.nonlinearities.ScaledTanH): return {'name':'scaled_tanh', 'scale_in':float(fn.scale_in), 'scale_out':float(fn.scale_out)}
+    keywords = dict()
+    if isinstance(fn, functools.partial):
+        keywords = fn.keywords
+        if len(fn.args)>0: raise ValueError('Cannot export the nonlinearity {} with positional arguments'.format(fn))
+        fn = fn.func
+    for f, name in _INFERENCE_NONLINEARITIES:
+        if fn is f:
+            spec = dict(_INFERENCE_NONLINEARITIES_DEFAULTS.get(name, dict()))
+            spec.update([(k, float(v)) for k, v in keywords.items()])
+            spec['name'] = name
+            return spec
+    raise ValueError('Cannot export the nonlinearity {}'.format(fn))
+
+def inference_layers(net):
+    """
+    Walk the Lasagne graph of net and describe it for the NumPy runtime (see inference.py).
+
+    Custom layers can be exported by implementing a method inference_spec(self),
+    which returns the dict of the operation of the layer, without its 'name', 'inputs' and 'tensors'.
+
+    The masks of the layers (mask_incoming_index, see Model.layer_mask(.)) are
+    dropped, since the NumPy runtime predicts unpadded inputs.
+
+    Returns
+    -------
+    layers :    list of dict describing the layers, in topological order.
+    tensors :   list of (name, numpy array) of the parameters used by the layers.
+    """
+    ll = lasagne.layers
+    layers = []
+    tensors = []
+    indices = dict()
+
+    alllayers = ll.get_all_layers(net)
+    masks = set([layer.input_layers[layer.mask_incoming_index] for layer in alllayers if getattr(layer, 'mask_incoming_index', -1)>0])
+
+    for layer in alllayers:
+        if layer in masks: continue
+        li = len(layers)
+        if isinstance(layer, ll.MergeLayer): incomings = [l for i, l in enumerate(layer.input_layers) if i!=getattr(layer, 'mask_incoming_index', -1)]
+        else:                                incomings = [layer.input_layer] if hasattr(layer, 'input_layer') else []
+        spec = {'name':str(layer.name), 'inputs':[indices[l] for l in incomings]}
+        params = dict()
+
+        if isinstance(layer, ll.InputLayer):
+            spec['type'] = 'input'
+        elif hasattr(layer, 'inference_spec'):
+            spec.update(layer.inference_spec())
+        elif isinstance(layer, ll.DenseLayer):
+            spec.update({'type':'dense', 'num_leading_axes':getattr(layer, 'num_leading_axes', 1), 'nonlinearity':inference_nonlinearity(layer.nonlinearity)})
+            params = {'W':layer.W, 'b':layer.b}
+        elif isinstance(layer, ll.Conv2DLayer):
+            if layer.untie_biases: raise ValueError('Cannot export {}: untied biases are not supported'.format(layer.name))
+            dilation = [int(d) for d in getattr(layer.convolution, 'keywords', dict()).get('filter_dilation', (1, 1))]    # e.g. partial(T.nnet.conv2d, filter_dilation=.)
+            filter_size = [d*(s-1)+1 for s, d in zip(layer.filter_size, dilation)]
+            if layer.pad=='same':   pad = [[s//2, s-1-s//2] for s in filter_size]
+            elif layer.pad=='full': pad = [[s-1, s-1] for s in filter_size]
+            elif layer.pad=='valid':pad = [[0, 0] for s in filter_size]
+            else:                   pad = [[int(p), int(p)] for p in layer.pad]
+            spec.update({'type':'conv2d', 'pad':pad, 'stride':[int(s) for s in layer.stride], 'dilation':dilation, 'flip_filters':bool(getattr(layer, 'flip_filters', True)), 'nonlinearity':inference_nonlinearity(layer.nonlinearity)})
+            params = {'W':layer.W, 'b':layer.b}
+        elif isinstance(layer, ll.BatchNormLayer):
+            spec.update({'type':'batchnorm', 'axes':[int(a) for a in layer.axes]})
+            params = {'beta':layer.beta, 'gamma':layer.gamma, 'mean':layer.mean, 'inv_std':layer.inv_std}
+        elif isinstance(layer, ll.NonlinearityLayer):
+            spec.update({'type':'nonlinearity', 'nonlinearity':inference_nonlinearity(layer.nonlinearity)})
+        elif isinstance(layer, (ll.DropoutLayer, ll.GaussianNoiseLayer)):
+            spec['type'] = 'identity'    # Deterministic at prediction time
+        elif isinstance(layer, ll.ElemwiseSumLayer):
+            spec.update({'type':'sum', 'coeffs':[float(c) for c in layer.coeffs]})
+        elif isinstance(layer, ll.ElemwiseMergeLayer):
+            ops = [(T.mul, 'mul'), (T.add, 'add'), (T.sub, 'sub'), (T.maximum, 'max'), (T.minimum, 'min')]
+            op = [name for f, name in ops if layer.merge_function is f]
+            if len(op)==0: raise ValueError('Cannot export {}: unsupported merge function {}'.format(layer.name, layer.merge_function))
+            spec.update({'type':'elemwise', 'op':op[0]})
+        elif isinstance(layer, ll.ConcatLayer):
+            spec.update({'type':'concat', 'axis':int(layer.axis)})
+        elif isinstance(layer, ll.DimshuffleLayer):
+            spec.update({'type':'dimshuffle', 'pattern':[p if p=='x' else int(p) for p in layer.pattern]})
+        elif isinstance(layer, ll.FlattenLayer):
+            spec.update({'type':'flatten', 'outdim':int(layer.outdim)})
+        elif isinstance(layer, ll.SliceLayer):
+            if isinstance(layer.slice, slice): indices_ = [layer.slice.start, layer.slice.stop, layer.slice.step]
+            else:                              indices_ = int(layer.slice)
+            spec.update({'type':'slice', 'axis':int(layer.axis), 'indices':indices_})
+        elif isinstance(layer, (ll.LSTMLayer, ll.GRULayer)):
+            if len(incomings)>1 or getattr(layer, 'only_return_final', False): raise ValueError('Cannot export {}: hidden state inputs and only_return_final are not supported'.format(layer.name))
+            spec['backwards'] = bool(layer.backwards)
+            if isinstance(layer, ll.LSTMLayer):
+                gates = ['ingate', 'forgetgate', 'cell', 'outgate']
+                spec.update({'type':'lstm', 'peepholes':bool(layer.peepholes), 'nonlinearity':inference_nonlinearity(layer.nonlinearity)})
+                params = {'cell_init':layer.cell_init, 'hid_init':layer.hid_init}
+                if layer.peepholes: params.update([('W_cell_to_'+g, getattr(layer, 'W_cell_to_'+g)) for g in ['ingate', 'forgetgate', 'outgate']])
+            else:
+                gates = ['resetgate', 'updategate', 'hidden_update']
+                spec.update({'type':'gru', 'nonlinearity_hid':inference_nonlinearity(layer.nonlinearity_hid)})
+                params = {'hid_init':layer.hid_init}
+            for g in gates:
+                if g!='hidden_update': spec['nonlinearity_'+g] = inference_nonlinearity(getattr(layer, 'nonlinearity_'+g))
+                params.update([('W_in_to_'+g, getattr(layer, 'W_in_to_'+g)), ('W_hid_to_'+g, getattr(layer, 'W_hid_to_'+g)), ('b_'+g, getattr(layer, 'b_'+g))])
+        else:
+            raise ValueError('Cannot export the layer {} of type {}'.format(layer.name, layer.__class__.__name__))
+
+        spec['tensors'] = dict()
+        for key, p in params.items():
+            if p is None: continue    # e.g. no bias
+            spec['tensors'][key] = '{}.{}'.format(li, key)
+            tensors.append((spec['tensors'][key], p.get_value()))
+        indices[layer] = li
+        layers.append(spec)
+
+    return layers, tensors
@@ -0,0 +1,245 @@
+'''
+Checkpoint file format for the parameters of the models and the training states.
+
+A checkpoint file is made of:
+    * 8 bytes of magic string (MAGIC)
+    * 8 bytes with the size of the header (little-endian unsigned integer)
+    * A JSON header with the name, shape, dtype and offset of each tensor and
+      any meta data (e.g. the configuration object, extra values)
+    * The raw tensors, each one aligned on ALIGN bytes
+The tensors can thus be loaded through a memory map, without any parsing or
+copy, and the parameters can be matched by name.
+
+This file is meant to be library-independent (independent of theano, lasagne, tensorflow, etc.)
+
+Copyright(C) 2017 Engineering Department, University of Cambridge, UK.
+
+License
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Author
+    Gilles Degottex <gad27@cam.ac.uk>
+'''
+
+from __future__ import print_function
+
+from percivaltts import *  # Always include this first to setup a few things
+
+import os
+import re
+import stat
+import json
+import struct
+import base64
+import cPickle
+
+import numpy as np
+numpy_force_random_seed()
+
+MAGIC = b'PRCVCKP1'
+ALIGN = 64
+
+
+def _encode(obj, arrays):
+    """Encode the meta data in JSON-compatible objects. The numpy arrays are appended to arrays and stored as tensors."""
+    if isinstance(obj, (np.ndarray, np.generic)):   # First, since some numpy scalars derive from Python's types
+        arrays.append(np.asarray(obj))
+        return {'__ndarray__':len(arrays)-1}
+    elif obj is None or isinstance(obj, (bool, int, long, float, str, unicode)):
+        return obj
+    elif type(obj) is list:
+        return [_encode(v, arrays) for v in obj]
+    elif type(obj) is tuple:
+        return {'__tuple__':[_encode(v, arrays) for v in obj]}
+    elif type(obj) is dict and all([isinstance(k, (str, unicode)) for k in obj.keys()]):
+        return {'__dict__':dict([(k, _encode(v, arrays)) for k, v in obj.items()])}
+    elif type(obj) is configuration:
+        return {'__configuration__':_encode(obj.__dict__, arrays)}
+    else:
+        return {'__pickle__':base64.b64encode(cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL))}  # Anything else (e.g. defaultdict)
+
+def _decode(obj, arrays):
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')  # Back to str, as in the saved objects
+    elif isinstance(obj, list):
+        return [_decode(v, arrays) for v in obj]
+    elif isinstance(obj, dict):
+        key, value = obj.items()[0]
+        if key=='__ndarray__':
+            array = np.array(arrays[value])   # Copy the meta data, only the tensors stay memory-mapped
+            return array[()] if array.ndim==0 else array
+        elif key=='__tuple__':          return tuple([_decode(v, arrays) for v in value])
+        elif key=='__dict__':           return dict([(_decode(k, arrays), _decode(v, arrays)) for k, v in value.items()])
+        elif key=='__configuration__':
+            cfg = configuration()
+            cfg.__dict__.update(_decode(value, arrays))
+            return cfg
+        elif key=='__pickle__':         return cPickle.loads(base64.b64decode(value))
+    return obj
+
+def _aligned(offset):
+    return ALIGN*((offset+ALIGN-1)//ALIGN)
+
+
+def save(fname, tensors, meta=None):
+    """
+    Save the tensors and the meta data in a checkpoint file.
+
+    The file is first written next to fname and then renamed, so that fname
+    is never left partially written (e.g. if the training is interrupted).
+    It keeps the permissions of the file it replaces, if any, otherwise it
+    gets those of a new file (i.e. 0666 restricted by the umask).
+
+    Parameters
+    ----------
+    tensors :   list of (name, numpy array)
+    meta :      Any meta data (e.g. dict of configuration object, values, lists, numpy arrays).
+                Most of the types are saved in JSON, the others are pickled.
+    """
+    import tempfile
+
+    metaarrays = []
+    meta = _encode(meta, metaarrays)
+    arrays = [np.array(value, copy=False, order='C') for _, value in tensors] + [np.array(value, copy=False, order='C') for value in metaarrays]
+    names = [name for name, _ in tensors] + [None]*len(metaarrays)
+
+    tensorsheader = []
+    offset = 0
+    for name, value in zip(names, arrays):
+        offset = _aligned(offset)
+        tensorsheader.append({'name':name, 'shape':list(value.shape), 'dtype':value.dtype.str, 'offset':offset})
+        offset += value.nbytes
+    header = json.dumps({'tensors':tensorsheader, 'nbmetaarrays':len(metaarrays), 'meta':meta}).encode('utf-8')
+    blobstart = _aligned(len(MAGIC)+8+len(header))
+
+    dirname = os.path.dirname(os.path.abspath(fname))
+    makedirs(dirname)
+    fd, ftmp = tempfile.mkstemp(dir=dirname, prefix=os.path.basename(fname)+'.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            for tensor, value in zip(tensorsheader, arrays):
+                f.seek(blobstart+tensor['offset'])
+                f.write(value.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(fname):
+            mode = stat.S_IMODE(os.stat(fname).st_mode)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(ftmp, mode)    # mkstemp(.) creates the file with 0600 only
+        os.rename(ftmp, fname)
+    except:
+        if os.path.exists(ftmp): os.remove(ftmp)
+        raise
+
+def ischeckpoint(fname):
+    """Return True if fname is a checkpoint file (as opposed to e.g. a pickle file of a previous version)."""
+    with open(fname, 'rb') as f:
+        return f.read(len(MAGIC))==MAGIC
+
+def load(fname):
+    """
+    Load a checkpoint file.
+
+    Returns
+    -------
+    tensors :   list of (name, numpy array), the arrays being read-only memory maps of the file.
+    meta :      The meta data.
+    """
+    with open(fname, 'rb') as f:
+        if f.read(len(MAGIC))!=MAGIC: raise ValueError('{} is not a checkpoint file'.format(fname))
+        headersize = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(headersize).decode('utf-8'))
+    blobstart = _aligned(len(MAGIC)+8+headersize)
+
+    mm = np.memmap(fname, dtype=np.uint8, mode='r')
+    arrays = []
+    for tensor in header['tensors']:
+        dtype = np.dtype(str(tensor['dtype']))
+        shape = tuple(tensor['shape'])
+        start = blobstart+tensor['offset']
+        arrays.append(mm[start:start+dtype.itemsize*int(np.prod(shape))].view(dtype).reshape(shape))
+
+    nbtensors = len(arrays)-header['nbmetaarrays']
+    tensors = [(str(tensor['name']), value) for tensor, value in zip(header['tensors'][:nbtensors], arrays[:nbtensors])]
+    meta = _decode(header['meta'], arrays[nbtensors:])
+
+    return tensors, meta
+
+def match(names, tensors, regexp=None):
+    """
+    Match the saved tensors with the given parameter names.
+
+    The parameters are matched by name if all the names are unique (in both
+    the parameters and the tensors), otherwise by position (as in the
+    previous pickle format). If regexp is given, only the parameters whose
+    names match it are considered (partial loading).
+
+    Returns
+    -------
+    list of (index in names, numpy array) for the parameters found in tensors.
+    """
+    tensornames = [name for name, _ in tensors]
+    if len(set(names))==len(names) and len(set(tensornames))==len(tensornames):
+        tensordict = dict(tensors)
+        matches = [(ni, tensordict[name]) for ni, name in enumerate(names) if name in tensordict]
+    else:
+        matches = [(ni, value) for ni, (_, value) in enumerate(tensors[:len(names)])]
+
+    if not regexp is None:
+        matches = [(ni, value) for ni, value in matches if re.search(regexp, names[ni])]
+
+    return matches
+
+def quantise(tensors, axes):
+    """
+    Quantise tensors in symmetric int8 per channel, with a float32 scale per channel.
+
+    Parameters
+    ----------
+    tensors :   list of (name, numpy array)
+    axes :      dict of the names of the tensors to quantise and the axis of their channels
+                (e.g. 1 for the weights of a dense layer, 0 for the filters of a 2D convolution)
+
+    Returns
+    -------
+    tensors :   The list of tensors, the quantised ones in int8, followed by their scales.
+    quantised : list of [index in tensors, axis] to give to dequantise(.) (e.g. through the meta data).
+    """
+    qtensors = list(tensors)
+    scales = []
+    quantised = []
+    for ti, (name, value) in enumerate(tensors):
+        if not name in axes: continue
+        axis = axes[name]%value.ndim
+        shape = [value.shape[axis] if d==axis else 1 for d in xrange(value.ndim)]
+        scale = np.max(abs(value), axis=tuple([d for d in xrange(value.ndim) if d!=axis])) / 127.0
+        scale[scale==0.0] = 1.0     # Any scale works for null channels
+        scale = scale.astype(np.float32)
+        qtensors[ti] = (name, np.clip(np.round(value/scale.reshape(shape)), -127, 127).astype(np.int8))
+        scales.append((name+'.scale', scale))
+        quantised.append([ti, axis])
+    return qtensors+scales, quantised
+
+def dequantise(tensors, quantised):
+    """Invert quantise(.), returns the list of tensors in float32, without the scales."""
+    nbtensors = len(tensors)-len(quantised)
+    dtensors = list(tensors[:nbtensors])
+    for (ti, axis), (_, scale) in zip(quantised, tensors[nbtensors:]):
+        name, value = dtensors[ti]
+        shape = [value.shape[axis] if d==axis else 1 for d in xrange(value.ndim)]
+        dtensors[ti] = (name, value.astype(np.float32)*scale.reshape(shape))
+    return dtensors
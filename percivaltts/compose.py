@@ -28,8 +28,34 @@ numpy_force_random_seed()
 import scipy.signal
 
 import data
+import labels
 
-def normalise_minmax(filepath, fids, outfilepath=None, featurepaths=None, nrange=None, keepidx=None, zerovarstozeros=True, verbose=1):
+def normalise_minmax_apply(Y, mins, maxs, nrange=None, zerovarstozeros=True):
+    """
+    Normalise the [min,max] values of the matrix Y to nrange values ([-1,1] by default),
+    as done by normalise_minmax(.) (e.g. to normalise new inputs with the statistics
+    saved in min4norm.dat and max4norm.dat).
+    """
+    if nrange is None: nrange=[-1,1]
+
+    mins = mins.copy()
+    maxmindiff = (maxs-mins)
+
+    if zerovarstozeros:                 # Force idx of zero vars to zero values
+        mins[maxmindiff==0.0] = 0.0     # to avoid zero vars idx to -1, e.g.
+
+    maxmindiff[maxmindiff==0.0] = 1.0   # Avoid division by zero in dead dimensions
+
+    Y = (Y - mins)/maxmindiff
+
+    Y -= 0.5  # ... then center it ...
+    Y *= 2.0  # ... and scale it to put it in [-1, 1]. Now DWTFYW
+    Y *= (nrange[1]-nrange[0])/2.0    # 2.0 is the current range
+    Y += 0.5*(nrange[0]+nrange[1])
+
+    return Y
+
+def normalise_minmax(filepath, fids, outfilepath=None, featurepaths=None, nrange=None, keepidx=None, zerovarstozeros=True, verbose=1, Ys=None):
     """
     Normalisation function for compose.compose(.): Normalise [min,max] values to nrange values ([-1,1] by default)
     """
@@ -57,26 +83,17 @@ def normalise_minmax(filepath, fids, outfilepath=None, featurepaths=None, nrange
     mins.astype('float32').tofile(os.path.dirname(outfilepath)+'/min4norm.dat')
     maxs.astype('float32').tofile(os.path.dirname(outfilepath)+'/max4norm.dat')
 
-    maxmindiff = (maxs-mins)
-
-    if zerovarstozeros:                 # Force idx of zero vars to zero values
-        mins[maxmindiff==0.0] = 0.0     # to avoid zero vars idx to -1, e.g.
-
-    maxmindiff[maxmindiff==0.0] = 1.0   # Avoid division by zero in dead dimensions
-
     for nf, fid in enumerate(fids):
-        finpath = filepath.replace('*',fid)
-        Y = np.fromfile(finpath, dtype='float32')
+        if Ys is None:
+            finpath = filepath.replace('*',fid)
+            Y = np.fromfile(finpath, dtype='float32')
+        else:
+            Y = Ys[nf]  # Data given in memory (see compose_labels(.))
         Y = Y.reshape((-1,orisize))
 
         Y = Y[:,keepidx]
 
-        Y = (Y - mins)/maxmindiff
-
-        Y -= 0.5  # ... then center it ...
-        Y *= 2.0  # ... and scale it to put it in [-1, 1]. Now DWTFYW
-        Y *= (nrange[1]-nrange[0])/2.0    # 2.0 is the current range
-        Y += 0.5*(nrange[0]+nrange[1])
+        Y = normalise_minmax_apply(Y, mins, maxs, nrange=nrange, zerovarstozeros=zerovarstozeros)
 
         print_tty('\r    Write normed data file {}: {}                '.format(nf, fid))
 
@@ -84,7 +101,7 @@ def normalise_minmax(filepath, fids, outfilepath=None, featurepaths=None, nrange
         Y.astype('float32').tofile(foutpath)
     print_tty('\r                                                           \r')
 
-def normalise_meanstd(filepath, fids, outfilepath=None, featurepaths=None, keepidx=None, verbose=1):
+def normalise_meanstd(filepath, fids, outfilepath=None, featurepaths=None, keepidx=None, verbose=1, Ys=None):
     """
     Normalisation function for compose.compose(.): Normalise mean and standard-deviation values to 0 and 1, respectively.
     """
@@ -113,8 +130,11 @@ def normalise_meanstd(filepath, fids, outfilepath=None, featurepaths=None, keepi
                           # Though, during denormalisation, the data variance will be crushed to zero variance, and not one, which is the correct behavior.
 
     for nf, fid in enumerate(fids):
-        finpath = filepath.replace('*',fid)
-        Y = np.fromfile(finpath, dtype='float32')
+        if Ys is None:
+            finpath = filepath.replace('*',fid)
+            Y = np.fromfile(finpath, dtype='float32')
+        else:
+            Y = Ys[nf]  # Data given in memory (see compose_labels(.))
         Y = Y.reshape((-1,len(means)))
         Y = (Y - means)/stds
         print_tty('\r    Write normed data file {}: {}                '.format(nf, fid))
@@ -122,7 +142,7 @@ def normalise_meanstd(filepath, fids, outfilepath=None, featurepaths=None, keepi
         Y.astype('float32').tofile(foutpath)
     print_tty('\r                                                           \r')
 
-def normalise_meanstd_nmnoscale(filepath, fids, outfilepath=None, featurepaths=None, keepidx=None, verbose=1):
+def normalise_meanstd_nmnoscale(filepath, fids, outfilepath=None, featurepaths=None, keepidx=None, verbose=1, Ys=None):
     """
     Normalisation function for compose.compose(.): Normalise mean and
     standard-deviation values to 0 and 1, respectively, except the 3rd feature
@@ -171,8 +191,11 @@ def normalise_meanstd_nmnoscale(filepath, fids, outfilepath=None, featurepaths=N
 
     stds[stds==0.0] = 1.0 # Force std to 1 for constant values to avoid division by zero
     for nf, fid in enumerate(fids):
-        finpath = filepath.replace('*',fid)
-        Y = np.fromfile(finpath, dtype='float32')
+        if Ys is None:
+            finpath = filepath.replace('*',fid)
+            Y = np.fromfile(finpath, dtype='float32')
+        else:
+            Y = Ys[nf]  # Data given in memory (see compose_labels(.))
         Y = Y.reshape((-1,len(means)))
         Y = (Y - means)/stds
         print_tty('\r    Write normed data file {}: {}                '.format(nf, fid))
@@ -358,6 +381,90 @@ def compose(featurepaths, fids, outfilepath, wins=None, id_valid_start=-1, normf
             print('verif_stds={}'.format(verif_stds))
 
 
+def compose_labels(label_normaliser, labpath, fids, outfilepath, id_valid_start=-1, normfn=None, label_type='state_align', shift=0.005, dropzerovardims=False, verbose=1):
+    """
+    Same as compose(.) for the input text labels, but without any intermediate
+    file: The outputs of label_normaliser (e.g. Merlin's HTSLabelNormalisation)
+    are kept in memory (in float32), the statistics are computed from them
+    and they are passed directly to normfn. Only the normalised inputs and the
+    statistics files are written in the outfilepath directory.
+
+    Parameters
+    ----------
+    label_normaliser : Object providing extract_linguistic_features(.), e.g.
+                    external.merlin.label_normalisation.HTSLabelNormalisation
+    labpath :       path of the HTS label files (e.g. label_state_align/*.lab)
+    fids :          file IDs
+    outfilepath :   outputpath of the resulted composition and normalisation.
+    """
+    print('Compose labels in memory (id_valid_start={})'.format(id_valid_start))
+
+    outfilepath = re.sub(r':[^:]+$', "", outfilepath)   # ignore any shape suffix in the output path
+    makedirs(os.path.dirname(outfilepath))
+
+    Ys = []
+    mins = None
+    maxs = None
+    means = None
+    nbframes = 0
+    for nf, fid in enumerate(fids):
+        print_tty('\r    Extracting labels features {}/{} {}               '.format(1+nf, len(fids), fid))
+
+        Y = label_normaliser.extract_linguistic_features(labpath.replace('*',fid), None, label_type=label_type)
+        Y = Y.astype('float32')
+        Ys.append(Y)
+
+        if nf<id_valid_start:
+            if mins is None:  mins=Y.min(axis=0)
+            else:             mins=np.minimum(mins, Y.min(axis=0))
+            if maxs is None:  maxs=Y.max(axis=0)
+            else:             maxs=np.maximum(maxs, Y.max(axis=0))
+            if means is None: means =Y.sum(axis=0).astype('float64')
+            else:             means+=Y.sum(axis=0).astype('float64')
+            nbframes += Y.shape[0]
+    print_tty('\r                                                           \r')
+
+    means /= nbframes
+    zerovaridx = np.where((maxs-mins)==0.0)[0]  # Indices of dimensions having zero-variance
+
+    stds = None
+    for Y in Ys[:id_valid_start]:
+        if stds is None: stds =((Y-means)**2).sum(axis=0).astype('float64')
+        else:            stds+=((Y-means)**2).sum(axis=0).astype('float64')
+    stds /= nbframes-1  # unbiased variance estimator
+    stds = np.sqrt(stds)
+
+    mins.astype('float32').tofile(os.path.dirname(outfilepath)+'/min.dat')
+    maxs.astype('float32').tofile(os.path.dirname(outfilepath)+'/max.dat')
+    means.astype('float32').tofile(os.path.dirname(outfilepath)+'/mean.dat')
+    stds.astype('float32').tofile(os.path.dirname(outfilepath)+'/std.dat')
+    if verbose>1:                                           # pragma: no cover
+        print('    mins={}'.format(mins))
+        print('    maxs={}'.format(maxs))
+        print('    means={}'.format(means))
+        print('    stds={}'.format(stds))
+
+    keepidx = np.arange(len(means))
+    if dropzerovardims:
+        keepidx = np.setdiff1d(np.arange(len(means)), zerovaridx)
+        keepidx.astype('int32').tofile(os.path.dirname(outfilepath)+'/keepidx.dat')
+        print('Dropped dimensions with zero variance. Remains {} dims'.format(len(keepidx)))
+
+    print('{} files'.format(len(fids)))
+    print('{} frames ({}s assuming {}s time shift)'.format(nbframes, datetime.timedelta(seconds=nbframes*shift), shift))
+    print('nb dimensions={}'.format(len(keepidx)))
+    print('{} dimensions with zero-variance ({}){}'.format(len(zerovaridx), zerovaridx, ', which have been dropped' if dropzerovardims else ', which have been kept'))
+    print('output path: {}'.format(outfilepath))
+
+    if normfn is None:
+        print('no normalisation called')
+        for fid, Y in zip(fids, Ys):
+            Y[:,keepidx].tofile(outfilepath.replace('*',fid))
+    else:
+        print('normalisation done using: {}'.format(normfn.__name__))
+        normfn(outfilepath, fids, keepidx=keepidx, verbose=verbose, Ys=Ys)
+
+
 def create_weights_spec(specfeaturepath, fids, outfilepath, thresh=-32, dftlen=4096, spec_type='fwlspec'):
     """
     This function creates a one-column vector with one weight value per frame.
@@ -414,13 +521,16 @@ def create_weights_spec(specfeaturepath, fids, outfilepath, thresh=-32, dftlen=4
 
     print_tty('\r                                                           \r')
 
-def create_weights_lab(labpath, fids, outfilepath, lineheadregexp=r'([^\^]+)\^([^-]+)-([^\+]+)\+([^=]+)=([^@]+)@(.+)', silencesymbol='sil', shift=0.005):
+def create_weights_lab(labpath, fids, outfilepath, lineheadregexp=r'([^\^]+)\^([^-]+)-([^\+]+)\+([^=]+)=([^@]+)@(.+)', silencesymbol='sil', shift=0.005, labcachedir=None):
     """
     This function creates a one-column vector with one weight value per frame.
     This weight is created based on the silence symbol that is at the head of
     each lab line.
 
     Some lab file formats uses: r'([^\~]+)\~([^-]+)-([^\+]+)\+([^=]+)=([^:]+):(.+)'
+
+    labcachedir : Directory where to keep the binary parses of the label files
+                  (see labels.load(.)). The parses are kept in memory anyway.
     """
 
     makedirs(os.path.dirname(outfilepath))
@@ -430,22 +540,15 @@ def create_weights_lab(labpath, fids, outfilepath, lineheadregexp=r'([^\^]+)\^([
     for fid in readids(fids):
         print_tty('\r    Processing feature file {}                '.format(fid))
 
-        with open(labpath.replace('*',fid)) as f:
+        segs, labstrs = labels.load(labpath.replace('*',fid), cachedir=labcachedir)
 
-            lines = f.readlines()
-            lineels = re.findall(r'([0-9]+)\s+([0-9]+)\s+(.+)', lines[-1])[0]
-            tend   = float(lineels[1])*1e-7
-            weight = np.ones(int(np.ceil(tend/shift)), dtype='float32')
+        weight = np.ones(labels.nbframes(segs, shift), dtype='float32')
 
-            for line in lines:
-                lineels = re.findall(r'([0-9]+)\s+([0-9]+)\s+(.+)', line)[0]
-                tstart = float(lineels[0])*1e-7
-                tend   = float(lineels[1])*1e-7
-                # print('{}-{}'.format(tstart, tend))
-                phones = re.findall(lineheadregexp, lineels[2])[0]
-                if phones[2]==silencesymbol:
-                    weight[int(np.floor(tstart/shift)):int(np.ceil(tend/shift))] = 0.0
+        issil = np.array([phone==silencesymbol for phone in labels.phones(labstrs, lineheadregexp)], dtype=bool)
+        starts, ends = labels.frames_segments(segs, shift)
+        for start, end in zip(starts[issil[segs['label']]], ends[issil[segs['label']]]):
+            weight[start:end] = 0.0
 
-            weight.astype('float32').tofile(outfilepath.replace('*',fid))
+        weight.astype('float32').tofile(outfilepath.replace('*',fid))
 
     print_tty('\r                                                           \r')
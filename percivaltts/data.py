@@ -141,6 +141,30 @@ def gettotallen(Xs, axis=0):
         l += Xs[i].shape[axis]
     return l
 
+def batches_bylength(lengths, framebudget):
+    """
+    Group items of the given lengths in batches for padded processing (e.g. Model.predict_padded(.)).
+
+    The items are sorted by length, so that items of similar lengths are padded
+    together, and each batch is filled as long as its padded size (its number
+    of items times its longest item) stays within framebudget frames. An item
+    longer than framebudget makes a batch on its own.
+
+    Returns
+    -------
+    The list of batches, each one being the list of indices of its items.
+    """
+    batches = []
+    batch = []
+    for idx in np.argsort(lengths, kind='mergesort'): # Stable, in order to keep the order of items of same length
+        if len(batch)>0 and (len(batch)+1)*lengths[idx]>framebudget:
+            batches.append(batch)
+            batch = []
+        batch.append(int(idx))
+    if len(batch)>0: batches.append(batch)
+
+    return batches
+
 def croplen(xs, axis=0):
     """
     Crop each matrices of a list of matrices to the same length among other matching list of matrices (Attention: Argument xs modified!)
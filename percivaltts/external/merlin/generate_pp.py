@@ -43,6 +43,7 @@
 
 import sys, os, subprocess, commands
 import numpy as np
+import scipy.signal
 
 import external.pulsemodel.sigproc as sp
 
@@ -160,3 +161,83 @@ def mcep_postproc_sptk(mcep, fs, dftlen=4096):
     #print(mgcpp.shape)
 
     return mgcpp
+
+
+# In-process NumPy versions of the SPTK tools used by mcep_postproc_sptk(.)
+# They work on all the frames at once (one frame per row).
+
+_freqt_mats = dict()   # (m1, m2, alpha) -> transformation matrix of freqt(.)
+
+def freqt(c1, m2, alpha):
+    """
+    Frequency transformation of cepstra (as SPTK's `freqt -m m1 -a alpha -M m2 -A 0`).
+
+    The transformation is linear: The row k of its matrix is the power series
+    of the k-th power of the all-pass function (z^-1-alpha)/(1-alpha*z^-1),
+    truncated to m2+1 terms. The matrix is cached for the following calls.
+    """
+    m1 = c1.shape[1]-1
+    key = (m1, m2, float(alpha))
+    A = _freqt_mats.get(key)
+    if A is None:
+        A = np.zeros((m1+1, m2+1))
+        A[0, 0] = 1.0
+        for k in xrange(1, m1+1):
+            A[k] = scipy.signal.lfilter([-alpha, 1.0], [1.0, -alpha], A[k-1])
+        A[np.abs(A)<1e-100] = 0.0   # Flush the negligible values (denormals slow down the products)
+        _freqt_mats[key] = A
+
+    return np.dot(c1, A)
+
+def c2acr(c, m2, fftlen):
+    """Autocorrelation (of order m2) from cepstra (as SPTK's `c2acr -m m1 -M m2 -l fftlen`)."""
+    X = np.fft.rfft(c, fftlen, axis=1).real  # The log amplitude spectrum
+    X = np.exp(2.0*X)                        # The power spectrum (even, thus only the first half)
+    # Inverse DFT of the power spectrum, only for the first m2+1 lags
+    weights = np.full(fftlen//2+1, 2.0)
+    weights[0] = 1.0
+    weights[-1] = 1.0
+    idft = np.cos(2.0*np.pi*np.outer(np.arange(fftlen//2+1), np.arange(m2+1))/fftlen)*np.reshape(weights/fftlen, (-1, 1))
+    return np.dot(X, idft)
+
+def mc2b(mc, alpha):
+    """Mel-cepstra to MLSA filter coefficients (as SPTK's `mc2b -a alpha`)."""
+    # b[m] = mc[m] - alpha*b[m+1], running from the last coefficient
+    return scipy.signal.lfilter([1.0], [1.0, alpha], mc[:, ::-1], axis=1)[:, ::-1]
+
+def b2mc(b, alpha):
+    """MLSA filter coefficients to mel-cepstra (as SPTK's `b2mc -a alpha`)."""
+    mc = b.copy()
+    mc[:, :-1] += alpha*b[:, 1:]
+    return mc
+
+def mcep_postproc(mcep, fs, dftlen=4096, pf_coef=1.4):
+    """
+    Same as mcep_postproc_sptk(.), but in memory, using NumPy only (i.e. no
+    temporary files and no SPTK processes) and on all the frames at once.
+    """
+    mcep = np.asarray(mcep, dtype=np.float64)
+    mgc_dim = mcep.shape[1]
+
+    fw_coef = sp.bark_alpha(fs)
+    co_coef = dftlen/2+1
+
+    weight = np.ones(mgc_dim)
+    weight[2:] = pf_coef
+
+    # Compute autocorr of decompressed cepstrum (unwarped cepstrum), i.e. original autocorr
+    r0 = c2acr(freqt(mcep, co_coef, fw_coef), 0, dftlen)[:, 0]
+
+    # Weight the warped cepstrum and get the resulting autocorr
+    mcep_w = mcep*weight
+    p_r0 = c2acr(freqt(mcep_w, co_coef, fw_coef), 0, dftlen)[:, 0]
+
+    # Weight the warped cepstrum and get the corresponding MLSA coefs
+    b = mc2b(mcep_w, fw_coef)
+
+    # Replace the gain by: log of the ratio original autocorr / weighted-cep autocorr, divided by 2, plus the weighted-cep gain
+    b[:, 0] += 0.5*np.log(r0/p_r0)
+
+    mgcpp = b2mc(b, fw_coef)
+
+    return mgcpp.astype('float32')
@@ -45,6 +45,8 @@ from multiprocessing import Pool
 
 import matplotlib.mlab as mlab
 
+import labels  # PercivalTTS's parser of HTS label files
+
 # import lxml
 # from lxml import etree
 # from lxml.etree import *
@@ -299,11 +301,9 @@ class HTSLabelNormalisation(LabelNormalisation):
             else: ## phoneme/syllable/word
                 dur_feature_matrix = numpy.empty((100000, 1))
 
-        fid = open(file_name)
-        utt_labels = fid.readlines()
-        fid.close()
+        segs, labstrs = labels.load(file_name) # Parsed once and shared with the other stages (e.g. weights)
 
-        label_number = len(utt_labels)
+        label_number = len(segs)
         # logger.info('loaded %s, %3d labels' % (file_name, label_number) )
 
         MLU_dur = [[],[],[]]
@@ -312,19 +312,12 @@ class HTSLabelNormalisation(LabelNormalisation):
         dur_feature_index = 0
         syllable_duration = 0
         word_duration = 0
-        for line in utt_labels:
-            line = line.strip()
+        for seg in segs:
+            start_time = int(seg['start'])
+            end_time = int(seg['end'])
 
-            if len(line) < 1:
-                continue
-            temp_list = re.split('\s+', line)
-            start_time = int(temp_list[0])
-            end_time = int(temp_list[1])
-
-            full_label = temp_list[2]
-            full_label_length = len(full_label) - 3  # remove state information [k]
-            state_index = full_label[full_label_length + 1]
-            state_index = int(state_index) - 1
+            full_label = labstrs[seg['label']]+'[{}]'.format(seg['state']) # (with the state information [k], as in the label file)
+            state_index = int(seg['state']) - 1
             current_phone = full_label[full_label.index('-') + 1:full_label.index('+')]
 
             frame_number = int(end_time/50000) - int(start_time/50000)
@@ -333,9 +326,8 @@ class HTSLabelNormalisation(LabelNormalisation):
                 phone_duration = frame_number
 
                 for i in range(state_number - 1):
-                    line = utt_labels[current_index + i + 1].strip()
-                    temp_list = re.split('\s+', line)
-                    phone_duration += int((int(temp_list[1]) - int(temp_list[0]))/50000)
+                    nextseg = segs[current_index + i + 1]
+                    phone_duration += int((int(nextseg['end']) - int(nextseg['start']))/50000)
 
                 syllable_duration+=phone_duration
                 word_duration+=phone_duration
@@ -602,38 +594,26 @@ class HTSLabelNormalisation(LabelNormalisation):
         state_number = 5
 
         lab_binary_vector = numpy.zeros((1, self.dict_size))
-        fid = open(file_name)
-        utt_labels = fid.readlines()
-        fid.close()
+        segs, labstrs = labels.load(file_name) # Parsed once and shared with the other stages (e.g. weights)
         current_index = 0
-        label_number = len(utt_labels)
+        label_number = len(segs)
         # logger.info('loaded %s, %3d labels' % (file_name, label_number) )
 
         phone_duration = 0
         state_duration_base = 0
-        for line in utt_labels:
-            line = line.strip()
+        for seg in segs:
+            full_label = labstrs[seg['label']] # (without state information [k])
 
-            if len(line) < 1:
-                continue
-            temp_list = re.split('\s+', line)
-
-            if len(temp_list)==1:
+            if seg['start']<0:
                 frame_number = 0
                 state_index = 1
-                full_label = temp_list[0]
             else:
-                start_time = int(temp_list[0])
-                end_time = int(temp_list[1])
+                start_time = int(seg['start'])
+                end_time = int(seg['end'])
                 frame_number = int(end_time/50000) - int(start_time/50000)
-                full_label = temp_list[2]
-
-                full_label_length = len(full_label) - 3  # remove state information [k]
-                state_index = full_label[full_label_length + 1]
 
-                state_index = int(state_index) - 1
+                state_index = int(seg['state']) - 1
                 state_index_backward = 6 - state_index
-                full_label = full_label[0:full_label_length]
 
             if state_index == 1:
                 current_frame_number = 0
@@ -647,13 +627,12 @@ class HTSLabelNormalisation(LabelNormalisation):
                 label_continuous_vector = self.pattern_matching_continous_position(full_label)
                 label_vector = numpy.concatenate([label_binary_vector, label_continuous_vector], axis = 1)
 
-                if len(temp_list)==1:
+                if seg['start']<0:
                     state_index = state_number
                 else:
                     for i in range(state_number - 1):
-                        line = utt_labels[current_index + i + 1].strip()
-                        temp_list = re.split('\s+', line)
-                        phone_duration += int((int(temp_list[1]) - int(temp_list[0]))/50000)
+                        nextseg = segs[current_index + i + 1]
+                        phone_duration += int((int(nextseg['end']) - int(nextseg['start']))/50000)
 
                     if self.subphone_feats == "coarse_coding":
                         cc_feat_matrix = self.extract_coarse_coding_features_relative(phone_duration)
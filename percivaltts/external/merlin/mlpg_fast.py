@@ -54,11 +54,20 @@ import bandmat as bm
 import bandmat.linalg as bla
 
 class MLParameterGenerationFast(object):
-    def __init__(self, delta_win = [-0.5, 0.0, 0.5], acc_win = [1.0, -2.0, 1.0]):
+    def __init__(self, delta_win = [-0.5, 0.0, 0.5], acc_win = [1.0, -2.0, 1.0], batch_size=16384):
         self.delta_win = delta_win
         self.acc_win   = acc_win
         ###assume the delta and acc windows have the same length
         self.win_length = int(len(delta_win)/2)
+        self.batch_size = batch_size    # Max number of values (dimensions x frames) solved at once by generation(.)
+        self._win_terms_cache = dict()  # frames -> sparse window matrices (see win_terms(.))
+
+    # The windows used by generation(.) and generation_perdim(.)
+    windows = [
+        (0, 0, np.array([1.0])),
+        (1, 1, np.array([-0.5, 0.0, 0.5])),
+        (1, 1, np.array([1.0, -2.0, 1.0])),
+    ]
 
     def build_win_mats(self, windows, frames):
         win_mats = []
@@ -92,13 +101,213 @@ class MLParameterGenerationFast(object):
 
         return b, prec
 
+    def win_terms(self, windows, frames, sdw):
+        """
+        Sparse description of the window matrices for a given number of frames,
+        as used by build_poe_batch(.). Cached by number of frames (the windows
+        are the same for all the calls of generation(.)).
+
+        Returns two lists:
+          b_terms: (win_index, coeff, s, t0, t1), meaning that the dynamic
+                   frames t0<=t<t1 add coeff*b_frames[t] to the static frame t+s.
+          prec_terms: (win_index, m, coeff, s, t0, t1), meaning that the dynamic
+                   frames t0<=t<t1 add coeff*tau_frames[t] to the element
+                   [t+s+m,t+s] of the precision matrix.
+        The truncation of the windows at the beginning and end of the utterance
+        is encoded in the frame ranges [t0,t1).
+        """
+        terms = self._win_terms_cache.get(frames)
+        if terms is None:
+            b_terms = []
+            prec_terms = []
+            for win_index, (l, u, win_coeff) in enumerate(windows):
+                assert l >= 0 and u >= 0
+                assert len(win_coeff) == l + u + 1
+                for j in xrange(l + u + 1):
+                    s = j - l    # The dynamic frame t is weighted by win_coeff[j] at the static frame t+s
+                    t0 = max(0, -s)
+                    t1 = min(frames, frames-s)
+                    if win_coeff[j]!=0.0 and t1>t0:
+                        b_terms.append((win_index, win_coeff[j], s, t0, t1))
+                    for j2 in xrange(j, min(l + u + 1, j + sdw + 1)):
+                        t1 = min(frames, frames-(j2-l))
+                        if win_coeff[j]*win_coeff[j2]!=0.0 and t1>t0:
+                            prec_terms.append((win_index, j2-j, win_coeff[j]*win_coeff[j2], s, t0, t1))
+            terms = (b_terms, prec_terms)
+            self._win_terms_cache[frames] = terms
+
+        return terms
+
+    def build_poe_batch(self, b_frames, tau_frames, win_terms, sdw):
+        """
+        Same as build_poe(.), but for all the dimensions at once.
+
+        b_frames and tau_frames are of shape (num_windows, dims, frames).
+        Returns the right-hand sides b of shape (dims, frames) and the lower
+        bands of the precision matrices, of shape (sdw+1, dims, frames) (i.e.
+        prec[m,d,t] is the element [t+m,t] of the precision matrix of the
+        dimension d).
+        """
+        num_windows, dims, frames = b_frames.shape
+        b_terms, prec_terms = win_terms
+
+        b = np.zeros((dims, frames))
+        prec = np.zeros((sdw+1, dims, frames))
+
+        for win_index, coeff, s, t0, t1 in b_terms:
+            b[:, t0+s:t1+s] += coeff*b_frames[win_index, :, t0:t1]
+        for win_index, m, coeff, s, t0, t1 in prec_terms:
+            prec[m, :, t0+s:t1+s] += coeff*tau_frames[win_index, :, t0:t1]
+
+        return b, prec
+
+    def solveh_batch(self, b_frames, tau_frames, win_terms, sdw):
+        """
+        Solve the MLPG problem for a batch of dimensions at once.
+
+        The precision matrices of the dimensions are built together and
+        stacked into a single block-diagonal banded matrix (the blocks do not
+        overlap since the bands of each block are zero beyond its last frame),
+        which is then factored and solved by a single call to bandmat.
+
+        b_frames and tau_frames are of shape (num_windows, dims, frames).
+        Returns the static trajectories, of shape (dims, frames).
+        """
+        num_windows, dims, frames = b_frames.shape
+
+        b, prec_lower = self.build_poe_batch(b_frames, tau_frames, win_terms, sdw)
+
+        size = dims*frames
+        prec_lower = np.reshape(prec_lower, (sdw+1, size))
+        prec_data = np.zeros((2*sdw+1, size))
+        prec_data[sdw:] = prec_lower
+        for m in xrange(1, sdw+1):
+            prec_data[sdw-m, m:] = prec_lower[m, :size-m]
+        prec = bm.BandMat(sdw, sdw, prec_data)
+
+        mean_traj = bla.solveh(prec, np.reshape(b, (size,)))
+
+        return np.reshape(mean_traj, (dims, frames))
+
     def generation(self, features, covariance, static_dimension):
+        """
+        Same as generation_perdim(.), but the dimensions are solved in batches
+        (see solveh_batch(.)). The batches are limited to batch_size values
+        (dimensions x frames), so that the working arrays remain in the CPU
+        caches.
+        """
+        windows = self.windows
+        num_windows = len(windows)
+
+        frame_number = features.shape[0]
+
+        logger = logging.getLogger('param_generation')
+        logger.debug('starting MLParameterGeneration.generation')
+
+        gen_parameter = np.zeros((frame_number, static_dimension))
+
+        sdw = max([l + u for l, u, _ in windows])
+        win_terms = self.win_terms(windows, frame_number, sdw)
+
+        features = np.reshape(features[:, :num_windows*static_dimension], (frame_number, num_windows, static_dimension))
+        covariance = np.reshape(covariance[:, :num_windows*static_dimension], (frame_number, num_windows, static_dimension))
+
+        batch_dims = max(1, self.batch_size//frame_number)
+        for d0 in xrange(0, static_dimension, batch_dims):
+            d1 = min(static_dimension, d0+batch_dims)
+
+            # Time is the fastest axis, so that each dimension is a contiguous block of the stacked system
+            mu_frames = np.array(np.transpose(features[:, :, d0:d1], (1, 2, 0)), dtype=float64, order='C')
+            var_frames = np.array(np.transpose(covariance[:, :, d0:d1], (1, 2, 0)), dtype=float64, order='C')
+            var_frames[1:, :, 0] = 100000000000;
+            var_frames[1:, :, frame_number-1] = 100000000000;
+
+            tau_frames = 1.0 / var_frames
+            b_frames = mu_frames * tau_frames
+
+            gen_parameter[:, d0:d1] = self.solveh_batch(b_frames, tau_frames, win_terms, sdw).T
+
+        return gen_parameter
+
+    def generation_chunks(self, features, covariance, static_dimension, chunk_size=200, lookahead=50, crossfade=10):
+        """
+        Windowed version of generation(.) that yields the static trajectories
+        chunk by chunk (of chunk_size frames, the last one can be shorter), so
+        that the following processing (e.g. vocoding) can start before the end
+        of the utterance is solved, and the memory used by the solver is
+        bounded by (chunk_size+2*lookahead) frames whatever the utterance
+        duration.
+
+        Each chunk is solved on its own, extended by lookahead frames on both
+        sides. The last crossfade frames of the extension are linearly
+        cross-faded with the beginning of the next chunk (crossfade<=lookahead).
+
+        Error bound: The error of a chunk's solution (w.r.t. generation(.))
+        comes from the truncation of the problem at the edges of its extended
+        range, which perturbs only the sdw=2 frames closest to these edges.
+        Following [Demko, Moss & Smith 1984], the inverse of a positive definite
+        band matrix decays exponentially away from its diagonal. Thus, the
+        error at a frame distant of d frames from the truncated edges is bounded
+        by
+            |e[t]| <= C * lam**(d-sdw) * |r|
+        where C and lam are given by decay_bound(.) and |r| is the l1-norm of
+        the perturbation at the edges (of the order of the static values times
+        the precisions). Here d>=lookahead-crossfade for all frames (the edges
+        of the utterance are not truncated). The decay is slower for the
+        dimensions whose static variance is large compared to the variances of
+        their dynamic features (lam close to 1), which is where the lookahead
+        should be increased.
+        """
+        assert crossfade <= lookahead
+        frame_number = features.shape[0]
+
+        prev_tail = None
+        for c0 in xrange(0, frame_number, chunk_size):
+            c1 = min(frame_number, c0+chunk_size)
+            s0 = max(0, c0-lookahead)
+            s1 = min(frame_number, c1+lookahead)
+
+            gen_parameter = self.generation(features[s0:s1], covariance[s0:s1], static_dimension)
+            gen_chunk = gen_parameter[c0-s0:c1-s0]
+
+            if prev_tail is not None:
+                n = min(prev_tail.shape[0], gen_chunk.shape[0])
+                fade = np.reshape((np.arange(n)+0.5)/n, (n, 1))
+                gen_chunk[:n] = (1.0-fade)*prev_tail[:n] + fade*gen_chunk[:n]
+            prev_tail = gen_parameter[c1-s0:min(s1, c1+crossfade)-s0]
+
+            yield gen_chunk
+
+    def decay_bound(self, covariance, static_dimension):
+        """
+        Constants of the error bound of generation_chunks(.), per dimension.
+
+        The precision matrix P=sum_w W_w^T diag(1/var_w) W_w has its eigenvalues
+        in [a,b] with a>=min(1/var_static) and b<=sum_w max(1/var_w)*|W_w|^2,
+        where |W_w|<=sum(|win_coeff|). From the condition number k=b/a and the
+        band width sdw, [Demko, Moss & Smith 1984] gives
+            |inv(P)[i,j]| <= C * lam**|i-j|
+        with lam=((sqrt(k)-1)/(sqrt(k)+1))**(1/sdw) and C=max(1/a, (1+sqrt(k))**2/(2b)).
+
+        Returns C and lam, both of size static_dimension.
+        """
+        num_windows = len(self.windows)
+        sdw = max([l + u for l, u, _ in self.windows])
+
+        tau_frames = 1.0 / np.reshape(covariance[:, :num_windows*static_dimension], (-1, num_windows, static_dimension)).astype(float64)
+        a = tau_frames[:, 0, :].min(axis=0)
+        b = np.zeros(static_dimension)
+        for win_index, (_, _, win_coeff) in enumerate(self.windows):
+            b += tau_frames[:, win_index, :].max(axis=0)*np.sum(np.abs(win_coeff))**2
+        k = b / a
+        lam = ((np.sqrt(k)-1.0)/(np.sqrt(k)+1.0))**(1.0/sdw)
+        C = np.maximum(1.0/a, (1.0+np.sqrt(k))**2/(2.0*b))
+
+        return C, lam
+
+    def generation_perdim(self, features, covariance, static_dimension):
 
-        windows = [
-            (0, 0, np.array([1.0])),
-            (1, 1, np.array([-0.5, 0.0, 0.5])),
-            (1, 1, np.array([1.0, -2.0, 1.0])),
-        ]
+        windows = self.windows
         num_windows = len(windows)
 
         frame_number = features.shape[0]
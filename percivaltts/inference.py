@@ -0,0 +1,365 @@
+'''
+NumPy runtime of the networks exported by Model.export_inference(.)
+
+An exported network is run on CPU without Theano, Lasagne or any compilation,
+so that a trained voice can be served with a start time of a few milliseconds.
+
+The network is stored in a checkpoint file (see checkpoint.py), whose tensors
+are the parameters of the network and whose meta data is the list of its
+layers, in topological order. Each layer is a dict with:
+    * 'type':   the operation (see the _op_* functions below)
+    * 'name':   the name of the original layer
+    * 'inputs': the indices of the layers it takes as input
+    * the arguments of the operation (e.g. 'axis', 'nonlinearity')
+    * 'tensors': dict of the parameters of the operation and the name of their tensor
+
+This file is meant to be library-independent (independent of theano, lasagne, tensorflow, etc.)
+
+Copyright(C) 2017 Engineering Department, University of Cambridge, UK.
+
+License
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Author
+    Gilles Degottex <gad27@cam.ac.uk>
+'''
+
+from __future__ import print_function
+
+from percivaltts import *  # Always include this first to setup a few things
+
+import numpy as np
+numpy_force_random_seed()
+
+import checkpoint
+
+FORMAT = 'percivaltts-inference'
+
+
+# Nonlinearities ---------------------------------------------------------------
+
+def _sigmoid(x):
+    return 0.5*(1.0+np.tanh(0.5*x))   # Numerically stable, without overflow warnings
+
+NONLINEARITIES = {
+    'linear':           lambda x: x,
+    'rectify':          lambda x: np.maximum(x, 0.0),
+    'leaky_rectify':    lambda x, leakiness: np.where(x>0.0, x, leakiness*x),
+    'sigmoid':          _sigmoid,
+    'tanh':             np.tanh,
+    'scaled_tanh':      lambda x, scale_in, scale_out: scale_out*np.tanh(scale_in*x),
+    'softplus':         lambda x: np.logaddexp(0.0, x).astype(x.dtype),
+    'elu':              lambda x: np.where(x>0.0, x, np.expm1(np.minimum(x, 0.0))),
+    'tanh_saturated':   lambda x, coef: coef*np.tanh(x),            # backend_theano.nonlin_tanh_saturated
+    'saturatedsigmoid': lambda x, coef: coef*_sigmoid(x),           # backend_theano.nonlin_saturatedsigmoid
+    'tanh_bysigmoid':   lambda x: (_sigmoid(x)-0.5)*2.0,            # backend_theano.nonlin_tanh_bysigmoid
+    'tanhcm11':         lambda x: np.tanh((2.0/3.0)*x),             # backend_theano.nonlin_tanhcm11
+    'softsign':         lambda x: x/(1.0+abs(x)),                   # backend_theano.nonlin_softsign
+    }
+
+def nonlinearity(x, spec):
+    """Apply the nonlinearity described by spec, a dict with its 'name' and its arguments, if any."""
+    args = dict([(k, v) for k, v in spec.items() if k!='name'])
+    return NONLINEARITIES[spec['name']](x, **args)
+
+
+# Operations -------------------------------------------------------------------
+# Each operation takes the layer, the list of its input arrays, the dict of its
+# parameters and the Network (for its random generator), and returns its output.
+
+def _op_dense(layer, xs, params, net):
+    x = xs[0]
+    nla = layer['num_leading_axes']
+    y = np.dot(x.reshape(x.shape[:nla]+(-1,)), params['W'])
+    if 'b' in params: y += params['b']
+    return nonlinearity(y, layer['nonlinearity'])
+
+def conv2d(x, W, pad, stride=(1,1), flip_filters=True, dilation=(1,1)):
+    """
+    2D convolution of x [batch x channels x rows x columns] by W [filters x channels x rows x columns].
+
+    pad : [(before, after), (before, after)] number of zeros padded on each side of the rows and the columns
+    dilation : spacing between the rows and between the columns of the filters
+    """
+    if flip_filters: W = W[:,:,::-1,::-1]
+    nbrows, nbcols = W.shape[2], W.shape[3]
+    dr, dc = dilation
+    xp = np.pad(x, [(0,0), (0,0)]+[tuple(p) for p in pad], 'constant')
+    outrows = xp.shape[2]-dr*(nbrows-1)
+    outcols = xp.shape[3]-dc*(nbcols-1)
+    y = np.zeros((W.shape[0], x.shape[0], outrows, outcols), dtype=x.dtype)   # [filters x batch x ...] for tensordot
+    for i in xrange(nbrows):
+        for j in xrange(nbcols):
+            y += np.tensordot(W[:,:,i,j], xp[:,:,i*dr:i*dr+outrows,j*dc:j*dc+outcols], axes=([1],[1]))
+    y = y.transpose((1,0,2,3))
+    if tuple(stride)!=(1,1): y=y[:,:,::stride[0],::stride[1]]
+    return y
+
+def _op_conv2d(layer, xs, params, net):
+    y = conv2d(xs[0], params['W'], layer['pad'], layer['stride'], layer['flip_filters'], layer.get('dilation', (1,1)))
+    if 'b' in params: y += params['b'][None,:,None,None]
+    return nonlinearity(y, layer['nonlinearity'])
+
+def _op_batchnorm(layer, xs, params, net):
+    x = xs[0]
+    shape = [1 if a in layer['axes'] else x.shape[a] for a in xrange(x.ndim)]
+    coef = (params['gamma']*params['inv_std']).reshape(shape)
+    return (x-params['mean'].reshape(shape))*coef + params['beta'].reshape(shape)
+
+def _op_nonlinearity(layer, xs, params, net):
+    return nonlinearity(xs[0], layer['nonlinearity'])
+
+def _op_identity(layer, xs, params, net):
+    return xs[0]    # e.g. dropout at prediction time
+
+def _op_elemwise(layer, xs, params, net):
+    fn = {'mul':np.multiply, 'add':np.add, 'sub':np.subtract, 'max':np.maximum, 'min':np.minimum}[layer['op']]
+    y = xs[0]
+    for x in xs[1:]: y=fn(y, x)
+    return y
+
+def _op_sum(layer, xs, params, net):
+    return sum([coeff*x for coeff, x in zip(layer['coeffs'], xs)])
+
+def _op_concat(layer, xs, params, net):
+    return np.concatenate(xs, axis=layer['axis'])
+
+def _op_dimshuffle(layer, xs, params, net):
+    x = xs[0]
+    pattern = layer['pattern']
+    kept = [p for p in pattern if p!='x']
+    dropped = [d for d in xrange(x.ndim) if not d in kept]  # Broadcastable dimensions, of size 1
+    return np.transpose(x, kept+dropped).reshape([1 if p=='x' else x.shape[p] for p in pattern])
+
+def _op_flatten(layer, xs, params, net):
+    x = xs[0]
+    return x.reshape(x.shape[:layer['outdim']-1]+(-1,))
+
+def _op_slice(layer, xs, params, net):
+    x = xs[0]
+    indices = layer['indices']
+    if isinstance(indices, list): indices=slice(*indices)
+    return x[(slice(None),)*(layer['axis']%x.ndim)+(indices,)]
+
+def _op_gating(layer, xs, params, net):
+    x = xs[0]
+    N = x.shape[layer['axis']]//2
+    pre = (slice(None),)*layer['axis']
+    return nonlinearity(x[pre+(slice(None, N),)], layer['nonlinearity'])*_sigmoid(x[pre+(slice(N, None),)])
+
+def _op_uniform_noise(layer, xs, params, net):
+    x = xs[0]
+    return net.rng.uniform(layer['low'], layer['high'], size=(x.shape[0], x.shape[1], layer['size'])).astype(x.dtype)
+
+def _op_lstm(layer, xs, params, net):
+    x = xs[0]
+    gates = ['ingate', 'forgetgate', 'cell', 'outgate']
+    W_in = np.concatenate([params['W_in_to_'+g] for g in gates], axis=1)
+    W_hid = np.concatenate([params['W_hid_to_'+g] for g in gates], axis=1)
+    b = np.concatenate([params['b_'+g] for g in gates])
+    nls = dict([(g, lambda x, spec=layer['nonlinearity_'+g]: nonlinearity(x, spec)) for g in gates])
+    N = W_hid.shape[0]
+
+    xin = np.dot(x, W_in) + b
+    cell = np.tile(params['cell_init'], (x.shape[0], 1))
+    hid = np.tile(params['hid_init'], (x.shape[0], 1))
+    y = np.empty((x.shape[0], x.shape[1], N), dtype=x.dtype)
+    for t in (xrange(x.shape[1]-1, -1, -1) if layer['backwards'] else xrange(x.shape[1])):
+        g = xin[:,t,:] + np.dot(hid, W_hid)
+        ingate, forgetgate, cellin, outgate = g[:,:N], g[:,N:2*N], g[:,2*N:3*N], g[:,3*N:]
+        if layer['peepholes']:
+            ingate = ingate + cell*params['W_cell_to_ingate']
+            forgetgate = forgetgate + cell*params['W_cell_to_forgetgate']
+        cell = nls['forgetgate'](forgetgate)*cell + nls['ingate'](ingate)*nls['cell'](cellin)
+        if layer['peepholes']:
+            outgate = outgate + cell*params['W_cell_to_outgate']
+        hid = nls['outgate'](outgate)*nonlinearity(cell, layer['nonlinearity'])
+        y[:,t,:] = hid
+    return y
+
+def _op_gru(layer, xs, params, net):
+    x = xs[0]
+    gates = ['resetgate', 'updategate', 'hidden_update']
+    W_in = np.concatenate([params['W_in_to_'+g] for g in gates], axis=1)
+    W_hid = np.concatenate([params['W_hid_to_'+g] for g in gates], axis=1)
+    b = np.concatenate([params['b_'+g] for g in gates])
+    nlr = lambda x: nonlinearity(x, layer['nonlinearity_resetgate'])
+    nlu = lambda x: nonlinearity(x, layer['nonlinearity_updategate'])
+    N = W_hid.shape[0]
+
+    xin = np.dot(x, W_in) + b
+    hid = np.tile(params['hid_init'], (x.shape[0], 1))
+    y = np.empty((x.shape[0], x.shape[1], N), dtype=x.dtype)
+    for t in (xrange(x.shape[1]-1, -1, -1) if layer['backwards'] else xrange(x.shape[1])):
+        hin = np.dot(hid, W_hid)
+        resetgate = nlr(xin[:,t,:N] + hin[:,:N])
+        updategate = nlu(xin[:,t,N:2*N] + hin[:,N:2*N])
+        hidden_update = nonlinearity(xin[:,t,2*N:] + resetgate*hin[:,2*N:], layer['nonlinearity_hid'])
+        hid = (1.0-updategate)*hid + updategate*hidden_update
+        y[:,t,:] = hid
+    return y
+
+def _op_recurrent_pooling(layer, xs, params, net):
+    x = xs[0]
+    N = layer['num_units']
+    if layer['cell']=='QRNN': candidate = np.tanh(x[:,:,:N])
+    else:                     candidate = x[:,:,:N]
+    forgetgate = _sigmoid(x[:,:,N:2*N])
+    candidate = (1.0-forgetgate)*candidate
+
+    cell = np.zeros((x.shape[0], N), dtype=x.dtype)
+    y = np.empty((x.shape[0], x.shape[1], N), dtype=x.dtype)
+    for t in (xrange(x.shape[1]-1, -1, -1) if layer['backwards'] else xrange(x.shape[1])):
+        cell = forgetgate[:,t,:]*cell + candidate[:,t,:]
+        y[:,t,:] = cell
+
+    gate = _sigmoid(x[:,:,2*N:3*N])
+    if layer['cell']=='QRNN': return gate*y
+    else:                     return gate*np.tanh(y) + (1.0-gate)*x[:,:,3*N:]
+
+_OPS = {
+    'dense':        _op_dense,
+    'conv2d':       _op_conv2d,
+    'batchnorm':    _op_batchnorm,
+    'nonlinearity': _op_nonlinearity,
+    'identity':     _op_identity,
+    'elemwise':     _op_elemwise,
+    'sum':          _op_sum,
+    'concat':       _op_concat,
+    'dimshuffle':   _op_dimshuffle,
+    'flatten':      _op_flatten,
+    'slice':        _op_slice,
+    'gating':       _op_gating,
+    'uniform_noise':_op_uniform_noise,
+    'lstm':         _op_lstm,
+    'gru':          _op_gru,
+    'recurrent_pooling':_op_recurrent_pooling,
+    }
+
+
+# Optimisations of the exported networks --------------------------------------
+
+def _channelaxes(layer):
+    """The axes over which the outputs of a dense or conv2d layer share their parameters"""
+    if layer['type']=='dense': return range(layer['num_leading_axes'])
+    else:                      return [0, 2, 3]
+
+def fold_batchnorm(layers, tensors):
+    """
+    Fold the batch normalisations into the dense and conv2d layers preceding them.
+
+    A batch normalisation at prediction time is an affine transform of each
+    channel, which can be merged in the weights and biases of a linear
+    dense or conv2d layer whose output is used by this normalisation only
+    (e.g. the layers wrapped by lasagne.layers.batch_norm(.)). The nonlinearity
+    following it is then moved into this layer, and the identity layers
+    (e.g. dropout) are removed.
+    The batch normalisations which follow other layers (e.g. the products of
+    the gated convolutions) are kept.
+
+    Parameters
+    ----------
+    layers :    The list of layers, as exported by Model.export_inference(.)
+    tensors :   list of (name, numpy array) of the parameters
+
+    Returns
+    -------
+    The new list of layers and list of tensors, predicting the same outputs.
+    """
+    layers = [dict(layer, tensors=dict(layer.get('tensors', dict()))) for layer in layers]
+    tensors = dict(tensors)
+    nbuses = [0]*len(layers)
+    for layer in layers:
+        for i in layer['inputs']: nbuses[i]+=1
+
+    alias = dict()   # Index of the removed layers -> Index of the layer replacing them
+    for li, layer in enumerate(layers):
+        layer['inputs'] = [alias.get(i, i) for i in layer['inputs']]
+        if layer['type']=='identity':
+            alias[li] = layer['inputs'][0]
+            nbuses[alias[li]] += nbuses[li]-1
+            continue
+        if not layer['type'] in ('batchnorm', 'nonlinearity'): continue
+        pi = layer['inputs'][0]
+        prev = layers[pi]
+        if not prev['type'] in ('dense', 'conv2d') or prev['nonlinearity']['name']!='linear' or nbuses[pi]>1: continue
+
+        if layer['type']=='batchnorm':
+            if sorted(layer['axes'])!=_channelaxes(prev): continue
+            mean, inv_std, beta, gamma = [tensors[layer['tensors'][key]] for key in ['mean', 'inv_std', 'beta', 'gamma']]
+            coef = gamma*inv_std
+            W = tensors[prev['tensors']['W']]
+            if prev['type']=='dense':   W = W*coef[None,:]
+            else:                       W = W*coef[:,None,None,None]
+            b = tensors[prev['tensors']['b']] if 'b' in prev['tensors'] else np.zeros(coef.shape, dtype=W.dtype)
+            prev['tensors']['W'] = '{}.W.foldedbn'.format(pi)
+            prev['tensors']['b'] = '{}.b.foldedbn'.format(pi)
+            tensors[prev['tensors']['W']] = W
+            tensors[prev['tensors']['b']] = ((b-mean)*coef + beta).astype(W.dtype)
+        else:
+            prev['nonlinearity'] = layer['nonlinearity']
+        alias[li] = pi
+        nbuses[pi] = nbuses[li]
+
+    # Remove the folded layers
+    kept = [li for li in xrange(len(layers)) if not li in alias]
+    if kept[-1]!=alias.get(len(layers)-1, len(layers)-1): raise ValueError('The output layer cannot be removed')  # pragma: no cover
+    newindices = dict([(li, ni) for ni, li in enumerate(kept)])
+    newlayers = []
+    for li in kept:
+        layer = layers[li]
+        layer['inputs'] = [newindices[i] for i in layer['inputs']]
+        newlayers.append(layer)
+    used = set([tname for layer in newlayers for tname in layer['tensors'].values()])
+    return newlayers, [(name, value) for name, value in tensors.items() if name in used]
+
+
+class Network:
+    """
+    A network exported by Model.export_inference(.), run with NumPy only.
+
+    Parameters
+    ----------
+    fname : The file written by Model.export_inference(.)
+    seed :  The seed of the random generator of the noise inputs (e.g. of ModelCNN).
+    """
+
+    def __init__(self, fname, seed=None):
+        tensors, meta = checkpoint.load(fname)
+        if not isinstance(meta, dict) or meta.get('format')!=FORMAT: raise ValueError('{} is not an exported network'.format(fname))
+        tensors = dict(tensors)
+
+        self.meta = meta
+        self.insize = meta['insize']
+        self.layers = meta['layers']
+        for layer in self.layers:
+            if layer['type']!='input' and not layer['type'] in _OPS: raise ValueError('Unknown operation "{}" of layer {}'.format(layer['type'], layer['name']))
+        self.params = [dict([(key, tensors[tname]) for key, tname in layer.get('tensors', dict()).items()]) for layer in self.layers]
+
+        # Index of the last layer using each layer, in order to free the arrays as soon as possible
+        self._lastuse = dict()
+        for li, layer in enumerate(self.layers):
+            for i in layer['inputs']: self._lastuse[i] = li
+
+        self.rng = np.random.RandomState(seed)
+
+    def predict(self, X):
+        """Predict the outputs of the input X [batch x frames x insize], as Model.predict(.)"""
+        X = np.asarray(X, dtype='float32')
+        outputs = dict()
+        for li, layer in enumerate(self.layers):
+            if layer['type']=='input':
+                outputs[li] = X
+            else:
+                outputs[li] = _OPS[layer['type']](layer, [outputs[i] for i in layer['inputs']], self.params[li], self)
+            for i in layer['inputs']:
+                if self._lastuse[i]==li: del outputs[i]
+        return outputs[len(self.layers)-1]
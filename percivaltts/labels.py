@@ -0,0 +1,164 @@
+'''
+Parsing of HTS label files (e.g. label_state_align or label_phone_align).
+
+A label file is parsed once into a structured numpy array with one record per
+line (start, end, state index, label id) plus a table of the label strings
+(without the state suffix). The results are cached per file so that the
+various stages of the pipeline (weights, durations, linguistic features, etc.)
+re-use the same parse.
+
+This file is meant to be library-independent (independent of theano, lasagne, tensorflow, etc.)
+
+Copyright(C) 2017 Engineering Department, University of Cambridge, UK.
+
+License
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Author
+    Gilles Degottex <gad27@cam.ac.uk>
+'''
+
+from __future__ import print_function
+
+from percivaltts import *  # Always include this first to setup a few things
+
+import os
+import re
+import hashlib
+import collections
+import threading
+
+import numpy as np
+numpy_force_random_seed()
+
+# One record per line of the label file.
+# start and end are in HTS units (100ns) and are -1 if the line has no time
+# alignment. state is the HMM state index found in the '[k]' suffix of the
+# label (0 if there is no such suffix). label is the index of the label string
+# in the string table returned along with the records.
+LAB_DTYPE = np.dtype([('start', np.int64), ('end', np.int64), ('state', np.int16), ('label', np.int32)])
+
+_re_line = re.compile(r'^[ \t]*(?:([0-9]+)[ \t]+([0-9]+)[ \t]+)?(\S(?:[^\r\n]*\S)?)', re.M)   # The label is the rest of the line (it can contain spaces)
+_re_state = re.compile(r'^(.*)\[([0-9]+)\]$')
+
+_cache = collections.OrderedDict() # realpath -> (mtime, size, segs, labstrs), from the least to the most recently used
+cache_maxsize = 10000   # Maximum number of parses kept in memory (e.g. for long-running processes)
+_cache_lock = threading.Lock()  # The cache is shared by the threads (e.g. those of server.py)
+
+
+def parse(flab):
+    """
+    Parse a HTS label file without any caching.
+
+    Returns
+    -------
+    segs : structured numpy array of dtype LAB_DTYPE
+    labstrs : list of the label strings (in order of first appearance)
+    """
+    with open(flab) as f:
+        content = f.read()
+
+    lines = _re_line.findall(content)
+
+    segs = np.empty(len(lines), dtype=LAB_DTYPE)
+    labstrs = []
+    labids = dict()
+    for li, (start, end, label) in enumerate(lines):
+        state = 0
+        match = _re_state.match(label)
+        if match:
+            label = match.group(1)
+            state = int(match.group(2))
+        labid = labids.get(label)
+        if labid is None:
+            labid = len(labstrs)
+            labids[label] = labid
+            labstrs.append(label)
+        if start=='':   segs[li] = (-1, -1, state, labid)
+        else:           segs[li] = (int(start), int(end), state, labid)
+
+    return segs, labstrs
+
+def save(fcache, segs, labstrs):
+    """Save a parsed label file into a binary cache file (numpy's npz format)."""
+    makedirs(os.path.dirname(fcache))
+    with open(fcache, 'wb') as f:
+        np.savez(f, segs=segs, labstrs=np.array(labstrs, dtype=np.str_))
+
+def load(flab, cachedir=None):
+    """
+    Return the parsed content of a HTS label file, re-using previous parses.
+
+    The parse is kept in memory as long as the label file is not modified,
+    for the cache_maxsize most recently used files.
+    If cachedir is given, the parse is also saved in this directory in a binary
+    format and is re-loaded from there (e.g. by another process) as long as it
+    is newer than the label file. The cache files are named after the file name
+    and a hash of the full path of the label file, so that the label files of
+    the same name in different directories do not collide.
+
+    The returned values are shared among callers and should not be modified.
+    """
+    flab = os.path.realpath(flab)
+    st = os.stat(flab)
+
+    with _cache_lock:
+        cached = _cache.pop(flab, None)
+        if (not cached is None) and cached[0]==st.st_mtime and cached[1]==st.st_size:
+            _cache[flab] = cached   # Most recently used
+            return cached[2], cached[3]
+
+    segs = None
+    if not cachedir is None:
+        fcache = os.path.join(cachedir, os.path.basename(flab)+'.'+hashlib.sha1(flab).hexdigest()[:16]+'.npz')
+        if os.path.isfile(fcache) and os.path.getmtime(fcache)>=st.st_mtime:
+            npz = np.load(fcache)
+            segs = npz['segs']
+            labstrs = [str(l) for l in npz['labstrs']]
+
+    if segs is None:
+        segs, labstrs = parse(flab)
+        if not cachedir is None: save(fcache, segs, labstrs)
+
+    with _cache_lock:
+        _cache[flab] = (st.st_mtime, st.st_size, segs, labstrs)
+        while len(_cache)>cache_maxsize:
+            _cache.popitem(last=False)
+
+    return segs, labstrs
+
+def forget(flab):
+    """Drop the in-memory parse of a label file (e.g. a temporary file about to be deleted, whose name could be re-used)."""
+    with _cache_lock:
+        _cache.pop(os.path.realpath(flab), None)
+
+def clear_cache():
+    """Drop the in-memory cache of the parsed label files."""
+    with _cache_lock:
+        _cache.clear()
+
+
+def nbframes(segs, shift=0.005):
+    """Number of frames covered by the time alignment of the parsed labels."""
+    return int(np.ceil(segs['end'][-1]*1e-7/shift))
+
+def frames_segments(segs, shift=0.005):
+    """Return the first and last+1 frame index covered by each record."""
+    starts = np.floor(segs['start']*1e-7/shift).astype(np.int64)
+    ends = np.ceil(segs['end']*1e-7/shift).astype(np.int64)
+    return starts, ends
+
+def phones(labstrs, lineheadregexp=r'([^\^]+)\^([^-]+)-([^\+]+)\+([^=]+)=([^@]+)@(.+)'):
+    """Return the central phone of each label string of the string table."""
+    phs = []
+    for labstr in labstrs:
+        phs.append(re.findall(lineheadregexp, labstr)[0][2])
+    return phs
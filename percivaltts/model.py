@@ -38,6 +38,131 @@ import lasagne
 # lasagne.random.set_rng(np.random)
 
 import data
+import checkpoint
+
+def _generate_wav_denormalise_chunks(CMP, vocoder, opts, wins):
+    """
+    De-normalises CMP and applies the MLPG (if any windows are given).
+    Returns an iterable of the consecutive chunks of the resulting features:
+    the generator of MLParameterGenerationFast.generation_chunks(.) if
+    opts['mlpg_chunksize']>0, so that each chunk is solved only when it is
+    consumed, otherwise a single chunk covering the whole utterance.
+    """
+    Ymean, Ystd = opts['Ymean'], opts['Ystd']
+
+    CMP = CMP*np.tile(Ystd, (CMP.shape[0], 1)) + np.tile(Ymean, (CMP.shape[0], 1)) # De-normalise
+
+    if len(wins)>0:
+        # Apply MLPG
+        from external.merlin.mlpg_fast import MLParameterGenerationFast as MLParameterGeneration
+        mlpg_algo = MLParameterGeneration(delta_win=wins[0], acc_win=wins[1])
+        var = np.tile(Ystd**2,(CMP.shape[0],1)) # Simplification!
+        if opts['mlpg_chunksize']>0:
+            return mlpg_algo.generation_chunks(CMP, var, len(Ymean)/3, chunk_size=opts['mlpg_chunksize'], lookahead=opts['mlpg_lookahead'], crossfade=min(opts['mlpg_lookahead'], 10))
+        else:
+            return [mlpg_algo.generation(CMP, var, len(Ymean)/3)]
+    else:
+        return [CMP[:,:vocoder.featuressize()]]
+
+def _generate_wav_denormalise(CMP, vocoder, opts, wins):
+    """De-normalises CMP and applies the MLPG (if any windows are given), for the whole utterance at once."""
+    return np.concatenate(list(_generate_wav_denormalise_chunks(CMP, vocoder, opts, wins)))
+
+def _wavwrite_stream(fwav, wavs, fs, verbose=1):
+    """
+    Writes the waveform chunks given by the iterable wavs as they come, in the
+    16 bits wav file fwav, normalised as sp.wavwrite(., norm_abs=True, force_norm_abs=True).
+    Since the normalisation depends on the whole waveform, the chunks are first
+    written in a temporary raw file next to fwav, which is then converted by
+    blocks. Thus, the waveform is never entirely in memory.
+    """
+    import wave
+    fraw = fwav+'.raw'
+    peak = 0.0
+    with open(fraw, 'wb') as f:
+        for wav in wavs:
+            if len(wav)>0: peak=max(peak, np.max(np.abs(wav)))
+            wav.astype('float32').tofile(f)
+    gain = 0.99/peak if peak>0.0 else 1.0
+
+    fout = wave.open(fwav, 'wb')
+    try:
+        fout.setnchannels(1)
+        fout.setsampwidth(2)
+        fout.setframerate(fs)
+        with open(fraw, 'rb') as f:
+            while True:
+                wav = np.fromfile(f, dtype='float32', count=65536)
+                if len(wav)==0: break
+                fout.writeframes(np.round(gain*32767*wav).astype('<i2').tobytes())
+    finally:
+        fout.close()
+        os.remove(fraw)
+    if verbose>0: print('Output: '+fwav)
+
+def _generate_wav_synthesis(fid, CMP, REF, vocoder, opts):
+    """
+    Everything that follows the prediction of one file in Model.generate_wav(.):
+    re-synthesis, de-normalisation, MLPG, synthesis and writing of the waveform.
+    If the MLPG is solved by chunks (opts['mlpg_chunksize']>0), each chunk is
+    synthesised (see Vocoder.synthesis_stream(.)) and written as soon as it is
+    solved, instead of waiting for the whole utterance.
+    Returns the de-normalised features (None if REF is None and the MLPG is
+    solved by chunks, since they are then needed only for the synthesis).
+    """
+    from external.pulsemodel import sigproc as sp
+
+    numpy_force_random_seed()   # Same random sequence for each file, whatever the process running it and the number of processes
+
+    if opts['do_resynth']:
+        CMPREF = _generate_wav_denormalise(REF, vocoder, opts, wins=[])
+        resyn = vocoder.synthesis(vocoder.fs, CMPREF, pp_mcep=False)
+        sp.wavwrite(opts['syndir']+'-resynth/'+fid+'.wav', resyn, vocoder.fs, norm_abs=True, force_norm_abs=True, verbose=1)
+
+    if len(opts['wins'])>0 and opts['mlpg_chunksize']>0:
+        CMPs = []
+        def chunks():
+            for CMPchunk in _generate_wav_denormalise_chunks(CMP, vocoder, opts, wins=opts['wins']):
+                if not REF is None: CMPs.append(CMPchunk)  # Keep them only for the objective measures
+                yield CMPchunk
+        _wavwrite_stream(opts['syndir']+'/'+fid+'.wav', vocoder.synthesis_stream(vocoder.fs, chunks(), pp_mcep=opts['pp_mcep']), vocoder.fs)
+        return np.concatenate(CMPs) if len(CMPs)>0 else None
+
+    CMP = _generate_wav_denormalise(CMP, vocoder, opts, wins=opts['wins'])
+    syn = vocoder.synthesis(vocoder.fs, CMP, pp_mcep=opts['pp_mcep'])
+    sp.wavwrite(opts['syndir']+'/'+fid+'.wav', syn, vocoder.fs, norm_abs=True, force_norm_abs=True, verbose=1)
+
+    return CMP
+
+def _generate_wav_worker(args):
+    """
+    Runs _generate_wav_synthesis(.) in a process of the pool of Model.generate_wav(.).
+    Returns the objective measures of the file.
+    """
+    fid, (fcmp, cmpshape), REF, vocoder, opts = args
+
+    def fromshm(fname, shape):
+        M = np.array(np.memmap(fname, dtype='float32', mode='r', shape=shape))
+        os.remove(fname)
+        return M
+    CMP = fromshm(fcmp, cmpshape)
+    if not REF is None: REF = fromshm(*REF)
+
+    CMP = _generate_wav_synthesis(fid, CMP, REF, vocoder, opts)
+
+    vocoder.objmeasures_clear()
+    if not REF is None: vocoder.objmeasures_add(CMP, REF)
+
+    return vocoder.features_err
+
+
+def load_configuration(fmodel):
+    """Returns the configuration saved with the parameters in fmodel (see Model.saveAllParams(.)), without building the model."""
+    if checkpoint.ischeckpoint(fmodel):
+        return checkpoint.load(fmodel)[1]['cfg']
+    else:
+        return cPickle.load(open(fmodel, 'rb'))[1]
+
 
 class Model:
 
@@ -48,6 +173,7 @@ class Model:
 
     insize = -1
     _input_values = None # Input contextual values (e.g. text, labels)
+    _layer_mask = None  # Mask of the frames of the input for the recurrent layers (see layer_mask(.))
     inputs = None   # All the inputs of prediction function
 
     params_all = None # All possible parameters, including non trainable, running averages of batch normalisation, etc.
@@ -61,6 +187,8 @@ class Model:
     outputs = None  # Outputs of prediction function
 
     predict = None  # Prection function
+    _predict_masked = None  # Prediction function with a mask of the frames (see predict_padded(.))
+    _predict_fixednoise = None  # Prediction function with given outputs of the noise layers (see predict_fixednoise(.))
 
     def __init__(self, insize, _vocoder, hiddensize=256):
         # Force additional random inputs is using anyform of GAN
@@ -73,6 +201,16 @@ class Model:
 
         self._input_values = T.ftensor3('input_values')
 
+    def layer_mask(self):
+        """
+        Input layer of the mask [size x length] of the frames of the input, to
+        give to the recurrent layers (mask_input), so that they skip the frames
+        padded by predict_padded(.). It is made of ones, unless substituted.
+        """
+        if self._layer_mask is None:
+            self._layer_mask = lasagne.layers.InputLayer(shape=(None, None), input_var=T.ones_like(self._input_values[:,:,0]), name='input.mask')
+        return self._layer_mask
+
 
     def init_finish(self, net_out):
 
@@ -89,7 +227,7 @@ class Model:
 
         predicted_values = lasagne.layers.get_output(self.net_out, deterministic=True)
         self.outputs = predicted_values
-        self.predict = theano.function(self.inputs, self.outputs, updates=self.updates)
+        self.predict = th_function(self.inputs, self.outputs, updates=self.updates, name='predict')
 
         print('')
 
@@ -97,36 +235,252 @@ class Model:
     def nbParams(self):
         return params_count(self.params_all)
 
-    def saveAllParams(self, fmodel, cfg=None, extras=None, printfn=print, infostr=''):
+    def receptive_field(self):
+        """
+        Number of input frames, on each side of a frame, which can influence
+        the prediction of this frame. None if it is unbounded (e.g. recurrent layers).
+        """
+        return None
+
+    def saveAllParams(self, fmodel, cfg=None, extras=None, printfn=print, infostr='', quantise=False):
+        """
+        Save all the parameters in fmodel (see checkpoint.py).
+        If quantise is True, the weights of the Dense and Conv2D layers are saved in int8 (see checkpoint.quantise(.)).
+        """
         if extras is None: extras=dict()
         # https://github.com/Lasagne/Lasagne/issues/159
         printfn('    saving parameters in {} ...'.format(fmodel), end='')
         sys.stdout.flush()
         paramsvalues = [(str(p), p.get_value()) for p in self.params_all]
-        DATA = [paramsvalues, cfg, extras]
-        cPickle.dump(DATA, open(fmodel, 'wb'))
+        meta = {'cfg':cfg, 'extras':extras}
+        if quantise:
+            axes = dict([(str(p), axis) for p, axis in params_quantisable(self.net_out)])
+            if len(axes)<len(params_quantisable(self.net_out)): raise ValueError('The names of the weights to quantise are not unique')
+            paramsvalues, meta['quantised'] = checkpoint.quantise(paramsvalues, axes)
+        checkpoint.save(fmodel, paramsvalues, meta)
         print(' done '+infostr)
         sys.stdout.flush()
 
-    def loadAllParams(self, fmodel, printfn=print):
+    def loadAllParams(self, fmodel, printfn=print, regexp=None):
+        """
+        Load the parameters saved by saveAllParams(.) (or pickled by its previous versions).
+        If regexp is given, only the parameters whose name match it are loaded,
+        otherwise all the parameters of the model have to be found in fmodel.
+        Returns [cfg, extras] as given to saveAllParams(.).
+        """
         # https://github.com/Lasagne/Lasagne/issues/159
         printfn('    reloading parameters from {} ...'.format(fmodel), end='')
         sys.stdout.flush()
-        DATA = cPickle.load(open(fmodel, 'rb'))
-        for p, v in zip(self.params_all, DATA[0]): p.set_value(v[1])
+        if checkpoint.ischeckpoint(fmodel):
+            paramsvalues, meta = checkpoint.load(fmodel)
+            if 'quantised' in meta: paramsvalues=checkpoint.dequantise(paramsvalues, meta['quantised'])
+            DATA = [paramsvalues, meta['cfg'], meta['extras']]
+        else:
+            DATA = cPickle.load(open(fmodel, 'rb'))
+        matches = checkpoint.match([str(p) for p in self.params_all], self.params_compat(DATA[0]), regexp=regexp)
+        if regexp is None and len(matches)!=len(self.params_all):
+            found = [pi for pi, _ in matches]
+            raise ValueError('Parameters of the model not found in {}: {}'.format(fmodel, ', '.join([str(p) for pi, p in enumerate(self.params_all) if not pi in found])))
+        for pi, v in matches:
+            if v.shape!=self.params_all[pi].get_value(borrow=True).shape: raise ValueError('Parameter {} has shape {} whereas the loaded one has shape {}'.format(self.params_all[pi], self.params_all[pi].get_value(borrow=True).shape, v.shape))
+            self.params_all[pi].set_value(np.array(v), borrow=True)   # Copy out of the memory map
         print(' done')
         sys.stdout.flush()
         return DATA[1:]
 
+    def params_compat(self, tensors):
+        """
+        Map the parameters saved by previous versions of the model to its
+        current parameters, before loading them (see loadAllParams(.)).
+        tensors is the list of saved (name, numpy array), the mapped list is returned.
+        """
+        return tensors
+
+    def export_inference(self, fname, foldbn=True, printfn=print):
+        """
+        Export the prediction network in fname, which can then be run by
+        inference.Network(fname) with NumPy only (without Theano, nor Lasagne).
+
+        foldbn : Fold the batch normalisations into the preceding layers (see inference.fold_batchnorm(.))
+        """
+        import inference
+        printfn('    exporting the prediction network in {} ...'.format(fname), end='')
+        sys.stdout.flush()
+        layers, tensors = inference_layers(self.net_out)
+        if foldbn: layers, tensors = inference.fold_batchnorm(layers, tensors)
+        checkpoint.save(fname, tensors, {'format':'percivaltts-inference', 'model':self.__class__.__name__, 'insize':self.insize, 'layers':layers})
+        print(' done')
+        sys.stdout.flush()
 
-    def generate_cmp(self, inpath, outpath, fid_lst):
+    def quantise(self, fmodel, fquantised, indir, outdir, fid_lst_val):
+        """
+        Quantise the parameters saved in fmodel into fquantised (see saveAllParams(.)).
+
+        The RMSE of the quantised model is reported w.r.t. the predictions of
+        the float model and w.r.t. the ground truth, on the fid_lst_val files,
+        and saved in fquantised+'.json'. The model is left with the
+        dequantised parameters. Both models are given the same noise inputs
+        (see predict_fixednoise(.)), so that the differences come only from
+        the quantisation.
+
+        Returns the report as a dict.
+        """
+        import json
+        cfg, extras = self.loadAllParams(fmodel)
+        X_vals = data.load(indir, fid_lst_val, verbose=1, label='Context labels: ')
+        Y_vals = data.load(outdir, fid_lst_val, verbose=1, label='Output features: ')
+        X_vals, Y_vals = data.croplen([X_vals, Y_vals])
+
+        def rmse(Y_preds, Y_refs):
+            return float(np.sqrt(np.sum([np.sum((Y_ref-Y_pred)**2) for Y_pred, Y_ref in zip(Y_preds, Y_refs)])/np.sum([Y_pred.size for Y_pred in Y_preds])))
+
+        Y_floats = [self.predict_fixednoise(X[None,:,:], seed=xi)[0,] for xi, X in enumerate(X_vals)]
+        report = {'rmse_float':rmse(Y_floats, Y_vals)}
+
+        self.saveAllParams(fquantised, cfg=cfg, extras=extras, quantise=True)
+        self.loadAllParams(fquantised)
+        Y_quantiseds = [self.predict_fixednoise(X[None,:,:], seed=xi)[0,] for xi, X in enumerate(X_vals)]
+        report['rmse_quantised'] = rmse(Y_quantiseds, Y_vals)
+        report['rmse_quantised_vs_float'] = rmse(Y_quantiseds, Y_floats)
+        report['size_float'] = os.path.getsize(fmodel)
+        report['size_quantised'] = os.path.getsize(fquantised)
+
+        print('    quantisation: RMSE w.r.t. float model {:.6f}, validation RMSE {:.6f} (float {:.6f}), size {:.1f}MB (float {:.1f}MB)'.format(report['rmse_quantised_vs_float'], report['rmse_quantised'], report['rmse_float'], report['size_quantised']/1e6, report['size_float']/1e6))
+        with open(fquantised+'.json', 'w') as f: json.dump(report, f, indent=4, sort_keys=True)
+
+        return report
+
+
+    def predict_padded(self, Xs):
+        """
+        Predict the outputs of multiple inputs of different lengths in a single
+        call of the prediction function.
+
+        The inputs are padded up to the longest one (by repeating their last
+        frame, usually silence) and the outputs are cut back to the length of
+        each input. The mask of the padded frames is given to the recurrent
+        layers (see layer_mask(.)), so that their states skip these frames, as
+        if each input was predicted alone. The convolutions through time do see
+        the padded frames, instead of their zero padding, so that the last
+        self.receptive_field() frames of each prediction can slightly differ
+        from a prediction of the input alone (and the whole prediction if a
+        recurrent layer follows such a convolution, e.g. in ModelCNN).
+
+        Parameters
+        ----------
+        Xs : list of input matrices [frames x self.insize]
+
+        Returns
+        -------
+        The list of the output matrices, in the order of Xs.
+        """
+        lengths = [X.shape[0] for X in Xs]
+        XB = np.empty((len(Xs), max(lengths), Xs[0].shape[1]), dtype='float32')
+        MB = np.zeros((len(Xs), max(lengths)), dtype='float32')
+        for b, X in enumerate(Xs):
+            XB[b,:lengths[b],:] = X
+            XB[b,lengths[b]:,:] = X[-1,:]
+            MB[b,:lengths[b]] = 1.0
+        if self._layer_mask is None:
+            YB = self.predict(XB)
+        else:
+            if self._predict_masked is None:
+                mask = T.fmatrix('input_mask')
+                outputs = lasagne.layers.get_output(self.net_out, {self._layer_mask:mask}, deterministic=True)
+                self._predict_masked = th_function(self.inputs+[mask], outputs, updates=self.updates, name='predict_masked')
+            YB = self._predict_masked(XB, MB)
+        return [YB[b,:lengths[b],:] for b in xrange(len(Xs))]
+
+    def predict_fixednoise(self, X, seed=None):
+        """
+        Same as predict(.), but the outputs of the layers drawing random noise
+        (those implementing sample_output(.), e.g. ModelCNN's UniformNoiseLayer)
+        are drawn by a NumPy generator seeded by seed, instead of Theano's
+        random streams. The predictions are thus reproducible, e.g. to compare
+        two sets of parameters (see quantise(.)). The noise is drawn as the
+        NumPy runtime does, such that the prediction is the same as
+        inference.Network(., seed=seed).predict(X) of the exported network.
+
+        X : input [batch x frames x self.insize]
+        """
+        layers_noise = [layer for layer in lasagne.layers.get_all_layers(self.net_out) if hasattr(layer, 'sample_output')]
+        if len(layers_noise)==0: return self.predict(X)
+        if self._predict_fixednoise is None:
+            noises = [T.ftensor3('noise{}'.format(ni)) for ni in xrange(len(layers_noise))]
+            outputs = lasagne.layers.get_output(self.net_out, dict(zip(layers_noise, noises)), deterministic=True)
+            self._predict_fixednoise = th_function(self.inputs+noises, outputs, updates=self.updates, name='predict_fixednoise')
+        rng = np.random.RandomState(seed)
+        return self._predict_fixednoise(X, *[layer.sample_output(rng, X.shape).astype('float32') for layer in layers_noise])
+
+    def predict_chunked(self, X, chunksize, context=None):
+        """
+        Predict the outputs of a (possibly very long) input by chunks.
+
+        The input is cut in chunks of chunksize frames, which are predicted one
+        by one with context frames of the input on each side. The predictions
+        of the context frames are then dropped and those of the chunks are
+        stitched back together. The memory used by the prediction is thus
+        bounded by chunksize+2*context frames, whatever the length of the input.
+        If context covers the receptive field of the model (the default), the
+        output is the same as the prediction of the whole input at once.
+
+        Parameters
+        ----------
+        X :         input matrix [frames x self.insize]
+        chunksize : number of frames predicted by each chunk
+        context :   number of context frames on each side of the chunks (def. self.receptive_field())
+
+        Returns
+        -------
+        The output matrix [frames x output size]
+        """
+        if context is None: context=self.receptive_field()
+        if context is None: raise ValueError('The receptive field of {} is unbounded, the context of the chunks has to be given'.format(self.__class__.__name__))
+        Y = None
+        for start in xrange(0, X.shape[0], chunksize):
+            end = min(start+chunksize, X.shape[0])
+            winstart = max(0, start-context)
+            winend = min(X.shape[0], end+context)
+            YW = self.predict(X[None,winstart:winend,:])[0,:,:]
+            if Y is None: Y = np.empty((X.shape[0], YW.shape[1]), dtype=YW.dtype)
+            Y[start:end,:] = YW[start-winstart:end-winstart,:]
+        return Y
+
+    def predict_batches(self, Xs, framebudget=-1, chunksize=-1, context=None):
+        """
+        Predict the outputs of a list of inputs, yielding (index in Xs, output matrix).
+
+        If framebudget>0, the inputs are sorted by length and predicted in
+        padded batches of at most framebudget frames (see data.batches_bylength(.)
+        and predict_padded(.)), otherwise they are predicted one by one, in order.
+        If chunksize>0, the inputs longer than chunksize frames are predicted
+        by chunks with context frames on each side (see predict_chunked(.)),
+        before the batches. If the receptive field of the model is unbounded
+        (e.g. recurrent layers), context has to be given, which is checked
+        before predicting anything.
+        """
+        chunked = [chunksize>0 and X.shape[0]>chunksize for X in Xs]
+        if any(chunked) and context is None and self.receptive_field() is None: raise ValueError('The receptive field of {} is unbounded, the context of the chunks has to be given to predict by chunks'.format(self.__class__.__name__))
+        if framebudget<=0:
+            for vi in xrange(len(Xs)):
+                if chunked[vi]: yield vi, self.predict_chunked(Xs[vi], chunksize, context=context)
+                else:           yield vi, self.predict(np.reshape(Xs[vi],[1]+[s for s in Xs[vi].shape]))[0,:,:]  # Generate them one by one to avoid blowing up the memory
+        else:
+            for vi in [vi for vi in xrange(len(Xs)) if chunked[vi]]:
+                yield vi, self.predict_chunked(Xs[vi], chunksize, context=context)
+            others = [vi for vi in xrange(len(Xs)) if not chunked[vi]]
+            for batch in data.batches_bylength([Xs[vi].shape[0] for vi in others], framebudget):
+                Ys = self.predict_padded([Xs[others[bi]] for bi in batch])
+                for bi, Y in zip(batch, Ys):
+                    yield others[bi], Y
+
+    def generate_cmp(self, inpath, outpath, fid_lst, batch_framebudget=-1, predict_chunksize=-1, predict_context=None):
 
         if not os.path.isdir(os.path.dirname(outpath)): os.mkdir(os.path.dirname(outpath))
 
         X = data.load(inpath, fid_lst, verbose=1)
 
-        for vi in xrange(len(fid_lst)):
-            CMP = self.predict(np.reshape(X[vi],[1]+[s for s in X[vi].shape]))  # Generate them one by one to avoid blowing up the memory
+        for vi, CMP in self.predict_batches(X, framebudget=batch_framebudget, chunksize=predict_chunksize, context=predict_context):
             CMP.astype('float32').tofile(outpath.replace('*',fid_lst[vi]))
 
 
@@ -134,9 +488,13 @@ class Model:
             , pp_mcep=False
             , pp_spec_pf_coef=-1 # Common value is 1.2
             , pp_spec_extrapfreq=-1
+            , mlpg_chunksize=-1 # Solve the MLPG by chunks of this size (see MLParameterGenerationFast.generation_chunks(.)), whole utterances if -1
+            , mlpg_lookahead=50
+            , nbproc=1 # Number of processes running the synthesis in parallel of the prediction
+            , batch_framebudget=-1 # Predict the files by padded batches of at most this number of frames (see predict_batches(.)), one by one if -1
+            , predict_chunksize=-1 # Predict the files longer than this number of frames by chunks (see predict_chunked(.)), whole files if -1
+            , predict_context=None # Number of context frames on each side of the chunks, the receptive field of the model if None (has to be given for the recurrent models)
             ):
-        from external.pulsemodel import sigproc as sp
-
         print('Reloading output stats')
         # Assume mean/std normalisation of the output
         Ymean = np.fromfile(os.path.dirname(outpath)+'/mean4norm.dat', dtype='float32')
@@ -144,47 +502,60 @@ class Model:
 
         print('\nLoading generation data at once ...')
         X_test = data.load(inpath, fid_lst, verbose=1)
+        y_test = None
         if do_objmeas:
             y_test = data.load(outpath, fid_lst, verbose=1)
             X_test, y_test = data.croplen((X_test, y_test))
 
-        def denormalise(CMP, wins=[[-0.5, 0.0, 0.5], [1.0, -2.0, 1.0]]):
-
-            CMP = CMP*np.tile(Ystd, (CMP.shape[0], 1)) + np.tile(Ymean, (CMP.shape[0], 1)) # De-normalise
-
-            if len(wins)>0:
-                # Apply MLPG
-                from external.merlin.mlpg_fast import MLParameterGenerationFast as MLParameterGeneration
-                mlpg_algo = MLParameterGeneration(delta_win=wins[0], acc_win=wins[1])
-                var = np.tile(Ystd**2,(CMP.shape[0],1)) # Simplification!
-                CMP = mlpg_algo.generation(CMP, var, len(Ymean)/3)
-            else:
-                CMP = CMP[:,:vocoder.featuressize()]
-
-            return CMP
-
         if not os.path.isdir(syndir): os.makedirs(syndir)
         if do_resynth and (not os.path.isdir(syndir+'-resynth')): os.makedirs(syndir+'-resynth')
 
-        for vi in xrange(len(X_test)):
-
-            print('Generating {}/{} ...'.format(1+vi, len(X_test)))
-            print('    Predict ...')
-
-            if do_resynth:
-                CMP = denormalise(y_test[vi], wins=[])
-                resyn = vocoder.synthesis(vocoder.fs, CMP, pp_mcep=False)
-                sp.wavwrite(syndir+'-resynth/'+fid_lst[vi]+'.wav', resyn, vocoder.fs, norm_abs=True, force_norm_abs=True, verbose=1)
-
-            CMP = self.predict(np.reshape(X_test[vi],[1]+[s for s in X_test[vi].shape]))
-            CMP = CMP[0,:,:]
-
-            CMP = denormalise(CMP, wins=wins)
-            syn = vocoder.synthesis(vocoder.fs, CMP, pp_mcep=pp_mcep)
-            sp.wavwrite(syndir+'/'+fid_lst[vi]+'.wav', syn, vocoder.fs, norm_abs=True, force_norm_abs=True, verbose=1)
-
-            if do_objmeas: vocoder.objmeasures_add(CMP, y_test[vi])
-
-        if do_objmeas: vocoder.objmeasures_stats()
+        if do_objmeas: vocoder.objmeasures_clear()
+
+        opts = {'Ymean':Ymean, 'Ystd':Ystd, 'wins':wins, 'syndir':syndir, 'do_resynth':do_resynth, 'pp_mcep':pp_mcep, 'mlpg_chunksize':mlpg_chunksize, 'mlpg_lookahead':mlpg_lookahead}
+
+        if nbproc>1:
+            # The model keeps predicting while a pool of processes runs the
+            # MLPG, the synthesis and the writing of the waveforms.
+            import multiprocessing
+            import tempfile
+            shmdir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+            def toshm(M):
+                # Hand off the matrices through files in shared memory instead of pickling them
+                fd, fname = tempfile.mkstemp(prefix='percivaltts_', suffix='.cmp', dir=shmdir)
+                os.close(fd)
+                M.astype('float32').tofile(fname)
+                return (fname, M.shape)
+
+            pool = multiprocessing.Pool(nbproc)
+            try:
+                results = []
+                for ni, (vi, CMP) in enumerate(self.predict_batches(X_test, framebudget=batch_framebudget, chunksize=predict_chunksize, context=predict_context)):
+                    print('Generating {}/{} ({}) ...'.format(1+ni, len(X_test), fid_lst[vi]))
+                    REF = None if y_test is None else toshm(y_test[vi])
+                    results.append(pool.apply_async(_generate_wav_worker, ((fid_lst[vi], toshm(CMP), REF, vocoder, opts),)))
+
+                    # Do not get too far ahead of the workers (this bounds the memory used by the pending files)
+                    pending = [r for r in results if not r.ready()]
+                    if len(pending)>2*nbproc: pending[0].wait()
+
+                # Gather the objective measures in the order of submission, whatever the order of completion
+                for result in results:
+                    features_err = result.get()
+                    if do_objmeas: vocoder.objmeasures_merge(features_err)
+            finally:
+                pool.close()
+                pool.join()
+
+        else:
+            for ni, (vi, CMP) in enumerate(self.predict_batches(X_test, framebudget=batch_framebudget, chunksize=predict_chunksize, context=predict_context)):
+
+                print('Generating {}/{} ({}) ...'.format(1+ni, len(X_test), fid_lst[vi]))
+
+                CMP = _generate_wav_synthesis(fid_lst[vi], CMP, None if y_test is None else y_test[vi], vocoder, opts)
+
+                if do_objmeas: vocoder.objmeasures_add(CMP, y_test[vi])
+
+        if do_objmeas: vocoder.objmeasures_stats(syndir+'/objmeasures.json')
 
         print_log('Generation finished')
@@ -67,7 +67,7 @@ def layer_final(l_hid, vocoder, mlpg_wins):
     return l_out
 
 
-def layer_LSTM(l_hid, hiddensize, nonlinearity, backwards=False, grad_clipping=50, name=""):
+def layer_LSTM(l_hid, hiddensize, nonlinearity, backwards=False, grad_clipping=50, mask_input=None, name=""):
     '''
     That's a custom LSTM layer that seems to converge faster.
     '''
@@ -77,10 +77,116 @@ def layer_LSTM(l_hid, hiddensize, nonlinearity, backwards=False, grad_clipping=5
     cell = ll.Gate(W_cell=None, W_in=lasagne.init.Orthogonal(1.0), W_hid=lasagne.init.Orthogonal(1.0), nonlinearity=nonlinearity)
     # The final nonline should be TanH otherwise it doesn't converge (why?)
     # by default peepholes=True
-    fwd = ll.LSTMLayer(l_hid, num_units=hiddensize, backwards=backwards, ingate=ingate, forgetgate=forgetgate, outgate=outgate, cell=cell, grad_clipping=grad_clipping, nonlinearity=lasagne.nonlinearities.tanh, name=name)
+    fwd = ll.LSTMLayer(l_hid, num_units=hiddensize, backwards=backwards, ingate=ingate, forgetgate=forgetgate, outgate=outgate, cell=cell, grad_clipping=grad_clipping, nonlinearity=lasagne.nonlinearities.tanh, mask_input=mask_input, name=name)
 
     return fwd
 
+class MaskLayer(ll.MergeLayer):
+    '''
+    Zero the masked frames of the incoming layer [size x length x features],
+    given the mask [size x length] (e.g. Model.layer_mask(.)).
+    '''
+    def __init__(self, incoming, mask_input, **kwargs):
+        super(MaskLayer, self).__init__([incoming, mask_input], **kwargs)
+        self.mask_incoming_index = 1
+
+    def get_output_shape_for(self, input_shapes):
+        return input_shapes[0]
+
+    def get_output_for(self, inputs, **kwargs):
+        return inputs[0]*inputs[1].dimshuffle(0, 1, 'x')
+
+    def inference_spec(self):
+        """Description of this layer for the NumPy runtime (see backend_theano.inference_layers(.))"""
+        return {'type':'identity'}    # The NumPy runtime predicts unpadded inputs
+
+class RecurrentPoolingLayer(ll.MergeLayer):
+    '''
+    Elementwise recurrence of the Quasi-Recurrent Neural Networks (QRNN) [Bradbury et al. 2017]
+    and of the Simple Recurrent Units (SRU) [Lei et al. 2018].
+
+    The incoming layer provides the projections of all the time steps, computed
+    beforehand by a single matrix multiplication (or convolution) through time:
+        QRNN: [candidate, forget gate, output gate]           (3*num_units features)
+        SRU:  [candidate, forget gate, reset gate, highway]   (4*num_units features)
+    so that the recurrence c_t = f_t*c_{t-1} + (1-f_t)*z_t is the only sequential
+    operation, and it is elementwise. See layer_QRNN(.) and layer_SRU(.).
+    As for Lasagne's recurrent layers, the cell is left unchanged over the
+    frames masked by mask_input [size x length] (if given).
+    '''
+    def __init__(self, incoming, num_units, cell='QRNN', backwards=False, mask_input=None, **kwargs):
+        incomings = [incoming]
+        self.mask_incoming_index = -1
+        if not mask_input is None:
+            incomings.append(mask_input)
+            self.mask_incoming_index = 1
+        super(RecurrentPoolingLayer, self).__init__(incomings, **kwargs)
+        if not cell in ['QRNN', 'SRU']: raise ValueError('Unknown recurrent pooling cell "{}"'.format(cell))
+        self.num_units = num_units
+        self.cell = cell
+        self.backwards = backwards
+
+    def get_output_shape_for(self, input_shapes):
+        return (input_shapes[0][0], input_shapes[0][1], self.num_units)
+
+    def get_output_for(self, inputs, **kwargs):
+        input = inputs[0]
+        N = self.num_units
+        if self.cell=='QRNN': candidate = T.tanh(input[:,:,:N])
+        else:                 candidate = input[:,:,:N]
+        forgetgate = T.nnet.sigmoid(input[:,:,N:2*N])
+        if self.mask_incoming_index>0:
+            mask = inputs[self.mask_incoming_index].dimshuffle(0, 1, 'x')
+            forgetgate = mask*forgetgate + (1.0-mask)   # Keep the cell over the masked frames
+
+        # Scan through time only the elementwise recurrence (time as first dimension)
+        forgetgate_seq = forgetgate.dimshuffle(1, 0, 2)
+        candidate_seq = ((1.0-forgetgate)*candidate).dimshuffle(1, 0, 2)
+        cell, _ = theano.scan(fn=lambda f, z, c: f*c+z, sequences=[forgetgate_seq, candidate_seq], outputs_info=[T.zeros_like(candidate_seq[0])], go_backwards=self.backwards)
+        if self.backwards: cell=cell[::-1]
+        cell = cell.dimshuffle(1, 0, 2)
+
+        gate = T.nnet.sigmoid(input[:,:,2*N:3*N])
+        if self.cell=='QRNN': return gate*cell
+        else:                 return gate*T.tanh(cell) + (1.0-gate)*input[:,:,3*N:]
+
+    def inference_spec(self):
+        """Description of this layer for the NumPy runtime (see backend_theano.inference_layers(.))"""
+        return {'type':'recurrent_pooling', 'num_units':int(self.num_units), 'cell':self.cell, 'backwards':bool(self.backwards)}
+
+def layer_QRNN(l_hid, hiddensize, backwards=False, filter_len=2, mask_input=None, name=""):
+    '''
+    Quasi-Recurrent Neural Network (QRNN) layer with fo-pooling [Bradbury et al. 2017].
+    The candidates and gates of all the time steps are computed by a single
+    convolution through time over filter_len frames, masked in the direction of
+    the recurrence (i.e. over the current and previous frames).
+    '''
+    if backwards and filter_len>1 and (not mask_input is None):
+        # The convolution of the last frames would see the masked frames instead of its zero padding
+        l_hid = MaskLayer(l_hid, mask_input, name=name+'.mask')
+    if filter_len==1:
+        l_hid = ll.DenseLayer(l_hid, num_units=3*hiddensize, nonlinearity=None, num_leading_axes=2, name=name+'.projection')
+    else:
+        l_hid = ll.dimshuffle(l_hid, [0, 2, 1, 'x'], name=name+'.dimshuffle_to_1DCNN')  # The features are the channels
+        l_hid = ll.Conv2DLayer(l_hid, num_filters=3*hiddensize, filter_size=[filter_len,1], stride=1, pad=(filter_len-1, 0), nonlinearity=None, name=name+'.projection')
+        # Keep the outputs which depend on the current and previous frames only
+        l_hid = ll.SliceLayer(l_hid, indices=slice(filter_len-1, None) if backwards else slice(None, -(filter_len-1)), axis=2, name=name+'.masking')
+        l_hid = ll.dimshuffle(l_hid, [0, 2, 1, 3], name=name+'.dimshuffle_back')
+        l_hid = ll.flatten(l_hid, outdim=3, name=name+'.flatten')
+
+    return RecurrentPoolingLayer(l_hid, hiddensize, cell='QRNN', backwards=backwards, mask_input=mask_input, name=name)
+
+def layer_SRU(l_hid, hiddensize, backwards=False, mask_input=None, name=""):
+    '''
+    Simple Recurrent Unit (SRU) layer [Lei et al. 2018].
+    The candidates, gates and highway of all the time steps are computed by a
+    single matrix multiplication. The highway is projected, so that the input
+    size can differ from hiddensize.
+    '''
+    l_hid = ll.DenseLayer(l_hid, num_units=4*hiddensize, nonlinearity=None, num_leading_axes=2, name=name+'.projection')
+
+    return RecurrentPoolingLayer(l_hid, hiddensize, cell='SRU', backwards=backwards, mask_input=mask_input, name=name)
+
 class ModelFC(model.Model):
     def __init__(self, insize, vocoder, mlpg_wins=[], hiddensize=256, nonlinearity=lasagne.nonlinearities.very_leaky_rectify, nblayers=6, bn_axes=None, dropout_p=-1.0):
         if bn_axes is None: bn_axes=[0,1]
@@ -108,6 +214,9 @@ class ModelFC(model.Model):
 
         self.init_finish(l_out) # Has to be called at the end of the __init__ to print out the architecture, get the trainable params, etc.
 
+    def receptive_field(self):
+        return 0    # Frame-wise
+
 
 class ModelBGRU(model.Model):
     def __init__(self, insize, vocoder, mlpg_wins=[], hiddensize=256, nonlinearity=lasagne.nonlinearities.very_leaky_rectify, nblayers=3, bn_axes=None, dropout_p=-1.0, grad_clipping=50):
@@ -121,8 +230,8 @@ class ModelBGRU(model.Model):
         for layi in xrange(nblayers):
             layerstr = 'l'+str(1+layi)+'_BGRU{}'.format(hiddensize)
 
-            fwd = ll.GRULayer(l_hid, num_units=hiddensize, backwards=False, name=layerstr+'.fwd', grad_clipping=grad_clipping)
-            bck = ll.GRULayer(l_hid, num_units=hiddensize, backwards=True, name=layerstr+'.bck', grad_clipping=grad_clipping)
+            fwd = ll.GRULayer(l_hid, num_units=hiddensize, backwards=False, name=layerstr+'.fwd', grad_clipping=grad_clipping, mask_input=self.layer_mask())
+            bck = ll.GRULayer(l_hid, num_units=hiddensize, backwards=True, name=layerstr+'.bck', grad_clipping=grad_clipping, mask_input=self.layer_mask())
             l_hid = ll.ConcatLayer((fwd, bck), axis=2)
 
             # Add batch normalisation
@@ -148,8 +257,58 @@ class ModelBLSTM(model.Model):
         for layi in xrange(nblayers):
             layerstr = 'l'+str(1+layi)+'_BLSTM{}'.format(hiddensize)
 
-            fwd = layer_LSTM(l_hid, hiddensize, nonlinearity=nonlinearity, backwards=False, grad_clipping=grad_clipping, name=layerstr+'.fwd')
-            bck = layer_LSTM(l_hid, hiddensize, nonlinearity=nonlinearity, backwards=True, grad_clipping=grad_clipping, name=layerstr+'.bck')
+            fwd = layer_LSTM(l_hid, hiddensize, nonlinearity=nonlinearity, backwards=False, grad_clipping=grad_clipping, mask_input=self.layer_mask(), name=layerstr+'.fwd')
+            bck = layer_LSTM(l_hid, hiddensize, nonlinearity=nonlinearity, backwards=True, grad_clipping=grad_clipping, mask_input=self.layer_mask(), name=layerstr+'.bck')
+            l_hid = ll.ConcatLayer((fwd, bck), axis=2)
+
+            # Add batch normalisation
+            if len(bn_axes)>0: l_hid=ll.batch_norm(l_hid, axes=bn_axes)
+
+            # Add dropout (after batchnorm)
+            if dropout_p>0.0: l_hid=ll.dropout(l_hid, p=dropout_p)
+
+        l_out = layer_final(l_hid, vocoder, mlpg_wins)
+
+        self.init_finish(l_out) # Has to be called at the end of the __init__ to print out the architecture, get the trainable params, etc.
+
+
+class ModelBQRNN(model.Model):
+    def __init__(self, insize, vocoder, mlpg_wins=[], hiddensize=256, nonlinearity=lasagne.nonlinearities.very_leaky_rectify, nblayers=3, bn_axes=None, dropout_p=-1.0, filter_len=2):
+        if bn_axes is None: bn_axes=[]
+        model.Model.__init__(self, insize, vocoder, hiddensize)
+
+        l_hid = ll.InputLayer(shape=(None, None, insize), input_var=self._input_values, name='input_conditional')
+
+        for layi in xrange(nblayers):
+            layerstr = 'l'+str(1+layi)+'_BQRNN{}'.format(hiddensize)
+
+            fwd = layer_QRNN(l_hid, hiddensize, backwards=False, filter_len=filter_len, mask_input=self.layer_mask(), name=layerstr+'.fwd')
+            bck = layer_QRNN(l_hid, hiddensize, backwards=True, filter_len=filter_len, mask_input=self.layer_mask(), name=layerstr+'.bck')
+            l_hid = ll.ConcatLayer((fwd, bck), axis=2)
+
+            # Add batch normalisation
+            if len(bn_axes)>0: l_hid=ll.batch_norm(l_hid, axes=bn_axes)
+
+            # Add dropout (after batchnorm)
+            if dropout_p>0.0: l_hid=ll.dropout(l_hid, p=dropout_p)
+
+        l_out = layer_final(l_hid, vocoder, mlpg_wins)
+
+        self.init_finish(l_out) # Has to be called at the end of the __init__ to print out the architecture, get the trainable params, etc.
+
+
+class ModelBSRU(model.Model):
+    def __init__(self, insize, vocoder, mlpg_wins=[], hiddensize=256, nonlinearity=lasagne.nonlinearities.very_leaky_rectify, nblayers=3, bn_axes=None, dropout_p=-1.0):
+        if bn_axes is None: bn_axes=[]
+        model.Model.__init__(self, insize, vocoder, hiddensize)
+
+        l_hid = ll.InputLayer(shape=(None, None, insize), input_var=self._input_values, name='input_conditional')
+
+        for layi in xrange(nblayers):
+            layerstr = 'l'+str(1+layi)+'_BSRU{}'.format(hiddensize)
+
+            fwd = layer_SRU(l_hid, hiddensize, backwards=False, mask_input=self.layer_mask(), name=layerstr+'.fwd')
+            bck = layer_SRU(l_hid, hiddensize, backwards=True, mask_input=self.layer_mask(), name=layerstr+'.bck')
             l_hid = ll.ConcatLayer((fwd, bck), axis=2)
 
             # Add batch normalisation
@@ -22,6 +22,8 @@ from __future__ import print_function
 
 from percivaltts import *  # Always include this first to setup a few things
 
+from functools import partial
+
 import numpy as np
 numpy_force_random_seed()
 
@@ -66,12 +68,80 @@ class TileLayer(ll.Layer):
         return (input_shape[0], input_shape[1], input_shape[2]*self.reps[2])
 
 
-def layer_GatedConv2DLayer(incoming, num_filters, filter_size, stride=(1, 1), pad=0, nonlinearity=lasagne.nonlinearities.very_leaky_rectify, name=''):
-    la = ll.Conv2DLayer(incoming, num_filters=num_filters, filter_size=filter_size, stride=stride, pad=pad, nonlinearity=nonlinearity, name=name+'.activation')
-    lg = ll.Conv2DLayer(incoming, num_filters=num_filters, filter_size=filter_size, stride=stride, pad=pad, nonlinearity=theano.tensor.nnet.nnet.sigmoid, name=name+'.gate')
-    lout = ll.ElemwiseMergeLayer([la, lg], T.mul, cropping=None, name=name+'.mul_merge')
+class GatingLayer(ll.Layer):
+    """
+    Split the channels (axis 1) of the incoming layer in two halves, the
+    activation and the gate, and return nonlinearity(activation)*sigmoid(gate).
+    """
+    def __init__(self, incoming, activation=lasagne.nonlinearities.very_leaky_rectify, **kwargs):
+        super(GatingLayer, self).__init__(incoming, **kwargs)
+        self.activation = activation    # Not named nonlinearity, which batch_norm(.) would move after the normalisation
+
+    def get_output_for(self, x, **kwargs):
+        N = self.input_shape[1]//2
+        return self.activation(x[:,:N])*T.nnet.sigmoid(x[:,N:])
+
+    def get_output_shape_for(self, input_shape):
+        return (input_shape[0], input_shape[1]//2) + tuple(input_shape[2:])
+
+    def inference_spec(self):
+        """Description of this layer for the NumPy runtime (see backend_theano.inference_layers(.))"""
+        return {'type':'gating', 'axis':1, 'nonlinearity':inference_nonlinearity(self.activation)}
+
+def layer_GatedConv2DLayer(incoming, num_filters, filter_size, stride=(1, 1), pad=0, nonlinearity=lasagne.nonlinearities.very_leaky_rectify, name='', dilation=(1, 1)):
+    """
+    Gated convolution: nonlinearity(conv_activation)*sigmoid(conv_gate).
+    The activation and the gate are computed by a single convolution of
+    2*num_filters filters, split by a GatingLayer.
+    Parameters saved with the previous separate convolutions can be loaded
+    through params_fuse_gatedconv(.).
+    """
+    convolution = T.nnet.conv2d if tuple(dilation)==(1, 1) else partial(T.nnet.conv2d, filter_dilation=tuple(dilation))
+    # Initialise the two halves as two separate convolutions
+    Wshape = (num_filters, incoming.output_shape[1]) + tuple(filter_size)
+    W = np.concatenate([lasagne.init.GlorotUniform().sample(Wshape) for _ in xrange(2)]).astype(theano.config.floatX)
+    layer = ll.Conv2DLayer(incoming, num_filters=2*num_filters, filter_size=filter_size, stride=stride, pad=pad, W=W, nonlinearity=None, convolution=convolution, name=name)
+    lout = GatingLayer(layer, activation=nonlinearity, name=name+'.mul_merge')   # Same name as the previous merge layer, for the names of the batch normalisations
     return lout
 
+def params_fuse_gatedconv(tensors):
+    """
+    Map the parameters of the gated convolutions saved before they were fused
+    (name.activation.W/b and name.gate.W/b) to the fused convolution (name.W/b).
+    The order of the other parameters is preserved, for matching by position.
+
+    tensors : list of (name, numpy array), as saved by Model.saveAllParams(.)
+    """
+    tensordict = dict(tensors)
+    fused = []
+    for name, value in tensors:
+        for key in ['.W', '.b']:
+            if name.endswith('.activation'+key) and name[:-len('.activation'+key)]+'.gate'+key in tensordict:
+                prefix = name[:-len('.activation'+key)]
+                fused.append((prefix+key, np.concatenate((value, tensordict[prefix+'.gate'+key]))))
+                break
+            if name.endswith('.gate'+key) and name[:-len('.gate'+key)]+'.activation'+key in tensordict:
+                break   # Concatenated with its activation above
+        else:
+            fused.append((name, value))
+    return fused
+
+def layer_DilatedGatedCNN(incoming, nblayers, num_filters, nonlinearity, filter_len=3, name=''):
+    """
+    Stack of gated 1D convolutions through time, whose dilation doubles at
+    each layer, as a convolutional alternative to the BLSTM layers.
+    Its receptive field is (filter_len-1)*(2**nblayers-1)/2 frames on each side
+    (filter_len has to be odd).
+    """
+    layer = ll.dimshuffle(incoming, [0, 2, 1, 'x'], name=name+'.dimshuffle_to_1DCNN')    # The features are the channels
+    for layi in xrange(nblayers):
+        dilation = 2**layi
+        layerstr = name+'.l'+str(1+layi)+'_DGC{}x{}d{}'.format(num_filters, filter_len, dilation)
+        layer = ll.batch_norm(layer_GatedConv2DLayer(layer, num_filters, [filter_len,1], stride=1, pad=(dilation*(filter_len-1)//2, 0), nonlinearity=nonlinearity, name=layerstr, dilation=(dilation, 1)))
+    layer = ll.dimshuffle(layer, [0, 2, 1, 3], name=name+'.dimshuffle_back')
+    layer = ll.flatten(layer, outdim=3, name=name+'.flatten')
+    return layer
+
 def layer_context(layer_ctx, ctx_nblayers, ctx_nbfilters, ctx_winlen, hiddensize, nonlinearity, bn_axes=None, bn_cnn_axes=None, critic=False, useLRN=True):
 
     layer_ctx = ll.dimshuffle(layer_ctx, [0, 'x', 1, 2], name='ctx.dimshuffle_to_2DCNN')
@@ -119,14 +189,30 @@ class UniformNoiseLayer(ll.Layer):
         unirnd = self._srng.uniform(shape, low=self._low, high=self._high)
         return unirnd
 
+    def sample_output(self, rng, input_shape):
+        """Draw an output of this layer with the NumPy generator rng, as the NumPy runtime does (see Model.predict_fixednoise(.))"""
+        return rng.uniform(self._low, self._high, size=(input_shape[0], input_shape[1], self._size))
+
+    def inference_spec(self):
+        """Description of this layer for the NumPy runtime (see backend_theano.inference_layers(.))"""
+        return {'type':'uniform_noise', 'size':int(self._size), 'low':float(self._low), 'high':float(self._high)}
+
     def get_output_shape_for(self, input_shape):
         return [input_shape[0], input_shape[1], self._size]
 
 
 class ModelCNN(model.Model):
 
-    def __init__(self, insize, vocoder, hiddensize=256, nonlinearity=lasagne.nonlinearities.very_leaky_rectify, ctx_nblayers=1, ctx_nbfilters=2, ctx_winlen=21, nbcnnlayers=8, nbfilters=16, spec_freqlen=5, noise_freqlen=5, windur=0.025, bn_axes=None, noisesize=100):
+    def __init__(self, insize, vocoder, hiddensize=256, nonlinearity=lasagne.nonlinearities.very_leaky_rectify, ctx_nblayers=1, ctx_nbfilters=2, ctx_winlen=21, nbcnnlayers=8, nbfilters=16, spec_freqlen=5, noise_freqlen=5, windur=0.025, bn_axes=None, noisesize=100, f0vuv_arch='BLSTM', f0vuv_dgcnn_nblayers=7):
+        """
+        f0vuv_arch : Architecture of the f0 and vuv branches, either 'BLSTM' or
+                     'DGCNN' for a stack of f0vuv_dgcnn_nblayers dilated gated
+                     CNN layers (see layer_DilatedGatedCNN(.)), which is not
+                     recurrent, thus faster on CPU. The default 7 layers see
+                     127 frames (0.635s) on each side.
+        """
         if bn_axes is None: bn_axes=[0,1]
+        if not f0vuv_arch in ['BLSTM', 'DGCNN']: raise ValueError('Unknown architecture "{}" for the f0 and vuv'.format(f0vuv_arch))
         model.Model.__init__(self, insize, vocoder, hiddensize)
 
         self._ctx_nblayers = ctx_nblayers
@@ -138,6 +224,8 @@ class ModelCNN(model.Model):
         self._spec_freqlen = spec_freqlen
         self._noise_freqlen = noise_freqlen
         self._windur = windur
+        self._f0vuv_arch = f0vuv_arch
+        self._f0vuv_dgcnn_nblayers = f0vuv_dgcnn_nblayers
 
         winlen = int(0.5*self._windur/0.005)*2+1
 
@@ -151,15 +239,19 @@ class ModelCNN(model.Model):
         layers_toconcat = []
 
         if vocoder.f0size()>0:
-            # F0 - BLSTM layer
             layer_f0 = self._layer_ctx
-            grad_clipping = 50
-            for layi in xrange(1):
-                layerstr = 'f0_l'+str(1+layi)+'_BLSTM{}'.format(self._hiddensize)
-                fwd = models_basic.layer_LSTM(layer_f0, self._hiddensize, nonlinearity, backwards=False, grad_clipping=grad_clipping, name=layerstr+'.fwd')
-                bck = models_basic.layer_LSTM(layer_f0, self._hiddensize, nonlinearity, backwards=True, grad_clipping=grad_clipping, name=layerstr+'.bck')
-                layer_f0 = ll.ConcatLayer((fwd, bck), axis=2, name=layerstr+'.concat')
-                # TODO Replace by CNN ?? It didn't work well, maybe didn't work well with WGAN loss, but f0 is not more on WGAN loss
+            if self._f0vuv_arch=='BLSTM':
+                # F0 - BLSTM layer
+                grad_clipping = 50
+                for layi in xrange(1):
+                    layerstr = 'f0_l'+str(1+layi)+'_BLSTM{}'.format(self._hiddensize)
+                    fwd = models_basic.layer_LSTM(layer_f0, self._hiddensize, nonlinearity, backwards=False, grad_clipping=grad_clipping, mask_input=self.layer_mask(), name=layerstr+'.fwd')
+                    bck = models_basic.layer_LSTM(layer_f0, self._hiddensize, nonlinearity, backwards=True, grad_clipping=grad_clipping, mask_input=self.layer_mask(), name=layerstr+'.bck')
+                    layer_f0 = ll.ConcatLayer((fwd, bck), axis=2, name=layerstr+'.concat')
+                    # TODO Replace by CNN ?? It didn't work well, maybe didn't work well with WGAN loss, but f0 is not more on WGAN loss
+            else:
+                # F0 - Dilated gated CNN layers
+                layer_f0 = layer_DilatedGatedCNN(layer_f0, self._f0vuv_dgcnn_nblayers, self._hiddensize, nonlinearity, name='f0_DGCNN')
             layer_f0 = ll.DenseLayer(layer_f0, num_units=vocoder.f0size(), nonlinearity=None, num_leading_axes=2, name='f0_lout_projection')
             layers_toconcat.append(layer_f0)
 
@@ -189,14 +281,18 @@ class ModelCNN(model.Model):
             layers_toconcat.append(layer_noise)
 
         if vocoder.vuvsize()>0:
-            # VUV - BLSTM layer
             layer_vuv = self._layer_ctx
-            grad_clipping = 50
-            for layi in xrange(1):
-                layerstr = 'vuv_l'+str(1+layi)+'_BLSTM{}'.format(self._hiddensize)
-                fwd = models_basic.layer_LSTM(layer_vuv, self._hiddensize, nonlinearity, backwards=False, grad_clipping=grad_clipping, name=layerstr+'.fwd')
-                bck = models_basic.layer_LSTM(layer_vuv, self._hiddensize, nonlinearity, backwards=True, grad_clipping=grad_clipping, name=layerstr+'.bck')
-                layer_vuv = ll.ConcatLayer((fwd, bck), axis=2, name=layerstr+'.concat')
+            if self._f0vuv_arch=='BLSTM':
+                # VUV - BLSTM layer
+                grad_clipping = 50
+                for layi in xrange(1):
+                    layerstr = 'vuv_l'+str(1+layi)+'_BLSTM{}'.format(self._hiddensize)
+                    fwd = models_basic.layer_LSTM(layer_vuv, self._hiddensize, nonlinearity, backwards=False, grad_clipping=grad_clipping, mask_input=self.layer_mask(), name=layerstr+'.fwd')
+                    bck = models_basic.layer_LSTM(layer_vuv, self._hiddensize, nonlinearity, backwards=True, grad_clipping=grad_clipping, mask_input=self.layer_mask(), name=layerstr+'.bck')
+                    layer_vuv = ll.ConcatLayer((fwd, bck), axis=2, name=layerstr+'.concat')
+            else:
+                # VUV - Dilated gated CNN layers
+                layer_vuv = layer_DilatedGatedCNN(layer_vuv, self._f0vuv_dgcnn_nblayers, self._hiddensize, nonlinearity, name='vuv_DGCNN')
             layer_vuv = ll.DenseLayer(layer_vuv, num_units=vocoder.vuvsize(), nonlinearity=None, num_leading_axes=2, name='vuv_lout_projection')
             layers_toconcat.append(layer_vuv)
 
@@ -204,6 +300,24 @@ class ModelCNN(model.Model):
 
         self.init_finish(layer) # Has to be called at the end of the __init__ to print out the architecture, get the trainable params, etc.
 
+    def params_compat(self, tensors):
+        return params_fuse_gatedconv(tensors)   # Saved before the gated convolutions were fused
+
+    def receptive_field(self):
+        """
+        The receptive field of the context CNN followed by the gated CNN of the
+        spectrum, or by the dilated gated CNN of the f0 and vuv (f0vuv_arch='DGCNN').
+        The BLSTM layers of the f0 and vuv (f0vuv_arch='BLSTM') are the exception: their
+        receptive field is unbounded and is ignored here. When predicting by chunks
+        (see Model.predict_chunked(.)), the f0 and vuv of each chunk thus depend only on
+        the chunk and its context, which can be increased to bring them closer to the
+        prediction of the whole input.
+        """
+        winlen = int(0.5*self._windur/0.005)*2+1
+        branch = (self._nbcnnlayers+1)*(winlen//2)   # 'same' padding
+        if self._f0vuv_arch=='DGCNN': branch=max(branch, 2**self._f0vuv_dgcnn_nblayers-1)  # Filters of 3 frames
+        return self._ctx_nblayers*(self._ctx_winlen//2) + branch
+
 
     def build_critic(self, critic_input_var, condition_var, vocoder, ctxsize, nonlinearity=lasagne.nonlinearities.very_leaky_rectify, postlayers_nb=6, use_LSweighting=True, LSWGANtransfreqcutoff=4000, LSWGANtranscoef=1.0/8.0, use_WGAN_incnoisefeature=False):
 
@@ -44,15 +44,28 @@ import models_basic
 from models_cnn import CstMulLayer
 from models_cnn import TileLayer
 from models_cnn import layer_GatedConv2DLayer
+from models_cnn import params_fuse_gatedconv
 from models_cnn import layer_context
 
 class ModelGeneric(model.Model):
-    def __init__(self, insize, vocoder, mlpg_wins=[], layertypes=['FC', 'FC', 'BLSTM'], hiddensize=256, nonlinearity=lasagne.nonlinearities.very_leaky_rectify, bn_axes=None, grad_clipping=50, nameprefix=None):
+    def __init__(self, insize, vocoder, mlpg_wins=[], layertypes=['FC', 'FC', 'BLSTM'], hiddensize=256, nonlinearity=lasagne.nonlinearities.very_leaky_rectify, bn_axes=None, grad_clipping=50, nameprefix=None, critic_postlayertype='FC'):
+        """
+        layertypes :    List of the layers' types: 'FC', 'BLSTM', ['CNN', nbfilters, winlen],
+                        ['GCNN', nbfilters, winlen], or the parallelisable recurrent layers
+                        'BQRNN' and 'BSRU' (see models_basic.RecurrentPoolingLayer), whose
+                        projections are computed for all the time steps at once.
+        critic_postlayertype : Type of the post layers of the critic (see build_critic(.)):
+                        'FC', 'BQRNN' or 'BSRU'.
+        """
         if bn_axes is None: bn_axes=[0,1]
+        if not critic_postlayertype in ['FC', 'BQRNN', 'BSRU']: raise ValueError('Unknown layer type "{}" for the critic\'s post layers'.format(critic_postlayertype))
         model.Model.__init__(self, insize, vocoder, hiddensize)
 
         if nameprefix is None: nameprefix=''
 
+        self._layertypes = layertypes
+        self._critic_postlayertype = critic_postlayertype
+
         l_hid = lasagne.layers.InputLayer(shape=(None, None, insize), input_var=self._input_values, name=nameprefix+'input.conditional')
 
         for layi in xrange(len(layertypes)):
@@ -64,12 +77,22 @@ class ModelGeneric(model.Model):
                 if len(bn_axes)>0: l_hid=lasagne.layers.batch_norm(l_hid, axes=bn_axes) # Add batch normalisation
 
             elif layertypes[layi]=='BLSTM':
-                fwd = models_basic.layer_LSTM(l_hid, hiddensize, nonlinearity=nonlinearity, backwards=False, grad_clipping=grad_clipping, name=layerstr+'.fwd')
-                bck = models_basic.layer_LSTM(l_hid, hiddensize, nonlinearity=nonlinearity, backwards=True, grad_clipping=grad_clipping, name=layerstr+'.bck')
+                fwd = models_basic.layer_LSTM(l_hid, hiddensize, nonlinearity=nonlinearity, backwards=False, grad_clipping=grad_clipping, mask_input=self.layer_mask(), name=layerstr+'.fwd')
+                bck = models_basic.layer_LSTM(l_hid, hiddensize, nonlinearity=nonlinearity, backwards=True, grad_clipping=grad_clipping, mask_input=self.layer_mask(), name=layerstr+'.bck')
                 l_hid = lasagne.layers.ConcatLayer((fwd, bck), axis=2)
 
                 # Don't add batch norm for RNN-based layers
 
+            elif layertypes[layi]=='BQRNN':
+                fwd = models_basic.layer_QRNN(l_hid, hiddensize, backwards=False, mask_input=self.layer_mask(), name=layerstr+'.fwd')
+                bck = models_basic.layer_QRNN(l_hid, hiddensize, backwards=True, mask_input=self.layer_mask(), name=layerstr+'.bck')
+                l_hid = lasagne.layers.ConcatLayer((fwd, bck), axis=2)
+
+            elif layertypes[layi]=='BSRU':
+                fwd = models_basic.layer_SRU(l_hid, hiddensize, backwards=False, mask_input=self.layer_mask(), name=layerstr+'.fwd')
+                bck = models_basic.layer_SRU(l_hid, hiddensize, backwards=True, mask_input=self.layer_mask(), name=layerstr+'.bck')
+                l_hid = lasagne.layers.ConcatLayer((fwd, bck), axis=2)
+
             elif isinstance(layertypes[layi], list):
                 if layertypes[layi][0]=='CNN':
                     # l_hid = lasagne.layers.batch_norm(lasagne.layers.DenseLayer(l_hid, hiddensize, nonlinearity=nonlinearity, num_leading_axes=2, name='projection'), axes=bn_axes)
@@ -94,6 +117,18 @@ class ModelGeneric(model.Model):
 
         self.init_finish(l_out) # Has to be called at the end of the __init__ to print out the architecture, get the trainable params, etc.
 
+    def params_compat(self, tensors):
+        return params_fuse_gatedconv(tensors)   # Saved before the gated convolutions were fused
+
+    def receptive_field(self):
+        context = 0
+        for layertype in self._layertypes:
+            if isinstance(layertype, list) and layertype[0] in ['CNN', 'GCNN']:
+                context += layertype[2]//2  # 'same' padding
+            elif layertype!='FC':
+                return None                 # Recurrent layers
+        return context
+
 
     # WGAN: Critic arch. parameters TODO Use cfg's
     #       These are usually symmetrical with the model, but it the model can be very different in the case of a generic model, so make D as in CNN model.
@@ -166,8 +201,14 @@ class ModelGeneric(model.Model):
 
         # ... and finalize with a common FC network
         for layi in xrange(postlayers_nb):
-            layerstr = 'post.l'+str(1+layi)+'_FC'+str(self._hiddensize)
-            layer = ll.DenseLayer(layer, self._hiddensize, nonlinearity=nonlinearity, num_leading_axes=2, name=layerstr)
+            layerstr = 'post.l'+str(1+layi)+'_'+self._critic_postlayertype+str(self._hiddensize)
+            if self._critic_postlayertype=='FC':
+                layer = ll.DenseLayer(layer, self._hiddensize, nonlinearity=nonlinearity, num_leading_axes=2, name=layerstr)
+            else:
+                layer_rnn = models_basic.layer_QRNN if self._critic_postlayertype=='BQRNN' else models_basic.layer_SRU
+                fwd = layer_rnn(layer, self._hiddensize, backwards=False, name=layerstr+'.fwd')
+                bck = layer_rnn(layer, self._hiddensize, backwards=True, name=layerstr+'.bck')
+                layer = ll.ConcatLayer((fwd, bck), axis=2, name=layerstr+'.concat')
 
         # output layer (linear)
         layer = ll.DenseLayer(layer, 1, nonlinearity=None, num_leading_axes=2, name='projection') # No nonlin for this output
@@ -43,6 +43,7 @@ import lasagne
 from external.pulsemodel import sigproc as sp
 
 import data
+import checkpoint
 
 if th_cuda_available():
     from pygpu.gpuarray import GpuArrayException   # pragma: no cover
@@ -80,25 +81,70 @@ class Optimizer:
         paramsvalues = [(str(p), p.get_value()) for p in self._model.params_all] # The network parameters
 
         ovs = []
-        for ov in self._optim_updates:
-            ovs.append([p.get_value() for p in ov.keys()]) # The optim algo state
+        for ov, names in zip(self._optim_updates, self._optim_names()):
+            ovs.extend([(name, p.get_value()) for name, p in zip(names, ov.keys())]) # The optim algo state
 
-        DATA = [paramsvalues, ovs, cfg, extras, np.random.get_state()]
-        cPickle.dump(DATA, open(fstate, 'wb'))
+        meta = {'nbparams':len(paramsvalues), 'nbovs':[len(ov) for ov in self._optim_updates], 'cfg':cfg, 'extras':extras, 'rngstate':np.random.get_state()}
+        checkpoint.save(fstate, paramsvalues+ovs, meta)
 
         print(' done')
         sys.stdout.flush()
 
+    def _optim_names(self):
+        """
+        Names of the variables of the optimisation algorithms, e.g. optim0/l1.W
+        for the parameter l1.W. The unnamed variables (e.g. Adam's moments) are
+        named after the parameter that follows them in the updates, e.g.
+        optim0/state0/l1.W, so that they can be mapped as their parameter by
+        Model.params_compat(.).
+        """
+        names = []
+        for oi, ov in enumerate(self._optim_updates):
+            ovnames = []
+            following, k = '', 0
+            for p in reversed(ov.keys()):
+                if p.name is None:
+                    ovnames.append('optim{}/state{}/{}'.format(oi, k, following))
+                    k += 1
+                else:
+                    following, k = str(p), 0
+                    ovnames.append('optim{}/{}'.format(oi, following))
+            names.append(ovnames[::-1])
+        return names
+
+    def _setvalues(self, params, names, tensors):
+        """
+        Set the values of params (of the given names) from the saved tensors,
+        matched by checkpoint.match(.). All of them have to be mapped, so that a
+        training is never resumed from a partial state.
+        """
+        matches = checkpoint.match(names, tensors)
+        if len(matches)!=len(names) or len(tensors)!=len(names): raise ValueError('Cannot map the {} saved values to the {} parameters ({} matched)'.format(len(tensors), len(names), len(matches)))
+        for pi, v in matches:
+            if v.shape!=params[pi].get_value(borrow=True).shape: raise ValueError('Parameter {} has shape {} whereas the loaded one has shape {}'.format(names[pi], params[pi].get_value(borrow=True).shape, v.shape))
+            params[pi].set_value(np.array(v), borrow=True)   # Copy out of the memory map
+
     def loadTrainingState(self, fstate, cfg, printfn=print):
         # https://github.com/Lasagne/Lasagne/issues/159
         printfn('    reloading parameters from {} ...'.format(fstate), end='')
         sys.stdout.flush()
 
-        DATA = cPickle.load(open(fstate, 'rb'))
-        for p, v in zip(self._model.params_all, DATA[0]): p.set_value(v[1])    # The network parameters
+        if checkpoint.ischeckpoint(fstate):
+            tensors, meta = checkpoint.load(fstate)
+            ovs = []
+            start = meta['nbparams']
+            for nbov in meta['nbovs']:
+                ovs.append(tensors[start:start+nbov])
+                start += nbov
+            DATA = [tensors[:meta['nbparams']], ovs, meta['cfg'], meta['extras'], meta['rngstate']]
+        else:
+            DATA = cPickle.load(open(fstate, 'rb'))
+            DATA[1] = [[('', value) for value in da] for da in DATA[1]]  # Pickled without names, thus matched by position
+        self._setvalues(self._model.params_all, [str(p) for p in self._model.params_all], self._model.params_compat(DATA[0]))  # The network parameters
 
-        for ov, da in zip(self._optim_updates, DATA[1]):
-            for p, value in zip(ov.keys(), da): p.set_value(value)
+        if len(DATA[1])!=len(self._optim_updates): raise ValueError('The training state has {} optimisation states whereas the optimiser has {}'.format(len(DATA[1]), len(self._optim_updates)))
+        for ov, names, da in zip(self._optim_updates, self._optim_names(), DATA[1]):
+            self._setvalues(ov.keys(), names, self._model.params_compat(da))
 
         print(' done')
         sys.stdout.flush()
@@ -119,38 +165,16 @@ class Optimizer:
 
     # Training =================================================================
 
-    def train(self, params, indir, outdir, wdir, fid_lst_tra, fid_lst_val, X_vals, Y_vals, cfg, params_savefile, trialstr='', cont=None):
-
-        print('Model initial status before training')
-        worst_val = data.cost_0pred_rmse(Y_vals) # RMSE
-        print("    0-pred validation RMSE = {} (100%)".format(worst_val))
-        init_pred_rms = data.prediction_rms(self._model, [X_vals])
-        print('    initial RMS of prediction = {}'.format(init_pred_rms))
-        init_val = data.cost_model_prediction_rmse(self._model, [X_vals], Y_vals)
-        best_val = None
-        print("    initial validation RMSE = {} ({:.4f}%)".format(init_val, 100.0*init_val/worst_val))
+    def compile_functions(self, params, cfg):
+        """
+        Build the training graphs (critic included, for WGAN) and compile their functions.
 
-        nbbatches = int(len(fid_lst_tra)/cfg.train_batch_size)
-        print('    using {} batches of {} sentences each'.format(nbbatches, cfg.train_batch_size))
-        print('    model #parameters={}'.format(self._model.nbParams()))
-
-        nbtrainframes = 0
-        for fid in fid_lst_tra:
-            X = data.loadfile(outdir, fid)
-            nbtrainframes += X.shape[0]
-        frameshift = 0.005 # TODO
-        print('    Training set: {} sentences, #frames={} ({})'.format(len(fid_lst_tra), nbtrainframes, time.strftime('%H:%M:%S', time.gmtime((nbtrainframes*frameshift)))))
-        print('    #parameters/#frames={:.2f}'.format(float(self._model.nbParams())/nbtrainframes))
-        if cfg.train_nbepochs_scalewdata and not cfg.train_batch_lengthmax is None:
-            # During an epoch, the whole data is _not_ seen by the training since cfg.train_batch_lengthmax is limited and smaller to the sentence size.
-            # To compensate for it and make the config below less depedent on the data, the min ans max nbepochs are scaled according to the missing number of frames seen.
-            # TODO Should consider only non-silent frames, many recordings have a lot of pre and post silences
-            epochcoef = nbtrainframes/float((cfg.train_batch_lengthmax*len(fid_lst_tra)))
-            print('    scale number of epochs wrt number of frames')
-            cfg.train_min_nbepochs = int(cfg.train_min_nbepochs*epochcoef)
-            cfg.train_max_nbepochs = int(cfg.train_max_nbepochs*epochcoef)
-            print('        train_min_nbepochs={}'.format(cfg.train_min_nbepochs))
-            print('        train_max_nbepochs={}'.format(cfg.train_max_nbepochs))
+        Returns
+        -------
+        train_fn, train_validation_fn, critic_train_fn, critic_train_validation_fn
+            (the last three are None for LSE)
+        """
+        self._optim_updates = []    # Only those of the functions compiled below (not of a previous training)
 
         if self._errtype=='WGAN':
             print('Preparing critic for WGAN...')
@@ -231,12 +255,12 @@ class Optimizer:
             generator_train_fn_ins = [self._model._input_values]
             generator_train_fn_ins.append(self._target_values)
             generator_train_fn_outs = [generator_loss, generator_lossratio]
-            train_fn = theano.function(generator_train_fn_ins, generator_train_fn_outs, updates=generator_updates)
-            train_validation_fn = theano.function(generator_train_fn_ins, generator_loss, no_default_updates=True)
+            train_fn = th_function(generator_train_fn_ins, generator_train_fn_outs, updates=generator_updates, name='generator_train')
+            train_validation_fn = th_function(generator_train_fn_ins, generator_loss, no_default_updates=True, name='generator_validation')
             print('Compiling critic training function...')
             critic_train_fn_ins = [self._model._input_values, critic_input_var, epsi]
-            critic_train_fn = theano.function(critic_train_fn_ins, critic_loss, updates=critic_updates)
-            critic_train_validation_fn = theano.function(critic_train_fn_ins, critic_loss, no_default_updates=True)
+            critic_train_fn = th_function(critic_train_fn_ins, critic_loss, updates=critic_updates, name='critic_train')
+            critic_train_validation_fn = th_function(critic_train_fn_ins, critic_loss, no_default_updates=True, name='critic_validation')
 
         elif self._errtype=='LSE':
             print('    LSE Training')
@@ -251,10 +275,48 @@ class Optimizer:
 
             self._optim_updates.append(updates)
             print("    compiling training function ...")
-            train_fn = theano.function(self._model.inputs+[self._target_values], self.cost, updates=updates)
+            train_fn = th_function(self._model.inputs+[self._target_values], self.cost, updates=updates, name='train')
+            train_validation_fn, critic_train_fn, critic_train_validation_fn = None, None, None
         else:
             raise ValueError('Unknown err type "'+self._errtype+'"')    # pragma: no cover
 
+        return train_fn, train_validation_fn, critic_train_fn, critic_train_validation_fn
+
+    def train(self, params, indir, outdir, wdir, fid_lst_tra, fid_lst_val, X_vals, Y_vals, cfg, params_savefile, trialstr='', cont=None):
+
+        print('Model initial status before training')
+        worst_val = data.cost_0pred_rmse(Y_vals) # RMSE
+        print("    0-pred validation RMSE = {} (100%)".format(worst_val))
+        init_pred_rms = data.prediction_rms(self._model, [X_vals])
+        print('    initial RMS of prediction = {}'.format(init_pred_rms))
+        init_val = data.cost_model_prediction_rmse(self._model, [X_vals], Y_vals)
+        best_val = None
+        print("    initial validation RMSE = {} ({:.4f}%)".format(init_val, 100.0*init_val/worst_val))
+
+        nbbatches = int(len(fid_lst_tra)/cfg.train_batch_size)
+        print('    using {} batches of {} sentences each'.format(nbbatches, cfg.train_batch_size))
+        print('    model #parameters={}'.format(self._model.nbParams()))
+
+        nbtrainframes = 0
+        for fid in fid_lst_tra:
+            X = data.loadfile(outdir, fid)
+            nbtrainframes += X.shape[0]
+        frameshift = 0.005 # TODO
+        print('    Training set: {} sentences, #frames={} ({})'.format(len(fid_lst_tra), nbtrainframes, time.strftime('%H:%M:%S', time.gmtime((nbtrainframes*frameshift)))))
+        print('    #parameters/#frames={:.2f}'.format(float(self._model.nbParams())/nbtrainframes))
+        if cfg.train_nbepochs_scalewdata and not cfg.train_batch_lengthmax is None:
+            # During an epoch, the whole data is _not_ seen by the training since cfg.train_batch_lengthmax is limited and smaller to the sentence size.
+            # To compensate for it and make the config below less depedent on the data, the min ans max nbepochs are scaled according to the missing number of frames seen.
+            # TODO Should consider only non-silent frames, many recordings have a lot of pre and post silences
+            epochcoef = nbtrainframes/float((cfg.train_batch_lengthmax*len(fid_lst_tra)))
+            print('    scale number of epochs wrt number of frames')
+            cfg.train_min_nbepochs = int(cfg.train_min_nbepochs*epochcoef)
+            cfg.train_max_nbepochs = int(cfg.train_max_nbepochs*epochcoef)
+            print('        train_min_nbepochs={}'.format(cfg.train_min_nbepochs))
+            print('        train_max_nbepochs={}'.format(cfg.train_max_nbepochs))
+
+        train_fn, train_validation_fn, critic_train_fn, critic_train_validation_fn = self.compile_functions(params, cfg)
+
         costs = defaultdict(list)
         epochs_modelssaved = []
         epochs_durs = []
@@ -434,8 +496,8 @@ class Optimizer:
 
         return cfg, hyperstr
 
-    def train_multipletrials(self, indir, outdir, wdir, fid_lst_tra, fid_lst_val, params, params_savefile, cfgtomerge=None, cont=None, **kwargs):
-        # Hyp: always uses batches
+    def train_configuration(self, cfgtomerge=None, **kwargs):
+        """Return the training configuration: the default values, overwritten by cfgtomerge and then by kwargs."""
 
         # All kwargs arguments are specific configuration values
         # First, fill a struct with the default configuration values ...
@@ -477,6 +539,49 @@ class Optimizer:
         # ... and add/overwrite specific configuration from the generic arguments
         for kwarg in kwargs.keys(): setattr(cfg, kwarg, kwargs[kwarg])
 
+        return cfg
+
+    def precompile(self, params, cfgtomerge=None, **kwargs):
+        """
+        Compile the training functions without training, in order to fill the
+        compile cache (see backend_theano.th_compilecache(.)) before the
+        training runs. The hyper-parameters which are constants of the graphs
+        (e.g. the learning rates) have to be the same as those of the training.
+        """
+        cfg = self.train_configuration(cfgtomerge, **kwargs)
+        self.compile_functions(params, cfg)
+
+    def profile(self, params, nbframes=None, nbiters=10, cfgtomerge=None, **kwargs):
+        """
+        Profile the time spent in each layer by the prediction function and the
+        training steps (generator and critic for WGAN), on random batches of
+        cfg.train_batch_size x nbframes (def. cfg.train_batch_lengthmax, or 2s).
+        The profiling mode has to be enabled before building the model (see
+        backend_theano.th_profile(.)). The parameters are modified by the
+        training steps.
+
+        Returns the list of the reports of backend_theano.th_profile_run(.)
+        """
+        cfg = self.train_configuration(cfgtomerge, **kwargs)
+        if nbframes is None: nbframes = cfg.train_batch_lengthmax if not cfg.train_batch_lengthmax is None else int(2.0/0.005)
+
+        train_fn, _, critic_train_fn, _ = self.compile_functions(params, cfg)
+
+        X = np.random.randn(cfg.train_batch_size, nbframes, self._model.insize).astype('float32')
+        Y = np.random.randn(cfg.train_batch_size, nbframes, self._model.vocoder.featuressize()).astype('float32')
+        reports = [th_profile_run(self._model.predict, [X], nbiters=nbiters)]
+        reports.append(th_profile_run(train_fn, [X, Y], nbiters=nbiters))
+        if self._errtype=='WGAN':
+            random_epsilon = np.random.uniform(size=(cfg.train_batch_size, 1,1)).astype('float32')
+            reports.append(th_profile_run(critic_train_fn, [X, Y, random_epsilon], nbiters=nbiters))
+
+        return reports
+
+    def train_multipletrials(self, indir, outdir, wdir, fid_lst_tra, fid_lst_val, params, params_savefile, cfgtomerge=None, cont=None, **kwargs):
+        # Hyp: always uses batches
+
+        cfg = self.train_configuration(cfgtomerge, **kwargs)
+
         print('Training configuration')
         cfg.print_content()
 
@@ -31,6 +31,7 @@ from percivaltts import *  # Always include this first to setup a few things for
 import data
 import vocoders
 import compose
+import model
 import models_cnn
 import models_generic
 import optimizer
@@ -61,6 +62,8 @@ labs_wpath = cp+lab_dir+'_weights/*.w:(-1,1)' # Ignore silences based on labs
 cfg.vocoder_fs = 16000
 cfg.vocoder_shift = 0.005
 cfg.vocoder_f0_min, cfg.vocoder_f0_max = 70, 600
+cfg.vocoder_analysis_nbproc = None  # Number of processes of the feature extraction (None for the number of CPUs)
+cfg.vocoder_analysis_segdur = None  # [s] WORLD only: analyse the long waveforms by segments of this duration (set vocoder_analysis_nbproc=1 to analyse the segments in parallel)
 
 vocoder = vocoders.VocoderPML(cfg.vocoder_fs, cfg.vocoder_shift, _spec_size=129, _nm_size=33)
 # vocoder = vocoders.VocoderWORLD(cfg.vocoder_fs, cfg.vocoder_shift, _spec_size=129, _aper_size=33)
@@ -101,6 +104,7 @@ cfg.model_nbfilters = 16        # CNN only 16
 cfg.model_spec_freqlen = 5      # [bins] CNN only 5
 cfg.model_noise_freqlen = 5     # [bins] CNN only 5
 cfg.model_windur = 0.025        # [s] 0.025/0.005=5 frames. CNN only 0.025
+cfg.model_f0vuv_arch = 'BLSTM'  # 'BLSTM' or 'DGCNN' (dilated gated CNN, faster on CPU). CNN only BLSTM
 
 # Training options
 cfg.fparams_fullset = 'model.pkl'
@@ -128,9 +132,9 @@ cfg.print_content()
 def pfs_map_vocoder(fid): return vocoder.analysisfid(fid, wav_path, cfg.vocoder_f0_min, cfg.vocoder_f0_max, {'f0':f0_path, 'spec':spec_path, 'noise':noise_path, 'vuv':vuv_path})
 def features_extraction():
 
-    # Use this tool for parallel extraction of the acoustic features ...
-    from external import pfs
-    pfs.map(pfs_map_vocoder, fids)
+    # Extract the acoustic features in parallel (the files already extracted are skipped) ...
+    failed = vocoders.analysisfids(vocoder, fids, wav_path, cfg.vocoder_f0_min, cfg.vocoder_f0_max, {'f0':f0_path, 'spec':spec_path, 'noise':noise_path, 'vuv':vuv_path}, nbproc=cfg.vocoder_analysis_nbproc, segdur=cfg.vocoder_analysis_segdur)
+    if len(failed)>0: raise ValueError('Feature extraction failed for {} files: {}'.format(len(failed), failed))  # pragma: no cover
 
     # ... or uncomment these line to extract them file by file.
     # for fid in fids: pfs_map_vocoder(fid)
@@ -151,22 +155,30 @@ def contexts_extraction():
     # Let's use Merlin's code for this
     from external.merlin.label_normalisation import HTSLabelNormalisation
     label_normaliser = HTSLabelNormalisation(question_file_name=lab_questions, add_frame_features=True, subphone_feats='full' if lab_type else 'coarse_coding') # coarse_coding or full
-    makedirs(os.path.dirname(labbin_path))
-    for fid in readids(cfg.fileids):
-        label_normaliser.perform_normalisation([lab_path.replace('*',fid)], [labbin_path.replace('*',fid)], label_type='state_align' if lab_type else 'phone_align') # phone_align or state_align
+
+    # Compose the inputs
+    # The binary labels, as they come from the NORMLAB Process of Merlin TTS pipeline https://github.com/CSTR-Edinburgh/merlin
+    # are passed in memory to the composition and normalisation (labbin_path is never written).
+    compose.compose_labels(label_normaliser, lab_path, fids, cfg.inpath, id_valid_start=cfg.id_valid_start, normfn=compose.normalise_minmax, label_type='state_align' if lab_type else 'phone_align') # phone_align or state_align
+    # ... or uncomment these lines to write the binary labels in labbin_path and compose them from there.
+    # makedirs(os.path.dirname(labbin_path))
+    # for fid in fids:
+    #     label_normaliser.perform_normalisation([lab_path.replace('*',fid)], [labbin_path.replace('*',fid)], label_type='state_align' if lab_type else 'phone_align')
+    # compose.compose([labbin_path+':(-1,'+str(in_size)+')'], fids, cfg.inpath, id_valid_start=cfg.id_valid_start, normfn=compose.normalise_minmax, wins=[], do_finalcheck=False)
 
     compose.create_weights_lab(lab_path, cfg.fileids, labs_wpath, silencesymbol='sil', shift=cfg.vocoder_shift)
 
-    # Compose the inputs
-    # The input files are binary labels, as they come from the NORMLAB Process of Merlin TTS pipeline https://github.com/CSTR-Edinburgh/merlin
-    compose.compose([labbin_path+':(-1,'+str(in_size)+')'], fids, cfg.inpath, id_valid_start=cfg.id_valid_start, normfn=compose.normalise_minmax, wins=[], do_finalcheck=False)
 
+def build_model(fparams=None):
+    # If fparams is given, the variants of the architecture are those saved with these parameters
+    f0vuv_arch = cfg.model_f0vuv_arch
+    if not fparams is None: f0vuv_arch = getattr(model.load_configuration(fparams), 'model_f0vuv_arch', 'BLSTM')  # Saved before the DGCNN option
 
-def build_model():
-    mod = models_cnn.ModelCNN(in_size, vocoder, hiddensize=cfg.model_hiddensize, ctx_nblayers=cfg.model_ctx_nblayers, ctx_nbfilters=cfg.model_ctx_nbfilters, ctx_winlen=cfg.model_ctx_winlen, nbcnnlayers=cfg.model_nbcnnlayers, nbfilters=cfg.model_nbfilters, spec_freqlen=cfg.model_spec_freqlen, noise_freqlen=cfg.model_noise_freqlen, windur=cfg.model_windur)
+    mod = models_cnn.ModelCNN(in_size, vocoder, hiddensize=cfg.model_hiddensize, ctx_nblayers=cfg.model_ctx_nblayers, ctx_nbfilters=cfg.model_ctx_nbfilters, ctx_winlen=cfg.model_ctx_winlen, nbcnnlayers=cfg.model_nbcnnlayers, nbfilters=cfg.model_nbfilters, spec_freqlen=cfg.model_spec_freqlen, noise_freqlen=cfg.model_noise_freqlen, windur=cfg.model_windur, f0vuv_arch=f0vuv_arch)
 
     # mod = models_generic.ModelGeneric(in_size, vocoder, mlpg_wins=mlpg_wins, layertypes=['FC', 'FC', 'FC', 'FC', 'FC', 'FC'], hiddensize=cfg.model_hiddensize)
     # mod = models_generic.ModelGeneric(in_size, vocoder, mlpg_wins=mlpg_wins, layertypes=['BLSTM', 'BLSTM', 'BLSTM'], hiddensize=cfg.model_hiddensize)
+    # mod = models_generic.ModelGeneric(in_size, vocoder, mlpg_wins=mlpg_wins, layertypes=['FC', 'BSRU', 'BSRU', 'BSRU'], hiddensize=cfg.model_hiddensize, critic_postlayertype='BQRNN')
     # mod = models_generic.ModelGeneric(in_size, vocoder, mlpg_wins=mlpg_wins, layertypes=[['CNN',cfg.model_ctx_nbfilters,cfg.model_ctx_winlen], 'FC', 'FC', 'FC', 'FC'], hiddensize=cfg.model_hiddensize)
 
     return mod
@@ -182,9 +194,38 @@ def training(cont=False):
     opti.train_multipletrials(cfg.inpath, cfg.outpath, cfg.wpath, fid_lst_tra, fid_lst_val, mod.params_trainable, cfg.fparams_fullset, cfgtomerge=cfg, cont=cont)
 
 
+def precompile():
+    # Compile the prediction and training functions without training, in order
+    # to fill the compile cache and start the training and generation warm.
+    # (set PERCIVALTTS_COMPILECACHE to the cache directory, see setenv.sh)
+    if os.getenv('PERCIVALTTS_COMPILECACHE') is None: raise ValueError('PERCIVALTTS_COMPILECACHE is not set, there is no compile cache to fill')    # pragma: no cover
+    from backend_theano import th_compilecache_report
+
+    mod = build_model()
+
+    opti = optimizer.Optimizer(mod, errtype='WGAN' if use_WGAN else 'LSE') # 'WGAN' or 'LSE'
+    opti.precompile(mod.params_trainable, cfgtomerge=cfg)
+
+    for report in th_compilecache_report():
+        print_log('    {}: {} start {:.2f}s (cold start {:.2f}s)'.format(report['name'], report['start'], report['time'], report['coldtime']))
+
+
+def profile():
+    # Report the time spent in each layer by the prediction and training
+    # functions, in order to see which part of the architecture to speed up.
+    from backend_theano import th_profile, th_profile_print
+    th_profile(True)
+
+    mod = build_model()
+
+    opti = optimizer.Optimizer(mod, errtype='WGAN' if use_WGAN else 'LSE') # 'WGAN' or 'LSE'
+    reports = opti.profile(mod.params_trainable, cfgtomerge=cfg)
+    th_profile_print(reports, os.path.splitext(cfg.fparams_fullset)[0]+'-profile.json')
+
+
 def generate(fparams=cfg.fparams_fullset):
 
-    mod = build_model()           # Rebuild the model from scratch
+    mod = build_model(fparams)    # Rebuild the model from scratch
     mod.loadAllParams(fparams)    # Load the model's parameters
 
     # Generate the network outputs (without any decomposition), for potential re-use for another network's input
@@ -199,8 +240,46 @@ def generate(fparams=cfg.fparams_fullset):
     # mod.generate_wav(cfg.inpath, cfg.outpath, fid_lst_test, os.path.splitext(fparams)[0]+'-snd', vocoder, wins=mlpg_wins, do_objmeas=True, do_resynth=True, pp_mcep=pp_mcep)
 
 
+def export_inference(fparams=cfg.fparams_fullset):
+    # Export the trained network for the NumPy runtime (see inference.py),
+    # in order to predict on CPU without Theano, nor compilation.
+    mod = build_model(fparams)    # Rebuild the model from scratch
+    mod.loadAllParams(fparams)    # Load the model's parameters
+    mod.export_inference(os.path.splitext(fparams)[0]+'-inference.pkl')
+
+
+def quantise(fparams=cfg.fparams_fullset):
+    # Save the weights in int8 for a compact serving and report the RMSE
+    # w.r.t. the float model on the validation set
+    mod = build_model(fparams)    # Rebuild the model from scratch
+    fid_lst_val = fids[cfg.id_valid_start:cfg.id_valid_start+cfg.id_valid_nb]
+    mod.quantise(fparams, os.path.splitext(fparams)[0]+'-int8.pkl', cfg.inpath, cfg.outpath, fid_lst_val)
+
+
+def serve(fparams=cfg.fparams_fullset, address=('localhost', 8765)):
+    # Keep the model loaded and synthesise on request (see server.py)
+    import server
+    from external.merlin.label_normalisation import HTSLabelNormalisation
+    label_normaliser = HTSLabelNormalisation(question_file_name=lab_questions, add_frame_features=True, subphone_feats='full' if lab_type else 'coarse_coding')
+
+    mod = build_model(fparams)    # Rebuild the model from scratch
+    mod.loadAllParams(fparams)    # Load the model's parameters
+
+    ttsserver = server.TTSServer(mod, vocoder, os.path.dirname(cfg.outpath), wins=mlpg_wins, pp_mcep=pp_mcep, label_normaliser=label_normaliser, instatsdir=os.path.dirname(cfg.inpath), label_type='state_align' if lab_type else 'phone_align')
+    ttsserver.serve(address)    # address can also be the path of a Unix socket
+
+
 if  __name__ == "__main__" :                                 # pragma: no cover
+    if '--precompile' in sys.argv:
+        precompile()    # Only fill the compile cache
+        sys.exit(0)
+    if '--profile' in sys.argv:
+        profile()       # Only report the time spent in each layer
+        sys.exit(0)
     features_extraction()
     contexts_extraction()
     training(cont='--continue' in sys.argv)
     generate()
+    # export_inference()    # To predict with NumPy only (see inference.py)
+    # quantise()            # To serve with int8 weights (see Model.quantise(.))
+    # serve()   # Instead of generate(), keep the model loaded to synthesise on request
@@ -0,0 +1,307 @@
+'''
+A persistent local server for the synthesis with a trained model.
+
+The model is built, compiled and loaded once, along with its vocoder, and then
+serves the synthesis requests sent over a local HTTP socket (TCP or Unix
+socket). The requests that arrive at the same time are predicted together in
+batches (see Batcher).
+
+Requests (POST):
+    /cmp    Returns the de-normalised output features (raw float32, with the
+            shape in the X-Shape header).
+    /wav    Returns the synthesised waveform (float32 wav file).
+    The body of the request is either the normalised input labels (raw
+    float32, Content-Type: application/octet-stream, as the files of the
+    input directory) or an HTS label file (Content-Type: text/plain), which is
+    then normalised using the statistics of the training data.
+
+    GET /status returns a few statistics about the batches in JSON.
+
+Copyright(C) 2017 Engineering Department, University of Cambridge, UK.
+
+License
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+     http://www.apache.org/licenses/LICENSE-2.0
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Author
+    Gilles Degottex <gad27@cam.ac.uk>
+'''
+
+from __future__ import print_function
+
+from percivaltts import *  # Always include this first to setup a few things
+
+import os
+import time
+import json
+import threading
+import Queue
+import BaseHTTPServer
+import SocketServer
+
+import numpy as np
+numpy_force_random_seed()
+
+import compose
+import labels
+import model
+
+
+class _Request:
+    def __init__(self, X):
+        self.X = X
+        self.Y = None
+        self.error = None
+        self.timestart = time.time()
+        self.done = threading.Event()
+
+
+class Batcher:
+    """
+    Dynamic batching of the predictions of a model.
+
+    The requests are queued and a single thread (the only one calling the model)
+    predicts the pending requests together, using Model.predict_padded(.).
+    A batch is closed when adding the next request would make it bigger than
+    framebudget frames (including the padding, i.e. the number of requests
+    times the longest one) or when its first request has waited maxlatency
+    seconds.
+    """
+
+    def __init__(self, predict_padded, framebudget=4000, maxlatency=0.02):
+        self._predict_padded = predict_padded
+        self.framebudget = framebudget
+        self.maxlatency = maxlatency
+
+        self._queue = Queue.Queue()
+        self._held = None   # The request that did not fit in the previous batch
+
+        self.nbrequests = 0
+        self.nbbatches = 0
+        self.nbframes = 0
+        self.nbpaddedframes = 0
+
+        self._thread = threading.Thread(target=self._run, name='Batcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def predict(self, X):
+        """Predict the outputs of the input matrix X [frames x insize] (blocks until done)."""
+        req = _Request(X)
+        self._queue.put(req)
+        req.done.wait()
+        if not req.error is None: raise req.error
+        return req.Y
+
+    def _nextbatch(self):
+        if self._held is None: batch = [self._queue.get()]
+        else:                  batch, self._held = [self._held], None
+        maxlen = batch[0].X.shape[0]
+        deadline = batch[0].timestart + self.maxlatency
+        while True:
+            timeout = deadline - time.time()
+            if timeout<=0.0: break
+            try:
+                req = self._queue.get(timeout=timeout)
+            except Queue.Empty:
+                break
+            if (len(batch)+1)*max(maxlen, req.X.shape[0])>self.framebudget:
+                self._held = req
+                break
+            batch.append(req)
+            maxlen = max(maxlen, req.X.shape[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._nextbatch()
+            try:
+                Ys = self._predict_padded([req.X for req in batch])
+                for req, Y in zip(batch, Ys): req.Y = Y
+            except Exception as e:                              # pragma: no cover
+                for req in batch: req.error = e
+            self.nbrequests += len(batch)
+            self.nbbatches += 1
+            self.nbframes += sum([req.X.shape[0] for req in batch])
+            self.nbpaddedframes += len(batch)*max([req.X.shape[0] for req in batch])
+            for req in batch: req.done.set()
+
+    def stats(self):
+        return {'nbrequests':self.nbrequests, 'nbbatches':self.nbbatches, 'nbframes':self.nbframes, 'nbpaddedframes':self.nbpaddedframes}
+
+
+class TTSServer:
+    """
+    Keeps a trained model and its vocoder in memory and synthesises on request.
+
+    Parameters
+    ----------
+    mod :           The model (e.g. ModelCNN or ModelGeneric), whose parameters are already loaded.
+    vocoder :       The vocoder used to synthesise the waveforms.
+    outstatsdir :   The directory of the output features, where are mean4norm.dat and std4norm.dat.
+    label_normaliser : Object providing extract_linguistic_features(.), e.g.
+                    external.merlin.label_normalisation.HTSLabelNormalisation
+                    (needed only for requests with HTS label files).
+    instatsdir :    The directory of the normalised input labels, where are
+                    min4norm.dat, max4norm.dat (and keepidx.dat, if any).
+    """
+
+    def __init__(self, mod, vocoder, outstatsdir, wins=[], pp_mcep=False, label_normaliser=None, instatsdir=None, label_type='state_align', framebudget=4000, maxlatency=0.02, mlpg_chunksize=-1, mlpg_lookahead=50):
+        self.mod = mod
+        self.vocoder = vocoder
+        self.wins = wins
+        self.pp_mcep = pp_mcep
+        self.label_normaliser = label_normaliser
+        self.label_type = label_type
+        self._labels_lock = threading.Lock()    # The label normaliser is shared by the threads of the HTTP server
+
+        Ymean = np.fromfile(outstatsdir+'/mean4norm.dat', dtype='float32')
+        Ystd = np.fromfile(outstatsdir+'/std4norm.dat', dtype='float32')
+        self._opts = {'Ymean':Ymean, 'Ystd':Ystd, 'mlpg_chunksize':mlpg_chunksize, 'mlpg_lookahead':mlpg_lookahead}
+
+        self._inmins = None
+        self._inmaxs = None
+        self._inkeepidx = None
+        if not instatsdir is None:
+            self._inmins = np.fromfile(instatsdir+'/min4norm.dat', dtype='float32')
+            self._inmaxs = np.fromfile(instatsdir+'/max4norm.dat', dtype='float32')
+            if os.path.isfile(instatsdir+'/keepidx.dat'): self._inkeepidx=np.fromfile(instatsdir+'/keepidx.dat', dtype='int32')
+
+        self.batcher = Batcher(mod.predict_padded, framebudget=framebudget, maxlatency=maxlatency)
+
+    def labels2input(self, labtext):
+        """Compute the normalised input of the model from the content of an HTS label file."""
+        import tempfile
+        if self.label_normaliser is None or self._inmins is None: raise ValueError('No label normaliser or input statistics given to the server, it cannot process HTS label files')
+
+        fd, flab = tempfile.mkstemp(prefix='percivaltts_', suffix='.lab')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(labtext)
+            with self._labels_lock:
+                X = self.label_normaliser.extract_linguistic_features(flab, None, label_type=self.label_type)
+        finally:
+            labels.forget(flab)     # Don't keep the parse of each request, nor re-use it for another file of the same name
+            os.remove(flab)
+
+        if not self._inkeepidx is None: X=X[:,self._inkeepidx]
+        return compose.normalise_minmax_apply(X.astype('float32'), self._inmins, self._inmaxs).astype('float32')
+
+    def generate_cmp(self, X):
+        """Predict and de-normalise the output features (MLPG included) of the normalised input X."""
+        return np.concatenate(list(self._generate_cmp_chunks(X)))
+
+    def _generate_cmp_chunks(self, X):
+        if X.ndim!=2 or X.shape[1]!=self.mod.insize: raise ValueError('The input has to be of shape [frames x {}] (got {})'.format(self.mod.insize, X.shape))
+        if X.shape[0]==0: raise ValueError('The input is empty')
+        CMP = self.batcher.predict(X)
+        return model._generate_wav_denormalise_chunks(CMP, self.vocoder, self._opts, wins=self.wins)
+
+    def generate_wav(self, X):
+        """
+        Synthesise the waveform of the normalised input X.
+        If the MLPG is solved by chunks (mlpg_chunksize>0), each chunk is
+        synthesised as soon as it is solved (see Vocoder.synthesis_stream(.)).
+        """
+        if len(self.wins)>0 and self._opts['mlpg_chunksize']>0:
+            return np.concatenate(list(self.vocoder.synthesis_stream(self.vocoder.fs, self._generate_cmp_chunks(X), pp_mcep=self.pp_mcep)))
+        CMP = self.generate_cmp(X)
+        return self.vocoder.synthesis(self.vocoder.fs, CMP, pp_mcep=self.pp_mcep)
+
+    def serve(self, address=('localhost', 8765)):
+        """
+        Serve the requests until interrupted.
+
+        Parameters
+        ----------
+        address : (host, port) for a TCP socket, or a file path for a Unix socket.
+        """
+        httpd = make_httpserver(self, address)
+        print_log('Serving on {}'.format(address))
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:                               # pragma: no cover
+            pass
+        finally:
+            httpd.server_close()
+            if isinstance(address, str) and os.path.exists(address): os.remove(address)
+
+
+class _HTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ttsserver = None
+
+    def address_string(self):
+        return str(self.client_address)  # Also for Unix sockets, which have no (host, port)
+
+    def log_message(self, format, *args):
+        print('{} {}'.format(self.address_string(), format%args))
+
+    def _reply(self, body, contenttype, headers=None):
+        self.send_response(200)
+        self.send_header('Content-Type', contenttype)
+        self.send_header('Content-Length', str(len(body)))
+        if not headers is None:
+            for key in headers: self.send_header(key, headers[key])
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path!='/status':
+            self.send_error(404, 'Unknown request {}'.format(self.path))
+            return
+        self._reply(json.dumps(self.ttsserver.batcher.stats()), 'application/json')
+
+    def do_POST(self):
+        import io
+        from scipy.io import wavfile
+
+        if not self.path in ['/cmp', '/wav']:
+            self.send_error(404, 'Unknown request {}'.format(self.path))
+            return
+        try:
+            body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+            if self.headers.getheader('Content-Type', '').startswith('text/plain'):
+                X = self.ttsserver.labels2input(body)
+            else:
+                X = np.frombuffer(body, dtype='float32')
+                if X.size%self.ttsserver.mod.insize!=0: raise ValueError('The size of the input ({} values) is not a multiple of the input size {}'.format(X.size, self.ttsserver.mod.insize))
+                X = X.reshape((-1, self.ttsserver.mod.insize))
+
+            if self.path=='/cmp':
+                CMP = self.ttsserver.generate_cmp(X).astype('float32')
+                self._reply(CMP.tobytes(), 'application/octet-stream', {'X-Shape':'{},{}'.format(*CMP.shape)})
+            else:
+                wav = self.ttsserver.generate_wav(X)
+                fwav = io.BytesIO()
+                wavfile.write(fwav, self.ttsserver.vocoder.fs, wav.astype('float32'))
+                self._reply(fwav.getvalue(), 'audio/wav')
+
+        except ValueError as e:
+            self.send_error(400, str(e))
+        except Exception as e:
+            self.log_error('Request %s failed: %r', self.path, e)
+            self.send_error(500, 'Internal error: {}'.format(e.__class__.__name__))
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class _ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+def make_httpserver(ttsserver, address):
+    """Create the HTTP server of a TTSServer (see TTSServer.serve(.)) on a TCP socket (host, port) or a Unix socket (file path)."""
+    class HTTPRequestHandler(_HTTPRequestHandler): pass
+    HTTPRequestHandler.ttsserver = ttsserver
+    if isinstance(address, str):
+        if os.path.exists(address): os.remove(address)
+        return _ThreadingUnixHTTPServer(address, HTTPRequestHandler)
+    else:
+        return _ThreadingHTTPServer(address, HTTPRequestHandler)
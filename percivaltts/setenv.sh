@@ -43,6 +43,12 @@ if [ "$HOSTNAME" == "mila" ]; then
     export THEANO_FLAGS="base_compiledir=/dev/shm/$USERNAME,"$THEANO_FLAGS
 fi
 
+# Persistent cache of the compiled functions (see backend_theano.th_function).
+# The cached functions refer to the C modules of base_compiledir, so put both
+# in the same shared directory, and fill it once with `run.py --precompile`.
+# export PERCIVALTTS_COMPILECACHE=/path/to/shared/dir/percivaltts_functions
+# export THEANO_FLAGS="base_compiledir=/path/to/shared/dir/theano,"$THEANO_FLAGS
+
 unset LD_PRELOAD
 
 echo "Run command: "$@
@@ -68,6 +68,24 @@ class TestBase(unittest.TestCase):
             # pulsemodel.analysisf(wav_path.replace('*',fid), f0_min=cfg.vocoder_f0_min, f0_max=cfg.vocoder_f0_max, ff0=f0_path.replace('*',fid), f0_log=True,
             # fspec=spec_fw_path.replace('*',fid), spec_nbfwbnds=spec_size, fnm=nm_path.replace('*',fid), nm_nbfwbnds=nm_size, verbose=1)
 
+        # All already extracted above
+        failed = vocoders.analysisfids(vocoder_pml, fids, wav_path, cfg.vocoder_f0_min, cfg.vocoder_f0_max, {'f0':f0_path, 'spec':spec_fw_path, 'noise':nm_path}, nbproc=2)
+        self.assertTrue(len(failed)==0)
+        failed = vocoders.analysisfids(vocoder_world, fids[:2], wav_path, cfg.vocoder_f0_min, cfg.vocoder_f0_max, {'f0':'tests/test_made__base_analysisfids/*.lf0', 'spec':'tests/test_made__base_analysisfids/*.fwlspec', 'noise':'tests/test_made__base_analysisfids/*.fwdbaper', 'vuv':'tests/test_made__base_analysisfids/*.vuv'}, nbproc=2, resume=False)
+        self.assertTrue(len(failed)==0)
+        # The same analysis is cached, but not with different analysis parameters
+        world_outputpathdicts = {'f0':'tests/test_made__base_analysisfids/*.lf0', 'spec':'tests/test_made__base_analysisfids/*.fwlspec', 'noise':'tests/test_made__base_analysisfids/*.fwdbaper', 'vuv':'tests/test_made__base_analysisfids/*.vuv'}
+        self.assertTrue(vocoder_world.analysisfid_iscached(fids[0], wav_path, cfg.vocoder_f0_min, cfg.vocoder_f0_max, world_outputpathdicts))
+        self.assertFalse(vocoder_world.analysisfid_iscached(fids[0], wav_path, cfg.vocoder_f0_min, cfg.vocoder_f0_max+10, world_outputpathdicts))
+        # Segment-parallel analysis of the long waveforms
+        failed = vocoders.analysisfids(vocoder_world, fids[:2], wav_path, cfg.vocoder_f0_min, cfg.vocoder_f0_max, {'f0':'tests/test_made__base_analysisfids_segments/*.lf0', 'spec':'tests/test_made__base_analysisfids_segments/*.fwlspec', 'noise':'tests/test_made__base_analysisfids_segments/*.fwdbaper', 'vuv':'tests/test_made__base_analysisfids_segments/*.vuv'}, nbproc=1, resume=False, segdur=0.5)
+        self.assertTrue(len(failed)==0)
+        for fid in fids[:2]:
+            self.assertEqual(os.path.getsize('tests/test_made__base_analysisfids_segments/'+fid+'.fwlspec'), os.path.getsize('tests/test_made__base_analysisfids/'+fid+'.fwlspec'))
+        segments_outputpathdicts = {'f0':'tests/test_made__base_analysisfids_segments/*.lf0', 'spec':'tests/test_made__base_analysisfids_segments/*.fwlspec', 'noise':'tests/test_made__base_analysisfids_segments/*.fwdbaper', 'vuv':'tests/test_made__base_analysisfids_segments/*.vuv'}
+        self.assertTrue(vocoder_world.analysisfid_iscached(fids[0], wav_path, cfg.vocoder_f0_min, cfg.vocoder_f0_max, segments_outputpathdicts, segdur=0.5))
+        self.assertFalse(vocoder_world.analysisfid_iscached(fids[0], wav_path, cfg.vocoder_f0_min, cfg.vocoder_f0_max, segments_outputpathdicts))
+
 
         import compose
 
@@ -101,6 +101,11 @@ class TestSmoke(unittest.TestCase):
 
         Xs_w_stop = data.addstop(Xs)
 
+        batches = data.batches_bylength([X.shape[0] for X in Xs], 2000)
+        self.assertEqual(sorted(sum(batches, [])), range(len(Xs)))
+        for batch in batches:
+            self.assertTrue(len(batch)==1 or len(batch)*max([Xs[vi].shape[0] for vi in batch])<=2000)
+
         X_train, MX_train, Y_train, MY_train, W_train = data.load_inoutset(indir, outdir, wdir, fids, length=None, lengthmax=100, maskpadtype='randshift', inouttimesync=False)
         X_train, MX_train, Y_train, MY_train, W_train = data.load_inoutset(indir, outdir, wdir, fids, length=None, lengthmax=100, maskpadtype='randshift')
         X_train, MX_train, Y_train, MY_train, W_train = data.load_inoutset(indir, outdir, wdir, fids, length=None, lengthmax=100, maskpadtype='randshift', cropmode='begendbigger')
@@ -133,6 +138,236 @@ class TestSmoke(unittest.TestCase):
         rms = data.prediction_rms(mod, [Xs])
         print(rms)
 
+    def test_labels(self):
+        import labels
+
+        fids = readids(cptest+'file_id_list.scp')
+
+        flab = cptest+'label_state_align/'+fids[0]+'.lab'
+        segs, labstrs = labels.parse(flab)
+        self.assertTrue(len(segs)==len(filter(None, map(str.strip, open(flab).readlines()))))
+        self.assertTrue(segs['state'].min()==2 and segs['state'].max()==6)
+        self.assertTrue(len(labstrs)*5==len(segs))  # 5 states per phone
+        self.assertTrue(labels.phones(labstrs)[0]=='sil')
+
+        labels.clear_cache()
+        segs2, labstrs2 = labels.load(flab, cachedir='tests/test_made__smoke_labels_cache')
+        self.assertTrue((segs==segs2).all() and labstrs==labstrs2)
+        labels.clear_cache()
+        segs3, labstrs3 = labels.load(flab, cachedir='tests/test_made__smoke_labels_cache') # From the binary cache
+        self.assertTrue((segs==segs3).all() and labstrs==labstrs3)
+        segs4, _ = labels.load(flab)                                                        # From memory
+        self.assertTrue(segs4 is segs3)
+        labels.forget(flab)
+        self.assertFalse(labels.load(flab)[0] is segs3)                                     # Parsed again
+        # The cache is bounded
+        cache_maxsize = labels.cache_maxsize
+        labels.cache_maxsize = 1
+        labels.load(cptest+'label_state_align/'+fids[1]+'.lab')
+        self.assertEqual(len(labels._cache), 1)
+        labels.cache_maxsize = cache_maxsize
+        # Label files of the same name in different directories, with labels containing spaces
+        for d, content in [('a', '0 50000 sil[2]\n50000 100000 a b[3]\n'), ('b', '  0 50000 x y z \r\n\n')]:
+            makedirs('tests/test_made__smoke_labels_samename/'+d)
+            with open('tests/test_made__smoke_labels_samename/'+d+'/same.lab', 'w') as f: f.write(content)
+        labels.clear_cache()
+        segsa, labstrsa = labels.load('tests/test_made__smoke_labels_samename/a/same.lab', cachedir='tests/test_made__smoke_labels_cache')
+        labels.clear_cache()
+        segsb, labstrsb = labels.load('tests/test_made__smoke_labels_samename/b/same.lab', cachedir='tests/test_made__smoke_labels_cache')
+        self.assertEqual(labstrsa, ['sil', 'a b'])
+        self.assertEqual(list(segsa['state']), [2, 3])
+        self.assertEqual(labstrsb, ['x y z'])
+        self.assertEqual(list(segsb['end']), [50000])
+
+        self.assertTrue(labels.nbframes(segs)==int(np.ceil(segs['end'][-1]*1e-7/0.005)))
+
+    def test_checkpoint(self):
+        import checkpoint
+        from collections import defaultdict
+
+        cfg = configuration()
+        cfg.train_hypers = [('train_learningrate_log10', -6.0, -2.0)]
+        cfg.fileids = cptest+'file_id_list.scp'
+        costs = defaultdict(list)
+        costs['model_validation'].append(1.5)
+        rng = np.random.RandomState(123)
+        tensors = [('W', rng.randn(lab_size, 8).astype('float32')), ('b', rng.randn(8).astype('float32')), ('W', rng.randn(8, 3).astype('float32'))]
+
+        fckpt = 'tests/test_made__smoke_checkpoint/params.pkl'
+        checkpoint.save(fckpt, tensors, {'cfg':cfg, 'extras':{'cost_val':np.float32(67.43), 'costs':costs}, 'rngstate':np.random.get_state()})
+        self.assertTrue(checkpoint.ischeckpoint(fckpt))
+        tensors_loaded, meta = checkpoint.load(fckpt)
+        for (name, value), (name_loaded, value_loaded) in zip(tensors, tensors_loaded):
+            self.assertEqual(name, name_loaded)
+            self.assertTrue(np.array_equal(value, value_loaded))
+        self.assertEqual(cfg, meta['cfg'])
+        self.assertEqual(meta['extras']['cost_val'], np.float32(67.43))
+        self.assertEqual(meta['extras']['costs'], costs)
+        self.assertTrue(np.array_equal(meta['rngstate'][1], np.random.get_state()[1]))
+
+        # The permissions are those of a new file, or those of the replaced file
+        import stat
+        umask = os.umask(0)
+        os.umask(umask)
+        os.remove(fckpt)
+        checkpoint.save(fckpt, tensors)
+        self.assertEqual(stat.S_IMODE(os.stat(fckpt).st_mode), 0o666 & ~umask)
+        os.chmod(fckpt, 0o640)
+        checkpoint.save(fckpt, tensors)
+        self.assertEqual(stat.S_IMODE(os.stat(fckpt).st_mode), 0o640)
+
+        # Non-unique names are matched by position, unique names by name (also partially)
+        self.assertEqual([ni for ni, _ in checkpoint.match(['W', 'b', 'W'], tensors_loaded)], [0, 1, 2])
+        self.assertEqual([ni for ni, _ in checkpoint.match(['c', 'b'], tensors_loaded[1:2])], [1])
+        self.assertEqual([ni for ni, _ in checkpoint.match(['W', 'b', 'W'], tensors_loaded, regexp='^b$')], [1])
+
+        # Quantisation in int8 per channel
+        tensors_quantised, quantised = checkpoint.quantise(tensors_loaded, {'W':1})
+        self.assertEqual(len(tensors_quantised), len(tensors)+2)
+        tensors_dequantised = checkpoint.dequantise(tensors_quantised, quantised)
+        for (name, value), (name_dequantised, value_dequantised) in zip(tensors, tensors_dequantised):
+            self.assertEqual(name, name_dequantised)
+            self.assertTrue(np.allclose(value, value_dequantised, atol=np.max(abs(value))/127.0))
+
+    def test_mlpg(self):
+        from external.merlin.mlpg_fast import MLParameterGenerationFast
+
+        rng = np.random.RandomState(123)
+        features = rng.randn(200, 3*nm_size)
+        covariance = rng.rand(200, 3*nm_size)+0.1
+
+        mlpg = MLParameterGenerationFast(batch_size=1024)   # Force multiple batches
+        gen_perdim = mlpg.generation_perdim(features, covariance, nm_size)
+        gen = mlpg.generation(features, covariance, nm_size)
+        self.assertTrue(gen.shape==(200, nm_size))
+        self.assertTrue(np.allclose(gen, gen_perdim))
+        gen = mlpg.generation(features, covariance, nm_size)    # With the window matrices from the cache
+        self.assertTrue(np.allclose(gen, gen_perdim))
+
+        features = np.cumsum(features, axis=0)
+        gen = mlpg.generation(features, covariance, nm_size)
+        gen_chunks = np.concatenate(list(mlpg.generation_chunks(features, covariance, nm_size, chunk_size=64, lookahead=40, crossfade=10)))
+        self.assertTrue(gen_chunks.shape==gen.shape)
+        C, lam = mlpg.decay_bound(covariance, nm_size)
+        self.assertTrue((lam<1.0).all())
+        self.assertTrue(np.abs(gen_chunks-gen).max()<1e-3*np.abs(gen).max())
+
+    def test_mcep_postproc(self):
+        import external.merlin.generate_pp
+
+        rng = np.random.RandomState(123)
+        mcep = rng.randn(20, 40)*np.exp(-np.arange(40)/8.0)
+        mcep[:,0] -= 3.0
+
+        mcep_pp = external.merlin.generate_pp.mcep_postproc(mcep, 16000, dftlen=4096)
+        self.assertTrue(mcep_pp.shape==mcep.shape)
+        self.assertTrue(np.allclose(mcep_pp[:,2:], 1.4*mcep[:,2:], atol=1e-5))
+
+        mcep_pp = external.merlin.generate_pp.mcep_postproc(mcep, 16000, dftlen=4096, pf_coef=1.0)   # No post-filter
+        self.assertTrue(np.allclose(mcep_pp, mcep, atol=1e-5))
+
+    def test_vocoders_bndops(self):
+        import vocoders
+        from external.pulsemodel import sigproc as sp
+
+        rng = np.random.RandomState(123)
+        X = rng.randn(20, 4096/2+1)
+        Z = vocoders.linbnd2fwbnd(X, 16000, 4096, spec_size)
+        self.assertTrue(np.allclose(Z, sp.linbnd2fwbnd(X, 16000, 4096, spec_size)))
+        Z = rng.randn(20, nm_size)
+        for smooth in [False, True]:
+            X = vocoders.fwbnd2linbnd(Z, 16000, 4096, smooth=smooth)
+            self.assertTrue(np.allclose(X, sp.fwbnd2linbnd(Z, 16000, 4096, smooth=smooth)))
+            X = vocoders.fwbnd2linbnd(Z, 16000, 4096, smooth=smooth)   # From the cache
+            self.assertTrue(np.allclose(X, sp.fwbnd2linbnd(Z, 16000, 4096, smooth=smooth)))
+
+    def test_vocoders_preprocwav(self):
+        import vocoders
+
+        fids = readids(cptest+'file_id_list.scp')
+
+        vocoder = vocoders.VocoderWORLD(16000, 0.005, spec_size, nm_size)
+        wav = np.random.RandomState(123).randn(32000).astype(np.float32)
+        wavrs = vocoder.preprocwav(wav, 32000, highpass=70.0)
+        self.assertEqual(wavrs.shape, (16000,))
+        self.assertEqual(wavrs.dtype, np.float32)
+        vocoder.preprocwav(wav, 32000, highpass=70.0)   # From the cache
+        self.assertTrue((1, 2, np.dtype(np.float32)) in vocoders._resample_kernels)
+        self.assertTrue((16000, 70.0) in vocoders._highpass_filters)
+        # The cut-off is relative to the Nyquist frequency
+        ts = np.arange(16000)/16000.0
+        self.assertTrue(np.std(vocoders.highpass_filter(np.sin(2*np.pi*35.0*ts), 16000, 70.0)[4000:-4000])<0.01)
+        self.assertTrue(np.std(vocoders.highpass_filter(np.sin(2*np.pi*280.0*ts), 16000, 70.0)[4000:-4000])>0.99*np.sqrt(0.5))
+
+        for wav in vocoder.preprocwavs([cptest+'wav/'+fid+'.wav' for fid in fids[:2]], highpass=70.0):
+            self.assertTrue(np.all(np.isfinite(wav)))
+
+    def test_vocoders_objmeasures(self):
+        import pickle
+        import vocoders
+
+        rng = np.random.RandomState(123)
+        CMPs = [rng.rand(100+10*n, 1+spec_size+nm_size+1)+0.1 for n in range(4)]
+        REFs = [rng.rand(100+10*n, 1+spec_size+nm_size+1)+0.1 for n in range(4)]
+
+        vocoder = vocoders.VocoderWORLD(16000, 0.005, spec_size, nm_size)
+        for CMP, REF in zip(CMPs, REFs): vocoder.objmeasures_add(CMP, REF)
+        report = vocoder.objmeasures_stats('tests/test_made__smoke_vocoders_objmeasures/objmeasures.json')
+        self.assertEqual(report['SPEC[dB]']['nbutts'], 4)
+
+        # The accumulators are per instance and mergeable
+        vocoder2 = vocoders.VocoderWORLD(16000, 0.005, spec_size, nm_size)
+        self.assertEqual(len(vocoder2.features_err.report()), 0)
+        vocoder3 = pickle.loads(pickle.dumps(vocoder2))
+        for n, (CMP, REF) in enumerate(zip(CMPs, REFs)):
+            (vocoder2 if n%2 else vocoder3).objmeasures_add(CMP, REF)
+        vocoder2.objmeasures_merge(vocoder3.features_err)
+        report2 = vocoder2.features_err.report()
+        for key in report:
+            self.assertTrue(np.allclose(report[key]['uttrmse_perdim'], report2[key]['uttrmse_perdim']))
+            self.assertTrue(np.allclose(report[key]['rmse_perdim'], report2[key]['rmse_perdim']))
+
+    def test_vocoders_synthesis_stream(self):
+        import data
+        import vocoders
+
+        fids = readids(cptest+'file_id_list.scp')
+
+        wav_dir = 'wav'
+        CMP = np.hstack([data.loadfile(path, fids[0]) for path in [cptest+wav_dir+'_world_lf0/*.lf0:(-1,1)', cptest+wav_dir+'_world_fwlspec/*.fwlspec:(-1,'+str(spec_size)+')', cptest+wav_dir+'_world_fwdbaper/*.fwdbaper:(-1,'+str(nm_size)+')', cptest+wav_dir+'_world_vuv/*.vuv:(-1,1)']])
+
+        vocoder = vocoders.VocoderWORLD(16000, 0.005, spec_size, nm_size)
+        syn = vocoder.synthesis(vocoder.fs, CMP)
+        syn_stream = np.concatenate(list(vocoder.synthesis_stream(vocoder.fs, CMP, blocksize=100, overlap=4)))
+        self.assertTrue(len(syn_stream)==len(syn))
+        # The first block is the same as the whole synthesis, away from its end
+        hop = int(round(vocoder.shift*vocoder.fs))
+        self.assertTrue(np.allclose(syn_stream[:50*hop], syn[:50*hop]))
+        # The next ones are synthesised independently, thus they are the same
+        # up to the phase of the periodic component (a lag of at most a period)
+        maxlag = int(vocoder.fs/np.exp(np.min(CMP[:,0])))
+        for b0 in xrange(100, CMP.shape[0]-100, 100):
+            t0, t1 = (b0+45)*hop, (b0+55)*hop   # The middle of the block
+            ref = syn[t0:t1]
+            xcorr = [np.dot(ref, syn_stream[t0+lag:t1+lag])/np.sqrt(np.sum(ref**2)*np.sum(syn_stream[t0+lag:t1+lag]**2)) for lag in xrange(-maxlag, maxlag+1)]
+            self.assertTrue(np.max(xcorr)>0.95)
+        syn_stream = np.concatenate(list(vocoder.synthesis_stream(vocoder.fs, [CMP[:50], CMP[50:51], CMP[51:]], overlap=4)))
+        self.assertTrue(len(syn_stream)==len(syn))
+
+    def test_vocoders_world_analysis_segments(self):
+        import vocoders
+        from external.pulsemodel import sigproc as sp
+
+        fids = readids(cptest+'file_id_list.scp')
+
+        wav, fs, _ = sp.wavread(cptest+'wav/'+fids[0]+'.wav')
+        vocoder = vocoders.VocoderWORLD(fs, 0.005, spec_size, nm_size)
+        f0, SPEC, APER = vocoder.world_analysis(wav, fs, 60, 600)
+        f0s, SPECs, APERs = vocoder.world_analysis_segments(wav, fs, 60, 600, segdur=1.0, nbproc=2)
+        self.assertTrue(f0s.shape==f0.shape and SPECs.shape==SPEC.shape and APERs.shape==APER.shape)
+        self.assertTrue(((f0>0)==(f0s>0)).mean()>0.99)
+        self.assertTrue(np.median(np.abs(sp.mag2db(SPECs)-sp.mag2db(SPEC)))<0.1)
+
     def test_compose(self):
         import data
         import compose
@@ -150,6 +385,18 @@ class TestSmoke(unittest.TestCase):
 
         path2, shape2 = data.getpathandshape('tests/test_made__smoke_compose_compose_lab1/*.lab:(mean.dat,'+str(lab_size)+')')
 
+        from external.merlin.label_normalisation import HTSLabelNormalisation
+        label_normaliser = HTSLabelNormalisation(question_file_name='external/merlin/questions-radio_dnn_416.hed', add_frame_features=True, subphone_feats='full')
+        compose.compose_labels(label_normaliser, cptest+'label_state_align/*.lab', fids, 'tests/test_made__smoke_compose_compose_labels/*.lab', id_valid_start=8, normfn=compose.normalise_minmax, label_type='state_align')
+        # Same as extracting the label features in files and composing them
+        makedirs('tests/test_made__smoke_compose_perform_normalisation')
+        label_normaliser.perform_normalisation([cptest+'label_state_align/'+fid+'.lab' for fid in fids], ['tests/test_made__smoke_compose_perform_normalisation/'+fid+'.lab' for fid in fids], label_type='state_align')
+        compose.compose(['tests/test_made__smoke_compose_perform_normalisation/*.lab:(-1,'+str(label_normaliser.dimension)+')'], fids, 'tests/test_made__smoke_compose_compose_labels_files/*.lab', id_valid_start=8, normfn=compose.normalise_minmax, wins=[], dropzerovardims=False)
+        for stat in ['min.dat', 'max.dat', 'min4norm.dat', 'max4norm.dat']:
+            self.assertTrue(np.array_equal(np.fromfile('tests/test_made__smoke_compose_compose_labels/'+stat, dtype='float32'), np.fromfile('tests/test_made__smoke_compose_compose_labels_files/'+stat, dtype='float32')))
+        for fid in fids:
+            self.assertTrue(np.array_equal(np.fromfile('tests/test_made__smoke_compose_compose_labels/'+fid+'.lab', dtype='float32'), np.fromfile('tests/test_made__smoke_compose_compose_labels_files/'+fid+'.lab', dtype='float32')))
+
         compose.compose([cptest+'binary_label_'+str(lab_size)+'/*.lab:(-1,'+str(lab_size)+')'], fids, 'tests/test_made__smoke_compose_compose_lab2/*.lab', id_valid_start=8, normfn=compose.normalise_minmax, wins=[], dropzerovardims=True)
 
         compose.compose([f0_path, spec_path+':(-1,'+str(spec_size)+')', nm_path+':(-1,'+str(nm_size)+')'], fids, 'tests/test_made__smoke_compose_compose2_cmp1/*.cmp', id_valid_start=8, normfn=compose.normalise_minmax, wins=[])
@@ -124,10 +124,73 @@ class TestSmokeTheano(unittest.TestCase):
         model.saveAllParams('tests/test_made__smoke_theano_model_train/smokymodelparams.pkl')
 
         model.generate_cmp(cfg.indir, 'tests/test_made__smoke_theano_model_train/smokymodelparams-cmp', fid_lst_val)
+        model.generate_cmp(cfg.indir, 'tests/test_made__smoke_theano_model_train/smokymodelparams-cmp-batches/*.cmp', fid_lst, batch_framebudget=2000)
+
+        # Prediction of multiple inputs at once (exact for a model without time context)
+        X_val = data.load(cfg.indir, fid_lst, verbose=1)
+        Ys = model.predict_padded(X_val[:3])
+        for X, Y in zip(X_val[:3], Ys):
+            self.assertTrue(np.allclose(Y, model.predict(X[None,:,:])[0,], atol=1e-5))
+
+        # Prediction by chunks (exact if the context covers the receptive field)
+        self.assertEqual(model.receptive_field(), 0)
+        Y = model.predict_chunked(X_val[0], 50)
+        self.assertTrue(np.allclose(Y, model.predict(X_val[0][None,:,:])[0,], atol=1e-5))
+        model.generate_cmp(cfg.indir, 'tests/test_made__smoke_theano_model_train/smokymodelparams-cmp-chunks/*.cmp', fid_lst, batch_framebudget=2000, predict_chunksize=100)
+
+        # Prediction with NumPy only
+        import inference
+        model.export_inference('tests/test_made__smoke_theano_model_train/smokymodelparams-inference.pkl')
+        net = inference.Network('tests/test_made__smoke_theano_model_train/smokymodelparams-inference.pkl')
+        self.assertTrue(np.allclose(net.predict(X_val[0][None,:,:]), model.predict(X_val[0][None,:,:]), atol=1e-4))
+        model.export_inference('tests/test_made__smoke_theano_model_train/smokymodelparams-inference-bn.pkl', foldbn=False)
+        netbn = inference.Network('tests/test_made__smoke_theano_model_train/smokymodelparams-inference-bn.pkl')
+        self.assertTrue(len(net.layers)<len(netbn.layers))    # The batch normalisations are folded
+        self.assertTrue(np.allclose(net.predict(X_val[0][None,:,:]), netbn.predict(X_val[0][None,:,:]), atol=1e-4))
+
+        # Quantisation of the parameters in int8
+        report = model.quantise('tests/test_made__smoke_theano_model_train/smokymodelparams.pkl', 'tests/test_made__smoke_theano_model_train/smokymodelparams-int8.pkl', cfg.indir, cfg.outdir, fid_lst_val)
+        self.assertTrue(report['size_quantised']<report['size_float'])
+        self.assertTrue(os.path.isfile('tests/test_made__smoke_theano_model_train/smokymodelparams-int8.pkl.json'))
+        model.loadAllParams('tests/test_made__smoke_theano_model_train/smokymodelparams.pkl')
+
+        # Synthesis server (without the HTTP socket)
+        import server
+        ttsserver = server.TTSServer(model, vocoder, os.path.dirname(cfg.outdir), wins=[], framebudget=2000)
+        CMP = ttsserver.generate_cmp(X_val[0])
+        self.assertEqual(CMP.shape, (X_val[0].shape[0], vocoder.featuressize()))
+        wav = ttsserver.generate_wav(X_val[0])
+        # Round trip over a TCP socket
+        import threading
+        import httplib
+        httpd = server.make_httpserver(ttsserver, ('localhost', 0))
+        serving = threading.Thread(target=httpd.serve_forever)
+        serving.daemon = True
+        serving.start()
+        try:
+            conn = httplib.HTTPConnection('localhost', httpd.server_address[1])
+            conn.request('POST', '/cmp', X_val[0].astype('float32').tobytes(), {'Content-Type':'application/octet-stream'})
+            resp = conn.getresponse()
+            self.assertEqual(resp.status, 200)
+            shape = tuple([int(d) for d in resp.getheader('X-Shape').split(',')])
+            self.assertTrue(np.allclose(np.frombuffer(resp.read(), dtype='float32').reshape(shape), CMP, atol=1e-5))
+            for body in ['', np.zeros(3, dtype='float32').tobytes()]:   # Empty input, and not a multiple of the input size
+                conn = httplib.HTTPConnection('localhost', httpd.server_address[1])
+                conn.request('POST', '/cmp', body, {'Content-Type':'application/octet-stream'})
+                resp = conn.getresponse()
+                resp.read()
+                self.assertEqual(resp.status, 400)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
 
         model.generate_wav(cfg.indir, cfg.outdir, fid_lst, 'tests/test_made__smoke_theano_model_train/smokymodelparams-snd', vocoder, wins=[], do_objmeas=True, do_resynth=True)
         model.generate_wav(cfg.indir, cfg.outdir, fid_lst, 'tests/test_made__smoke_theano_model_train/smokymodelparams-snd-pp_spec_extrapfreq', vocoder, wins=[], do_objmeas=True, do_resynth=True, pp_spec_extrapfreq=8000)
         model.generate_wav(cfg.indir, cfg.outdir, fid_lst, 'tests/test_made__smoke_theano_model_train/smokymodelparams-snd-pp_spec_pf_coef', vocoder, wins=[], do_objmeas=True, do_resynth=True, pp_spec_pf_coef=1.2)
+        model.generate_wav(cfg.indir, cfg.outdir, fid_lst, 'tests/test_made__smoke_theano_model_train/smokymodelparams-snd-nbproc', vocoder, wins=[], do_objmeas=True, do_resynth=True, nbproc=2)
+        for fid in fid_lst:  # Same noise whatever the number of processes
+            self.assertEqual(open('tests/test_made__smoke_theano_model_train/smokymodelparams-snd/'+fid+'.wav', 'rb').read(), open('tests/test_made__smoke_theano_model_train/smokymodelparams-snd-nbproc/'+fid+'.wav', 'rb').read())
+        model.generate_wav(cfg.indir, cfg.outdir, fid_lst, 'tests/test_made__smoke_theano_model_train/smokymodelparams-snd-batches', vocoder, wins=[], do_objmeas=True, do_resynth=True, batch_framebudget=2000)
 
         # Test MLPG
         mlpg_wins = [[-0.5, 0.0, 0.5], [1.0, -2.0, 1.0]]
@@ -138,6 +201,9 @@ class TestSmokeTheano(unittest.TestCase):
         optiganwdeltas.train_multipletrials(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, modelwdeltas.params_trainable, 'tests/test_made__smoke_theano_model_train/smokymodelparams_wdeltas.pkl', cfgtomerge=cfg, cont=False)
         modelwdeltas.saveAllParams('tests/test_made__smoke_theano_model_train/smokymodelparams_wdeltas.pkl')
         modelwdeltas.generate_wav(cfg.indir, cfg.outdir, fid_lst, 'tests/test_made__smoke_theano_model_train/smokymodelparams_wdeltas-snd', vocoder, wins=mlpg_wins, do_objmeas=True, do_resynth=True)
+        # Stream the MLPG chunks into the synthesis
+        modelwdeltas.generate_wav(cfg.indir, cfg.outdir, fid_lst, 'tests/test_made__smoke_theano_model_train/smokymodelparams_wdeltas-snd-mlpgchunks', vocoder, wins=mlpg_wins, do_objmeas=True, do_resynth=False, mlpg_chunksize=100, mlpg_lookahead=20)
+        modelwdeltas.generate_wav(cfg.indir, cfg.outdir, fid_lst, 'tests/test_made__smoke_theano_model_train/smokymodelparams_wdeltas-snd-mlpgchunks-nbproc', vocoder, wins=mlpg_wins, do_objmeas=False, do_resynth=False, mlpg_chunksize=100, mlpg_lookahead=20, nbproc=2)
         # Restore the non-MLPG features
         cfg.outdir = cptest+'wav_cmp_lf0_fwlspec65_fwnm17_bndnmnoscale/*.cmp:(-1,83)'
 
@@ -177,22 +243,117 @@ class TestSmokeTheano(unittest.TestCase):
         modelwdeltas = models_basic.ModelBGRU(lab_size, vocoder, mlpg_wins=mlpg_wins, hiddensize=4, nblayers=1)
         optigan = optimizer.Optimizer(model, errtype='LSE')
         optigan.train_multipletrials(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, model.params_trainable, 'tests/test_made__smoke_theano_model_train/smokymodelparams.pkl', cfgtomerge=cfg, cont=False)
+        model.export_inference('tests/test_made__smoke_theano_model_train/smokymodelparams-inference.pkl')
+        self.assertTrue(np.allclose(inference.Network('tests/test_made__smoke_theano_model_train/smokymodelparams-inference.pkl').predict(X_val[0][None,:,:]), model.predict(X_val[0][None,:,:]), atol=1e-4))
         # model.generate_wav('test/test_made__smoke_theano_model_train/smokymodelparams-snd', fid_lst, cfg, do_objmeas=True, do_resynth=True, indicestosynth=None, spec_comp='fwlspec', spec_size=spec_size, nm_size=nm_size)
 
         model = models_basic.ModelBLSTM(lab_size, vocoder, mlpg_wins=[], hiddensize=4, nblayers=1)
         modelwdeltas = models_basic.ModelBLSTM(lab_size, vocoder, mlpg_wins=mlpg_wins, hiddensize=4, nblayers=1)
         optigan = optimizer.Optimizer(model, errtype='LSE')
         optigan.train_multipletrials(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, model.params_trainable, 'tests/test_made__smoke_theano_model_train/smokymodelparams.pkl', cfgtomerge=cfg, cont=False)
+        model.export_inference('tests/test_made__smoke_theano_model_train/smokymodelparams-inference.pkl')
+        self.assertTrue(np.allclose(inference.Network('tests/test_made__smoke_theano_model_train/smokymodelparams-inference.pkl').predict(X_val[0][None,:,:]), model.predict(X_val[0][None,:,:]), atol=1e-4))
+        Ys = model.predict_padded(X_val[:3])    # The padded frames are masked in the recurrent layers
+        for X, Y in zip(X_val[:3], Ys):
+            self.assertTrue(np.allclose(Y, model.predict(X[None,:,:])[0,], atol=1e-5))
         # model.generate_wav('test/test_made__smoke_theano_model_train/smokymodelparams-snd', fid_lst, cfg, do_objmeas=True, do_resynth=True, indicestosynth=None, spec_comp='fwlspec', spec_size=spec_size, nm_size=nm_size)
 
+        model = models_basic.ModelBQRNN(lab_size, vocoder, mlpg_wins=[], hiddensize=4, nblayers=1)
+        modelwdeltas = models_basic.ModelBQRNN(lab_size, vocoder, mlpg_wins=mlpg_wins, hiddensize=4, nblayers=1)
+        optigan = optimizer.Optimizer(model, errtype='LSE')
+        optigan.train_multipletrials(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, model.params_trainable, 'tests/test_made__smoke_theano_model_train/smokymodelparams.pkl', cfgtomerge=cfg, cont=False)
+        model.export_inference('tests/test_made__smoke_theano_model_train/smokymodelparams-inference.pkl')
+        self.assertTrue(np.allclose(inference.Network('tests/test_made__smoke_theano_model_train/smokymodelparams-inference.pkl').predict(X_val[0][None,:,:]), model.predict(X_val[0][None,:,:]), atol=1e-4))
+        Ys = model.predict_padded(X_val[:3])    # The padded frames are masked in the recurrent layers
+        for X, Y in zip(X_val[:3], Ys):
+            self.assertTrue(np.allclose(Y, model.predict(X[None,:,:])[0,], atol=1e-5))
+
+        model = models_basic.ModelBSRU(lab_size, vocoder, mlpg_wins=[], hiddensize=4, nblayers=1)
+        modelwdeltas = models_basic.ModelBSRU(lab_size, vocoder, mlpg_wins=mlpg_wins, hiddensize=4, nblayers=1)
+        optigan = optimizer.Optimizer(model, errtype='LSE')
+        optigan.train_multipletrials(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, model.params_trainable, 'tests/test_made__smoke_theano_model_train/smokymodelparams.pkl', cfgtomerge=cfg, cont=False)
+        model.export_inference('tests/test_made__smoke_theano_model_train/smokymodelparams-inference.pkl')
+        self.assertTrue(np.allclose(inference.Network('tests/test_made__smoke_theano_model_train/smokymodelparams-inference.pkl').predict(X_val[0][None,:,:]), model.predict(X_val[0][None,:,:]), atol=1e-4))
+
         model = models_generic.ModelGeneric(lab_size, vocoder, mlpg_wins=[], layertypes=['FC', 'BLSTM'], hiddensize=4)
         optigan = optimizer.Optimizer(model, errtype='LSE')
         optigan.train_multipletrials(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, model.params_trainable, 'tests/test_made__smoke_theano_model_train/smokymodelparams.pkl', cfgtomerge=cfg, cont=False)
+        self.assertEqual(model.receptive_field(), None)
+        with self.assertRaises(ValueError):
+            model.predict_chunked(X_val[0], 50)
+        with self.assertRaises(ValueError):
+            model.generate_cmp(cfg.indir, 'tests/test_made__smoke_theano_model_train/smokymodelparams-cmp-chunks/*.cmp', fid_lst, predict_chunksize=100)
+        model.generate_cmp(cfg.indir, 'tests/test_made__smoke_theano_model_train/smokymodelparams-cmp-chunks/*.cmp', fid_lst, predict_chunksize=100, predict_context=50)
+        model.export_inference('tests/test_made__smoke_theano_model_train/smokymodelparams-inference.pkl')
+        self.assertTrue(np.allclose(inference.Network('tests/test_made__smoke_theano_model_train/smokymodelparams-inference.pkl').predict(X_val[0][None,:,:]), model.predict(X_val[0][None,:,:]), atol=1e-4))
+
+        # Parameters saved before the gated convolutions were fused
+        import checkpoint
+        model = models_generic.ModelGeneric(lab_size, vocoder, mlpg_wins=[], layertypes=['FC', ['GCNN', 2, 3]], hiddensize=4)
+        tensors = [(str(p), p.get_value()) for p in model.params_all]
+        W, b = dict(tensors)['l2_GCNN2x3x1.W'], dict(tensors)['l2_GCNN2x3x1.b']
+        tensors = [(name, value) for name, value in tensors if not name in ['l2_GCNN2x3x1.W', 'l2_GCNN2x3x1.b']]
+        tensors += [('l2_GCNN2x3x1.activation.W', W[:2]), ('l2_GCNN2x3x1.activation.b', b[:2]), ('l2_GCNN2x3x1.gate.W', W[2:]), ('l2_GCNN2x3x1.gate.b', b[2:])]
+        checkpoint.save('tests/test_made__smoke_theano_model_train/smokymodelparams-unfused.pkl', tensors, {'cfg':None, 'extras':None})
+        Y = model.predict(X_val[0][None,:,:])
+        for p in model.params_all: p.set_value(np.zeros_like(p.get_value()))
+        model.loadAllParams('tests/test_made__smoke_theano_model_train/smokymodelparams-unfused.pkl')
+        self.assertTrue(np.allclose(model.predict(X_val[0][None,:,:]), Y))
+        # Missing parameters are only allowed for a partial loading
+        checkpoint.save('tests/test_made__smoke_theano_model_train/smokymodelparams-partial.pkl', tensors[1:], {'cfg':None, 'extras':None})
+        with self.assertRaises(ValueError):
+            model.loadAllParams('tests/test_made__smoke_theano_model_train/smokymodelparams-partial.pkl')
+        model.loadAllParams('tests/test_made__smoke_theano_model_train/smokymodelparams-partial.pkl', regexp='GCNN')
+        model.export_inference('tests/test_made__smoke_theano_model_train/smokymodelparams-inference.pkl')
+        self.assertTrue(np.allclose(inference.Network('tests/test_made__smoke_theano_model_train/smokymodelparams-inference.pkl').predict(X_val[0][None,:,:]), Y, atol=1e-4))
+
+        # Training state saved before the gated convolutions were fused (the optimisation states included)
+        optigan = optimizer.Optimizer(model, errtype='LSE')
+        optigan.train_multipletrials(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, model.params_trainable, 'tests/test_made__smoke_theano_model_train/smokymodelparams.pkl', cfgtomerge=cfg, cont=False)
+        tensors, meta = checkpoint.load('tests/test_made__smoke_theano_model_train/smokymodelparams-trainingstate-last.pkl')
+        tensors_unfused = []
+        for name, value in tensors:
+            if name.endswith('l2_GCNN2x3x1.W') or name.endswith('l2_GCNN2x3x1.b'):
+                tensors_unfused += [(name[:-2]+'.activation'+name[-2:], value[:2]), (name[:-2]+'.gate'+name[-2:], value[2:])]
+            else:
+                tensors_unfused.append((name, value))
+        meta['nbparams'] += 2
+        meta['nbovs'] = [len(tensors_unfused)-meta['nbparams']]
+        checkpoint.save('tests/test_made__smoke_theano_model_train/smokymodelparams-trainingstate-unfused.pkl', tensors_unfused, meta)
+        variables = model.params_all+optigan._optim_updates[0].keys()
+        values = [p.get_value() for p in variables]
+        for p in variables: p.set_value(np.zeros_like(p.get_value()))
+        optigan.loadTrainingState('tests/test_made__smoke_theano_model_train/smokymodelparams-trainingstate-unfused.pkl', cfg)
+        for p, value in zip(variables, values):
+            self.assertTrue(np.array_equal(p.get_value(), value))
+        # The optimisation states cannot be resumed if they cannot be mapped to the fused parameters
+        tensors_unfused = [(name, value) if not '/state' in name else ('optim0/moment', value) for name, value in tensors_unfused]
+        checkpoint.save('tests/test_made__smoke_theano_model_train/smokymodelparams-trainingstate-unfused.pkl', tensors_unfused, meta)
+        with self.assertRaises(ValueError):
+            optigan.loadTrainingState('tests/test_made__smoke_theano_model_train/smokymodelparams-trainingstate-unfused.pkl', cfg)
+
+        with self.assertRaises(ValueError):
+            models_generic.ModelGeneric(lab_size, vocoder, mlpg_wins=[], layertypes=['FC'], hiddensize=4, critic_postlayertype='BLSTM')
+        model = models_generic.ModelGeneric(lab_size, vocoder, mlpg_wins=[], layertypes=['FC', 'BQRNN', 'BSRU'], hiddensize=4, critic_postlayertype='BSRU')
+        optigan = optimizer.Optimizer(model, errtype='WGAN')
+        optigan.train_multipletrials(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, model.params_trainable, 'tests/test_made__smoke_theano_model_train/smokymodelparams.pkl', cfgtomerge=cfg, cont=False)
+        self.assertEqual(model.receptive_field(), None)
+        model.export_inference('tests/test_made__smoke_theano_model_train/smokymodelparams-inference.pkl')
+        self.assertTrue(np.allclose(inference.Network('tests/test_made__smoke_theano_model_train/smokymodelparams-inference.pkl').predict(X_val[0][None,:,:]), model.predict(X_val[0][None,:,:]), atol=1e-4))
 
         import models_cnn
         model = models_cnn.ModelCNN(lab_size, vocoder, hiddensize=4, nbcnnlayers=1, nbfilters=2, spec_freqlen=3, noise_freqlen=3, windur=0.020)
         optigan = optimizer.Optimizer(model, errtype='LSE')
         optigan.train_multipletrials(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, model.params_trainable, 'tests/test_made__smoke_theano_model_train/smokymodelparams.pkl', cfgtomerge=cfg, cont=False)
+        self.assertEqual(model.receptive_field(), 10+2*2)   # ctx_winlen=21 and 2 layers of 5 frames
+        Y = model.predict_chunked(X_val[0], 50)
+        self.assertEqual(Y.shape, (X_val[0].shape[0], vocoder.featuressize()))
+        model.export_inference('tests/test_made__smoke_theano_model_train/smokymodelparams-inference.pkl')
+        Y = inference.Network('tests/test_made__smoke_theano_model_train/smokymodelparams-inference.pkl', seed=123).predict(X_val[0][None,:,:])
+        self.assertTrue(np.allclose(Y, model.predict_fixednoise(X_val[0][None,:,:], seed=123), atol=1e-4))   # Same noise input
+        self.assertTrue(np.allclose(model.predict_fixednoise(X_val[0][None,:,:], seed=123), model.predict_fixednoise(X_val[0][None,:,:], seed=123)))
+        report = model.quantise('tests/test_made__smoke_theano_model_train/smokymodelparams.pkl', 'tests/test_made__smoke_theano_model_train/smokymodelparams-int8.pkl', cfg.indir, cfg.outdir, fid_lst_val)
+        self.assertTrue(report['rmse_quantised_vs_float']<0.1*report['rmse_float'])    # Same noise input for both models
         # # model.generate_wav('test/test_made__smoke_theano_model_train/smokymodelparams-snd', fid_lst, cfg, do_objmeas=True, do_resynth=True, indicestosynth=None, spec_comp='fwlspec', spec_size=spec_size, nm_size=nm_size)
 
         optigan = optimizer.Optimizer(model, errtype='WGAN')
@@ -202,6 +363,19 @@ class TestSmokeTheano(unittest.TestCase):
         optigan.train_multipletrials(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, model.params_trainable, 'tests/test_made__smoke_theano_model_train/smokymodelparams.pkl', cfgtomerge=cfg, cont=False)
         # model.generate_wav('test/test_made__smoke_theano_model_train/smokymodelparams-snd', fid_lst, cfg, do_objmeas=True, do_resynth=True, indicestosynth=None, spec_comp='fwlspec', spec_size=spec_size, nm_size=nm_size)
 
+        with self.assertRaises(ValueError):
+            models_cnn.ModelCNN(lab_size, vocoder, f0vuv_arch='WaveNet')
+        model = models_cnn.ModelCNN(lab_size, vocoder, hiddensize=4, nbcnnlayers=1, nbfilters=2, spec_freqlen=3, noise_freqlen=3, windur=0.020, f0vuv_arch='DGCNN', f0vuv_dgcnn_nblayers=3)
+        optigan = optimizer.Optimizer(model, errtype='LSE')
+        optigan.train_multipletrials(cfg.indir, cfg.outdir, cfg.wdir, fid_lst_tra, fid_lst_val, model.params_trainable, 'tests/test_made__smoke_theano_model_train/smokymodelparams.pkl', cfgtomerge=cfg, cont=False)
+        self.assertEqual(model.receptive_field(), 10+(2**3-1))  # ctx_winlen=21 and dilations 1,2,4 of 3 frames
+        Y = model.predict_chunked(X_val[0], 50)
+        self.assertEqual(Y.shape, (X_val[0].shape[0], vocoder.featuressize()))
+        model.export_inference('tests/test_made__smoke_theano_model_train/smokymodelparams-inference.pkl')
+        Y = inference.Network('tests/test_made__smoke_theano_model_train/smokymodelparams-inference.pkl', seed=123).predict(X_val[0][None,:,:])
+        self.assertTrue(np.allclose(Y, model.predict_fixednoise(X_val[0][None,:,:], seed=123), atol=1e-4))   # Same noise input
+        self.assertTrue(np.allclose(model.predict_fixednoise(X_val[0][None,:,:], seed=123), model.predict_fixednoise(X_val[0][None,:,:], seed=123)))
+
 
 
     def test_backend_theano(self):
@@ -225,6 +399,51 @@ class TestSmokeTheano(unittest.TestCase):
         y = backend_theano.nonlin_softsign(x)
         y = backend_theano.nonlin_sigmoidparm(x, c=0.0, f=1.0)
 
+        # Compile cache: the warm function has to work on the shared variables of its own graph
+        import theano
+        from collections import OrderedDict
+        def build(lr):
+            W = theano.shared(np.ones((3,2), dtype=theano.config.floatX), name='W')
+            z = T.fmatrix('z')
+            cost = T.mean(T.dot(z, W)**2)
+            return W, z, cost, OrderedDict([(W, W-lr*T.grad(cost, W))])
+        Z = np.random.randn(4, 3).astype(theano.config.floatX)
+        import shutil
+        if os.path.exists('tests/test_made__smoke_theano_compilecache'): shutil.rmtree('tests/test_made__smoke_theano_compilecache')
+        backend_theano.th_compilecache('tests/test_made__smoke_theano_compilecache')
+        Ws = []
+        for lr in [0.1, 0.1, 0.2]:
+            W, z, cost, updates = build(lr)
+            fn = backend_theano.th_function([z], cost, updates=updates, name='smoky_train')
+            fn(Z)
+            Ws.append(W.get_value())
+        backend_theano.th_compilecache(None)
+        starts = [report['start'] for report in backend_theano.th_compilecache_report()[-3:]]
+        self.assertEqual(starts, ['cold', 'warm', 'cold'])  # A different learning rate is a different graph
+        self.assertTrue(np.allclose(Ws[0], Ws[1]))
+        self.assertFalse(np.allclose(Ws[0], Ws[2]))
+
+        # Profiling per layer
+        import vocoders
+        import models_basic
+        import optimizer
+        makedirs('tests/test_made__smoke_theano_profile')
+        backend_theano.th_profile(True)
+        self.addCleanup(backend_theano.th_profile, False)   # Restore lasagne.layers.get_output(.) whatever happens
+        model = models_basic.ModelFC(lab_size, vocoders.VocoderPML(cfg.vocoder_fs, cfg.vocoder_shift, spec_size, nm_size), hiddensize=4, nblayers=2)
+        reports = optimizer.Optimizer(model, errtype='LSE').profile(model.params_trainable, nbframes=50, nbiters=2, cfgtomerge=cfg)
+        backend_theano.th_profile_print(reports, 'tests/test_made__smoke_theano_profile/profile.json')
+        self.assertEqual([report['name'] for report in reports], ['predict', 'train'])
+        self.assertTrue('l1_FC4' in [l['layer'] for l in reports[0]['layers']])
+        self.assertTrue(any([l['backward']>0.0 for l in reports[1]['layers']]))
+        # With the critic
+        import models_generic
+        model = models_generic.ModelGeneric(lab_size, vocoders.VocoderPML(cfg.vocoder_fs, cfg.vocoder_shift, spec_size, nm_size), mlpg_wins=[], layertypes=['FC'], hiddensize=4)
+        reports = optimizer.Optimizer(model, errtype='WGAN').profile(model.params_trainable, nbframes=50, nbiters=2, cfgtomerge=cfg)
+        backend_theano.th_profile_print(reports, 'tests/test_made__smoke_theano_profile/profile_wgan.json')
+        self.assertEqual([report['name'] for report in reports], ['predict', 'generator_train', 'critic_train'])
+        self.assertTrue(any([l['backward']>0.0 for l in reports[2]['layers']]))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -27,16 +27,214 @@ from external.pulsemodel import sigproc as sp
 
 from external import pulsemodel
 
+
+# Cache of the linear operators converting between linear frequency bins and
+# frequency-warped bands. (fn name, fs, dftlen, input size, args) -> (matrix, offset)
+# or None if the conversion turned out to be non-linear.
+_bndops = dict()
+
+def _bndop_apply(fn, X, fs, dftlen, *args, **kwargs):
+    """
+    Apply the band conversion fn(X, fs, dftlen, *args, **kwargs) as a single
+    matrix product over all the frames of X.
+
+    The conversion depends only on (fs, dftlen, number of bands, options), so
+    its matrix is built once by applying fn on the identity, and cached.
+    At construction, the result is checked against fn on the first frames of X;
+    if it does not match, fn is called directly for these parameters.
+    """
+    key = (fn.__name__, fs, dftlen, X.shape[1], args, tuple(sorted(kwargs.items())))
+    if not key in _bndops:
+        offset = fn(np.zeros((1, X.shape[1])), fs, dftlen, *args, **kwargs)
+        op = fn(np.eye(X.shape[1]), fs, dftlen, *args, **kwargs) - offset
+        _bndops[key] = (op, offset)
+        ref = fn(X[:4], fs, dftlen, *args, **kwargs)
+        if not np.allclose(np.dot(X[:4], op)+offset, ref, rtol=1e-5, atol=1e-8*np.max(np.abs(ref))):   # pragma: no cover
+            print('    WARNING: {} is not linear, it will not be cached'.format(fn.__name__))
+            _bndops[key] = None
+
+    if _bndops[key] is None: return fn(X, fs, dftlen, *args, **kwargs)    # pragma: no cover
+
+    op, offset = _bndops[key]
+    return np.dot(X, op) + offset
+
+def linbnd2fwbnd(X, fs, dftlen, nbbnds):
+    """Same as pulsemodel's sigproc.linbnd2fwbnd(.), using a cached operator."""
+    return _bndop_apply(sp.linbnd2fwbnd, X, fs, dftlen, nbbnds)
+
+def fwbnd2linbnd(Z, fs, dftlen, smooth=False):
+    """Same as pulsemodel's sigproc.fwbnd2linbnd(.), using a cached operator."""
+    return _bndop_apply(sp.fwbnd2linbnd, Z, fs, dftlen, smooth=smooth)
+
+# Caches of the waveform pre-processing (see Vocoder.preprocwav(.))
+_resample_kernels = dict()   # (up, down, dtype) -> FIR kernel of the polyphase resampler
+_highpass_filters = dict()   # (fs, cutoff) -> coefficients of the Butterworth filter
+
+def resample(wav, fs_in, fs_out):
+    """
+    Resample the waveform using a polyphase filter, whose kernel is designed
+    once per ratio of sampling rates. The waveform keeps its data type (e.g.
+    float32 waveforms are not converted to float64).
+    """
+    import fractions
+    from scipy import signal as sig
+
+    g = fractions.gcd(int(fs_in), int(fs_out))
+    up, down = int(fs_out)//g, int(fs_in)//g
+    if not np.issubdtype(wav.dtype, np.floating): wav = wav.astype(np.float64) # pragma: no cover
+
+    key = (up, down, wav.dtype)
+    h = _resample_kernels.get(key)
+    if h is None:
+        max_rate = max(up, down)
+        h = sig.firwin(2*10*max_rate+1, 1.0/max_rate, window=('kaiser', 5.0)).astype(wav.dtype)  # As in scipy.signal.resample_poly
+        _resample_kernels[key] = h
+
+    return sig.resample_poly(wav, up, down, window=h)
+
+def highpass_filter(wav, fs, cutoff):
+    """
+    High-pass filter the waveform (zero-phase) using a cached filter design.
+    The filtering is computed in float64, since the coefficients of a low
+    cut-off Butterworth filter are unstable in float32, and the result is
+    cast back to the waveform's data type.
+    """
+    from scipy import signal as sig
+
+    key = (fs, cutoff)
+    ba = _highpass_filters.get(key)
+    if ba is None:
+        ba = sig.butter(4, cutoff/(0.5*fs), btype='high')   # Cut-off relative to Nyquist
+        _highpass_filters[key] = ba
+
+    return sig.filtfilt(ba[0], ba[1], wav).astype(wav.dtype, copy=False)
+
+
+# Version of the analysis code, recorded in the analysis cache (see Vocoder.analysis_params(.)).
+# Increment it when a change of the code changes the outputs of the analysis, so that they are re-analysed.
+#   2: Cut-off of the high-pass filter of preprocwav(.) relative to the Nyquist frequency
+ANALYSIS_VERSION = 2
+
+def _filestat(fname):
+    """Size and modification time of a file, as recorded in the cache index of the analysis."""
+    st = os.stat(fname)
+    return [st.st_size, st.st_mtime]
+
+def _analysiscache_write(findex, index):
+    import json
+    import tempfile
+    makedirs(os.path.dirname(findex))
+    fd, ftmp = tempfile.mkstemp(dir=os.path.dirname(findex), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(index, f)
+    os.rename(ftmp, findex)   # Atomic, a concurrent reader never sees a partial entry
+
+
+class ObjMeasures:
+    """
+    Streaming accumulators of objective measures (e.g. F0 RMSE, spectral RMSE).
+
+    Only running sums per dimension are kept for each measure, so that the
+    memory used does not grow with the number of utterances. Accumulators
+    filled in different processes can be merged with merge(.), and adding or
+    merging is protected by a lock so that threads can share an instance.
+    """
+
+    def __init__(self):
+        import threading
+        self._lock = threading.Lock()
+        self.acc = dict()  # key -> dict of the running sums of the measure
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']  # Locks cannot be pickled (e.g. when sent to a pool of processes)
+        return state
+
+    def __setstate__(self, state):
+        import threading
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self.acc = dict()
+
+    def add(self, key, E, stat='rmse'):
+        """
+        Add the errors of one utterance to the measure `key`.
+
+        Parameters
+        ----------
+        E : the errors between the generated and target features, of shape [frames] or [frames x dims].
+        stat : The statistic printed by summary(.): 'rmse' for the mean of the per-utterance RMSE,
+            'mean' for the mean error over all frames (e.g. for error rates).
+        """
+        E = np.asarray(E, dtype=np.float64)
+        if E.ndim==1: E = E[:,None]
+        E2 = E**2
+        with self._lock:
+            acc = self.acc.get(key)
+            if acc is None:
+                acc = {'stat':stat, 'nbutts':0, 'nbframes':0, 'sum':np.zeros(E.shape[1]), 'sumsq':np.zeros(E.shape[1]), 'sumuttrmse':np.zeros(E.shape[1])}
+                self.acc[key] = acc
+            acc['nbutts'] += 1
+            acc['nbframes'] += E.shape[0]
+            acc['sum'] += np.sum(E, axis=0)
+            acc['sumsq'] += np.sum(E2, axis=0)
+            acc['sumuttrmse'] += np.sqrt(np.mean(E2, axis=0))
+
+    def merge(self, other):
+        """Add the accumulators of another ObjMeasures instance (e.g. filled by another process)."""
+        with self._lock:
+            for key in sorted(other.acc.keys()):
+                oacc = other.acc[key]
+                acc = self.acc.get(key)
+                if acc is None:
+                    self.acc[key] = {k:(v.copy() if isinstance(v, np.ndarray) else v) for k, v in oacc.items()}
+                else:
+                    for k in ['nbutts', 'nbframes', 'sum', 'sumsq', 'sumuttrmse']:
+                        acc[k] = acc[k] + oacc[k]
+
+    def report(self):
+        """
+        Return the measures as a dictionary (e.g. to be saved in JSON format).
+
+        For each measure: the number of utterances and frames, the mean error,
+        the RMSE over all frames and the mean of the per-utterance RMSE, both
+        per dimension and averaged over the dimensions.
+        """
+        report = dict()
+        with self._lock:
+            for key in sorted(self.acc.keys()):
+                acc = self.acc[key]
+                mean = acc['sum']/acc['nbframes']
+                rmse = np.sqrt(acc['sumsq']/acc['nbframes'])
+                uttrmse = acc['sumuttrmse']/acc['nbutts']
+                report[key] = {'stat':acc['stat'], 'nbutts':acc['nbutts'], 'nbframes':acc['nbframes']
+                            , 'mean':float(np.mean(mean)), 'rmse':float(np.sqrt(np.mean(rmse**2))), 'uttrmse':float(np.mean(uttrmse))
+                            , 'mean_perdim':mean.tolist(), 'rmse_perdim':rmse.tolist(), 'uttrmse_perdim':uttrmse.tolist()}
+        return report
+
+    def summary(self, report=None):
+        """Print one line per measure."""
+        if report is None: report = self.report()
+        for key in sorted(report.keys()):
+            print('{}: {}'.format(key, report[key]['uttrmse' if report[key]['stat']=='rmse' else 'mean']))
+
+
 class Vocoder:
     _name = None
 
     shift = None
     fs = None
 
+    features_err = None # ObjMeasures
+
     def __init__(self, _name, _fs, _shift):
         self._name = _name
         self.fs = _fs
         self.shift = _shift
+        self.features_err = ObjMeasures()
 
     def preprocwav(self, wav, fs, highpass=None):
         '''
@@ -45,19 +243,112 @@ class Vocoder:
 
         if fs!=self.fs:
             print('    Resampling the waveform (new fs={}Hz)'.format(self.fs))
-            wav = sp.resample(wav, fs, self.fs, method=2, deterministic=True)
+            wav = resample(wav, fs, self.fs)
             fs = self.fs
 
         if not highpass is None:
             print('    High-pass filter the waveform (cutt-off={}Hz)'.format(highpass))
-            from scipy import signal as sig
-            b, a = sig.butter(4, highpass/(self.fs/0.5), btype='high')
-            wav = sig.filtfilt(b, a, wav)
+            wav = highpass_filter(wav, self.fs, highpass)
 
         wav = np.ascontiguousarray(wav) # Often necessary for some cython implementations
 
         return wav
 
+    def preprocwavs(self, fwavs, highpass=None):
+        '''
+        Batch version of preprocwav(.): Read and pre-process the given wav
+        files one after the other, re-using the same resampling and filtering
+        designs. Yields the pre-processed waveforms (at self.fs).
+        '''
+        for fwav in fwavs:
+            wav, fs, _ = sp.wavread(fwav)
+            yield self.preprocwav(wav, fs, highpass=highpass)
+
+    # Caching of the analysis, such that unchanged files are not re-analysed
+    def analysis_params(self):
+        """The parameters of the vocoder (and the version of the analysis code) that the outputs of the analysis depend on."""
+        return {'version':ANALYSIS_VERSION, 'name':self._name, 'fs':self.fs, 'shift':self.shift, 'featuressize':self.featuressize(), 'noisesize':self.noisesize(), 'vuvsize':self.vuvsize()}
+
+    def _analysis_params(self, f0_min, f0_max, preproc_hp, segdur):
+        params = self.analysis_params()
+        params.update({'f0_min':f0_min, 'f0_max':f0_max, 'preproc_hp':preproc_hp, 'segdur':segdur})
+        return params
+
+    def analysis_key(self, fwav, f0_min, f0_max, preproc_hp=None, segdur=None):
+        """Content-addressed key of an analysis: hash of the waveform's bytes and of the analysis parameters."""
+        import hashlib
+        import json
+        h = hashlib.sha1()
+        with open(fwav, 'rb') as f:
+            for buf in iter(lambda: f.read(1<<20), b''):
+                h.update(buf)
+        h.update(json.dumps(self._analysis_params(f0_min, f0_max, preproc_hp, segdur), sort_keys=True).encode('utf-8'))
+        return h.hexdigest()
+
+    def _analysiscache_paths(self, fid, wav_path, outputpathdicts):
+        fwav = wav_path.replace('*',fid)
+        outkeys = ['f0', 'spec', 'noise']
+        if self.vuvsize()>0: outkeys.append('vuv')
+        foutputs = [outputpathdicts[key].replace('*',fid) for key in outkeys]
+        # The index is made of one small file per waveform, so that the processes of analysisfids(.) never write the same file
+        findex = os.path.join(os.path.dirname(outputpathdicts['f0']), '.analysiscache', fid+'.json')
+        return fwav, foutputs, findex
+
+    def analysisfid_iscached(self, fid, wav_path, f0_min, f0_max, outputpathdicts, preproc_hp=None, segdur=None):
+        """
+        Return True if the outputs of analysisfid(.) already exist for the same
+        waveform content and the same analysis parameters, according to the
+        cache index. The waveform is hashed only if its size or modification
+        time differ from those recorded in the index.
+        """
+        import json
+        fwav, foutputs, findex = self._analysiscache_paths(fid, wav_path, outputpathdicts)
+        if not os.path.isfile(findex): return False
+        try:
+            with open(findex, 'r') as f:
+                index = json.load(f)
+        except ValueError:                                          # pragma: no cover
+            return False    # Corrupted index entry, just re-analyse
+
+        for fout in foutputs:
+            if (not os.path.isfile(fout)) or index['outputs'].get(fout)!=_filestat(fout): return False
+
+        if index['wav']!=_filestat(fwav):
+            if index['key']!=self.analysis_key(fwav, f0_min, f0_max, preproc_hp, segdur): return False
+            index['wav'] = _filestat(fwav) # Same content (e.g. copied), no need to re-hash next time
+            _analysiscache_write(findex, index)
+
+        else:
+            # The waveform did not change, but the analysis parameters could have
+            if index['params']!=json.loads(json.dumps(self._analysis_params(f0_min, f0_max, preproc_hp, segdur))): return False
+
+        return True
+
+    def analysisfid(self, fid, wav_path, f0_min, f0_max, outputpathdicts, preproc_hp=None, resume=True, segdur=None):
+        """
+        Analyse the waveform wav_path (where * is replaced by fid) and write the
+        features in outputpathdicts (dictionary of paths with keys f0, spec,
+        noise and vuv, where * is replaced by fid).
+        The analysis is always recorded in the cache index, and if resume is
+        True, it is skipped if it has already been done for the same waveform
+        content and analysis parameters (see analysisfid_iscached(.)).
+        segdur :    If not None, analyse the long waveforms by segments of about
+                    segdur seconds in parallel (VocoderWORLD only, see
+                    VocoderWORLD.world_analysis_segments(.)).
+        """
+        if resume and self.analysisfid_iscached(fid, wav_path, f0_min, f0_max, outputpathdicts, preproc_hp=preproc_hp, segdur=segdur):
+            print('Skip the analysis of {} (unchanged)'.format(fid))
+            return
+
+        self._analysisfid(fid, wav_path, f0_min, f0_max, outputpathdicts, preproc_hp=preproc_hp, segdur=segdur)
+
+        fwav, foutputs, findex = self._analysiscache_paths(fid, wav_path, outputpathdicts)
+        index = {'key':self.analysis_key(fwav, f0_min, f0_max, preproc_hp, segdur), 'params':self._analysis_params(f0_min, f0_max, preproc_hp, segdur), 'wav':_filestat(fwav), 'outputs':dict([(fout, _filestat(fout)) for fout in foutputs])}
+        _analysiscache_write(findex, index)
+
+    def _analysisfid(self, fid, wav_path, f0_min, f0_max, outputpathdicts, preproc_hp=None, segdur=None):
+        raise ValueError('This member function has to be re-implemented in the sub-classes')           # pragma: no cover
+
         # if pp_spec_extrapfreq>0:
         #     idxlim = int(dftlen*pp_spec_extrapfreq/self.fs)
         #     for n in xrange(SPEC.shape[0]):
@@ -85,6 +376,63 @@ class Vocoder:
         #             from IPython.core.debugger import  Pdb; Pdb().set_trace()
         #         SPEC[n,:] = spec_pp
 
+    def synthesis_stream(self, fs, CMP, blocksize=200, overlap=4, pp_mcep=False):
+        """
+        Streaming version of synthesis(.): Yields the waveform chunk by chunk,
+        as soon as each block of frames is synthesised.
+
+        CMP can be either a matrix of frames, which is then cut in blocks of
+        blocksize frames, or an iterable of blocks of frames (e.g. the chunks
+        of MLParameterGenerationFast.generation_chunks(.)), which can be of any
+        size.
+
+        Each block is synthesised separately (thus only its frames are decoded,
+        and the memory does not grow with the duration of the utterance), along
+        with the overlap frames preceding it. The waveform of these overlap
+        frames is cross-faded with the end of the previous block. The waveform
+        of the last overlap frames of a block is held back until the next block
+        is synthesised. Since the blocks are synthesised independently, the
+        periodic components of two consecutive blocks are not phase-aligned,
+        thus the overlap should be kept short.
+        """
+        if isinstance(CMP, np.ndarray):
+            CMP = [CMP[b0:b0+blocksize] for b0 in xrange(0, CMP.shape[0], blocksize)]
+
+        hop = int(round(self.shift*fs))
+
+        prevframes = None   # The last overlap frames of the previous block
+        pending = None      # The waveform not yet given out ...
+        pending_start = 0   # ... and its starting sample
+        nbframes = 0
+        for block in CMP:
+            seg = block if prevframes is None else np.vstack((prevframes, block))
+            seg_start = (nbframes-(0 if prevframes is None else prevframes.shape[0]))*hop
+            wav = self.synthesis(fs, seg, pp_mcep=pp_mcep)
+            nbframes += block.shape[0]
+            prevframes = seg[-overlap:] if overlap>0 else None
+
+            if pending is None:
+                pending = wav
+            else:
+                # Cross-fade the head of this block with the tail of the previous one
+                n = min(pending_start+len(pending)-seg_start, len(wav))
+                head = pending[:seg_start-pending_start]
+                fade = 0.5-0.5*np.cos(np.pi*(np.arange(n)+0.5)/n)
+                cross = (1.0-fade)*pending[seg_start-pending_start:seg_start-pending_start+n] + fade*wav[:n]
+                pending = np.concatenate((head, cross, wav[n:]))
+
+            # Give out all but the waveform of the frames that the next block will overlap
+            tail_start = max(pending_start, (nbframes-overlap)*hop)
+            if len(pending)<tail_start-pending_start:
+                pending = np.concatenate((pending, np.zeros(tail_start-pending_start-len(pending))))
+            if tail_start>pending_start:
+                yield pending[:tail_start-pending_start]
+                pending = pending[tail_start-pending_start:]
+                pending_start = tail_start
+
+        if (not pending is None) and len(pending)>0:
+            yield pending
+
     def __str__(self):
          return '{} (fs={}, shift={})'.format(self.name(), self.fs, self.shift)
 
@@ -98,11 +446,18 @@ class Vocoder:
     def vuvsize(self): return -1
 
     # Objective measures member functions for any vocoder
-    features_err = dict()
-    def objmeasures_clear(self): self.features_err=dict()
-    def objmeasures_stats(self):
-        for key in self.features_err:
-            print('{}: {}'.format(key, np.mean(np.vstack(self.features_err[key]))))
+    def objmeasures_clear(self): self.features_err.clear()
+    def objmeasures_merge(self, features_err): self.features_err.merge(features_err)
+    def objmeasures_stats(self, fjson=None):
+        """Print the objective measures and return them as a dictionary (also saved in fjson if given)."""
+        report = self.features_err.report()
+        self.features_err.summary(report)
+        if not fjson is None:
+            import json
+            makedirs(os.path.dirname(fjson))
+            with open(fjson, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+        return report
 
 class VocoderF0Spec(Vocoder):
     spec_type = None
@@ -115,16 +470,19 @@ class VocoderF0Spec(Vocoder):
         self.spec_type = _spec_type # 'fwbnd' 'mcep'
         self.dftlen = _dftlen
 
+    def analysis_params(self):
+        params = Vocoder.analysis_params(self)
+        params.update({'spec_type':self.spec_type, 'dftlen':self.dftlen})
+        return params
+
     def f0size(self): return 1
     def specsize(self): return self.spec_size
 
     # Utility functions for this class of vocoder
     def compress_spectrum(self, SPEC, spec_type, spec_size):
 
-        dftlen = (SPEC.shape[1]-1)*2
-
         if self.spec_type=='fwbnd':
-            COMPSPEC = sp.linbnd2fwbnd(np.log(abs(SPEC)), self.fs, dftlen, spec_size)
+            COMPSPEC = linbnd2fwbnd(np.log(abs(SPEC)), self.fs, self.dftlen, spec_size)
 
         elif self.spec_type=='mcep':  # pragma: no cover   Need SPTK to test this
             # TODO test
@@ -135,20 +493,20 @@ class VocoderF0Spec(Vocoder):
     def decompress_spectrum(self, COMPSPEC, spec_type, pp_mcep=False):
 
         if self.spec_type=='fwbnd':
-            SPEC = np.exp(sp.fwbnd2linbnd(COMPSPEC, self.fs, self.dftlen, smooth=True))
+            SPEC = np.exp(fwbnd2linbnd(COMPSPEC, self.fs, self.dftlen, smooth=True))
             if pp_mcep:             # pragma: no cover Would need SPTK to test it
-                print('        Merlin/SPTK Post-proc on MCEP')
+                print('        Merlin Post-proc on MCEP')
                 import external.merlin.generate_pp
                 mcep = sp.spec2mcep(SPEC*self.fs, sp.bark_alpha(self.fs), 256)    # Arbitrary high order
-                mcep_pp = external.merlin.generate_pp.mcep_postproc_sptk(mcep, self.fs, dftlen=self.dftlen) # Apply Merlin's post-proc on spec env
+                mcep_pp = external.merlin.generate_pp.mcep_postproc(mcep, self.fs, dftlen=self.dftlen) # Apply Merlin's post-proc on spec env
                 SPEC = sp.mcep2spec(mcep_pp, sp.bark_alpha(self.fs), dftlen=self.dftlen)/self.fs
 
         elif self.spec_type=='mcep':# pragma: no cover Would need SPTK to test it
             # TODO test
             if pp_mcep:
-                print('        Merlin/SPTK Post-proc on MCEP')
+                print('        Merlin Post-proc on MCEP')
                 import external.merlin.generate_pp
-                COMPSPEC = external.merlin.generate_pp.mcep_postproc_sptk(COMPSPEC, self.fs, dftlen=self.dftlen) # Apply Merlin's post-proc on spec env
+                COMPSPEC = external.merlin.generate_pp.mcep_postproc(COMPSPEC, self.fs, dftlen=self.dftlen) # Apply Merlin's post-proc on spec env
             SPEC = sp.mcep2spec(COMPSPEC, sp.bark_alpha(self.fs), dftlen=self.dftlen)
 
         return SPEC
@@ -173,7 +531,8 @@ class VocoderPML(VocoderF0Spec):
 
         pulsemodel.analysisf(fwav, shift=self.shift, f0estimator='REAPER', f0_min=f0_min, f0_max=f0_max, ff0=ff0, f0_log=True, fspec=fspec, spec_nbfwbnds=self.spec_size, fnm=fnm, nm_nbfwbnds=self.nm_size, preproc_fs=self.fs, preproc_hp=preproc_hp, verbose=1)
 
-    def analysisfid(self, fid, wav_path, f0_min, f0_max, outputpathdicts, preproc_hp=None):   # pragma: no cover  coverage not detected
+    def _analysisfid(self, fid, wav_path, f0_min, f0_max, outputpathdicts, preproc_hp=None, segdur=None):   # pragma: no cover  coverage not detected
+        if not segdur is None: raise ValueError('The analysis by segments is not available for the PML vocoder')
         return self.analysisf(wav_path.replace('*',fid), outputpathdicts['f0'].replace('*',fid), f0_min, f0_max, outputpathdicts['spec'].replace('*',fid), outputpathdicts['noise'].replace('*',fid), preproc_hp=preproc_hp)
 
     def synthesis(self, fs, CMP, pp_mcep=False):
@@ -184,7 +543,7 @@ class VocoderPML(VocoderF0Spec):
         SPEC = self.decompress_spectrum(CMP[:,1:1+self.spec_size], self.spec_type, pp_mcep=pp_mcep)
 
         NM = CMP[:,1+self.spec_size:1+self.spec_size+self.nm_size]
-        NM = sp.fwbnd2linbnd(NM, fs, self.dftlen)
+        NM = fwbnd2linbnd(NM, fs, self.dftlen)
 
         syn = pulsemodel.synthesis.synthesize(fs, np.vstack((self.shift*np.arange(len(f0)), f0)).T, SPEC, NM=NM, nm_cont=False, pp_atten1stharminsilences=-25)
 
@@ -192,15 +551,9 @@ class VocoderPML(VocoderF0Spec):
 
     # Objective measures
     def objmeasures_add(self, CMP, REF):
-        f0trg = np.exp(REF[:,0])
-        f0gen = np.exp(CMP[:,0])
-        self.features_err.setdefault('F0[Hz]', []).append(np.sqrt(np.mean((f0trg-f0gen)**2)))
-        spectrg = sp.log2db(REF[:,1:1+self.spec_size])
-        specgen = sp.log2db(CMP[:,1:1+self.spec_size])
-        self.features_err.setdefault('SPEC[dB]', []).append(np.sqrt(np.mean((spectrg-specgen)**2, 0)))
-        nmtrg = REF[:,1+self.spec_size:1+self.spec_size+self.nm_size]
-        nmgen = CMP[:,1+self.spec_size:1+self.spec_size+self.nm_size]
-        self.features_err.setdefault('NM', []).append(np.sqrt(np.mean((nmtrg-nmgen)**2, 0)))
+        self.features_err.add('F0[Hz]', np.exp(CMP[:,0])-np.exp(REF[:,0]))
+        self.features_err.add('SPEC[dB]', sp.log2db(CMP[:,1:1+self.spec_size])-sp.log2db(REF[:,1:1+self.spec_size]))
+        self.features_err.add('NM', CMP[:,1+self.spec_size:1+self.spec_size+self.nm_size]-REF[:,1+self.spec_size:1+self.spec_size+self.nm_size])
 
 
 class VocoderWORLD(VocoderF0Spec):
@@ -216,13 +569,97 @@ class VocoderWORLD(VocoderF0Spec):
     def noisesize(self): return self.aper_size
     def vuvsize(self): return 1
 
-    def analysisf(self, fwav, ff0, f0_min, f0_max, fspec, faper, fvuv, preproc_hp=None):
+    def world_analysis(self, wav, fs, f0_min, f0_max):
+        """Run WORLD's analysis (f0, spectral envelope and aperiodicity) on a waveform."""
+        import pyworld as pw
+
+        wav = np.ascontiguousarray(wav)
+        _f0, ts = pw.dio(wav, fs, f0_floor=f0_min, f0_ceil=f0_max, channels_in_octave=2, frame_period=self.shift*1000.0)
+        f0 = pw.stonemask(wav, _f0, ts, fs)
+        SPEC = pw.cheaptrick(wav, f0, ts, fs, fft_size=self.dftlen)
+        # SPEC = 10.0*np.sqrt(SPEC) # TODO Best gain correction I could find. Hard to find the good one between PML and WORLD different syntheses
+        APER = pw.d4c(wav, f0, ts, fs, fft_size=self.dftlen)
+
+        return f0, SPEC, APER
+
+    def world_analysis_segments(self, wav, fs, f0_min, f0_max, segdur, overlap=0.2, nbproc=None):
+        """
+        Same as world_analysis(.), but the waveform is split into segments of
+        about segdur seconds, which are analysed in parallel.
+
+        The segments are cut at the lowest-energy frame around each multiple of
+        segdur and are extended by overlap seconds on both sides, so that the
+        analysis windows of the frames close to the cuts see the same signal as
+        in a whole-file analysis. The analysis frames of the segments are on the
+        same shift grid as those of the whole-file analysis, thus the frames
+        are stitched without interpolation and the number of frames is the
+        same as world_analysis(.).
+        """
+        import multiprocessing
+
+        hop = int(round(self.shift*fs))
+        if abs(hop-self.shift*fs)>1e-6: raise ValueError('The shift has to be a whole number of samples for the segment analysis')  # pragma: no cover
+
+        nbframes = int(1000.0*len(wav)/fs/(self.shift*1000.0))+1  # As in pw.dio
+        segframes = int(segdur/self.shift)
+        ovframes = int(np.ceil(overlap/self.shift))
+
+        # Frame energies, to cut the segments in the quietest frames
+        wavpad = np.concatenate((np.zeros(hop), wav, np.zeros((nbframes+1)*hop-len(wav))))
+        energy = np.sum(np.reshape(wavpad[:(nbframes+1)*hop]**2, (nbframes+1, hop)), axis=1)
+        energy = energy[:-1]+energy[1:]     # Over the two hops centered on each frame
+        cuts = [0]
+        for target in xrange(segframes, nbframes-segframes//2, segframes):
+            lo = max(cuts[-1]+1, target-segframes//10)
+            hi = min(nbframes-1, target+segframes//10)
+            cuts.append(lo+np.argmin(energy[lo:hi+1]))
+        cuts.append(nbframes)
+
+        jobs = []
+        for c0, c1 in zip(cuts[:-1], cuts[1:]):
+            s0 = max(0, c0-ovframes)                      # First frame analysed in the segment
+            s1 = min(len(wav), (c1-1+ovframes)*hop+1)     # Last sample analysed in the segment
+            jobs.append((self, wav[s0*hop:s1], fs, f0_min, f0_max))
+
+        if nbproc is None: nbproc=multiprocessing.cpu_count()
+        nbproc = min(nbproc, len(jobs))
+        if nbproc>1 and multiprocessing.current_process().daemon:
+            nbproc = 1  # Already in a pool's process (e.g. analysisfids(.)), which cannot have children
+        print('    Analysing {} segments using {} processes'.format(len(jobs), nbproc))
+        if nbproc>1:
+            pool = multiprocessing.Pool(nbproc)
+            try:
+                results = pool.map(_world_analysis_segment, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_world_analysis_segment, jobs)
+
+        f0 = np.zeros(nbframes)
+        SPEC = np.zeros((nbframes, self.dftlen/2+1))
+        APER = np.zeros((nbframes, self.dftlen/2+1))
+        for (c0, c1), (segf0, segSPEC, segAPER) in zip(zip(cuts[:-1], cuts[1:]), results):
+            s0 = max(0, c0-ovframes)
+            f0[c0:c1] = segf0[c0-s0:c1-s0]
+            SPEC[c0:c1] = segSPEC[c0-s0:c1-s0]
+            APER[c0:c1] = segAPER[c0-s0:c1-s0]
+
+        return f0, SPEC, APER
+
+    def analysisf(self, fwav, ff0, f0_min, f0_max, fspec, faper, fvuv, preproc_hp=None, segdur=None, nbproc=None):
+        """
+        segdur :    If not None, waveforms longer than 2*segdur seconds are
+                    analysed by segments of about segdur seconds in nbproc
+                    processes (see world_analysis_segments(.)).
+        """
         print('Extracting WORLD features from: '+fwav)
 
         wav, fs, _ = sp.wavread(fwav)
 
         if preproc_hp=='auto': preproc_hp=f0_min
-        self.preprocwav(wav, fs, highpass=preproc_hp)
+        wav = self.preprocwav(wav, fs, highpass=preproc_hp)
+        fs = self.fs
 
         import pyworld as pw
 
@@ -239,11 +676,11 @@ class VocoderWORLD(VocoderF0Spec):
             sp.wavwrite('resynth.wav', resyn, fs, norm_abs=True, force_norm_abs=True, verbose=1)
             from IPython.core.debugger import  Pdb; Pdb().set_trace()
 
-        _f0, ts = pw.dio(wav, fs, f0_floor=f0_min, f0_ceil=f0_max, channels_in_octave=2, frame_period=self.shift*1000.0)
-        f0 = pw.stonemask(wav, _f0, ts, fs)
-        SPEC = pw.cheaptrick(wav, f0, ts, fs, fft_size=self.dftlen)
-        # SPEC = 10.0*np.sqrt(SPEC) # TODO Best gain correction I could find. Hard to find the good one between PML and WORLD different syntheses
-        APER = pw.d4c(wav, f0, ts, fs, fft_size=self.dftlen)
+        if (not segdur is None) and len(wav)>2*segdur*fs:
+            f0, SPEC, APER = self.world_analysis_segments(wav, fs, f0_min, f0_max, segdur, nbproc=nbproc)
+        else:
+            f0, SPEC, APER = self.world_analysis(wav, fs, f0_min, f0_max)
+        ts = self.shift*np.arange(len(f0))
 
         unvoiced = np.where(f0<20)[0]
         f0 = np.interp(ts, ts[f0>0], f0[f0>0])
@@ -260,7 +697,7 @@ class VocoderWORLD(VocoderF0Spec):
         makedirs(os.path.dirname(fspec))
         SPEC.astype('float32').tofile(fspec)
 
-        APER = sp.linbnd2fwbnd(APER, fs, self.dftlen, self.aper_size)
+        APER = linbnd2fwbnd(APER, fs, self.dftlen, self.aper_size)
         APER = sp.mag2db(APER)
         makedirs(os.path.dirname(faper))
         APER.astype('float32').tofile(faper)
@@ -276,8 +713,8 @@ class VocoderWORLD(VocoderF0Spec):
 
         # return CMP
 
-    def analysisfid(self, fid, wav_path, f0_min, f0_max, outputpathdicts, preproc_hp=None):              # pragma: no cover  coverage not detected
-        return self.analysisf(wav_path.replace('*',fid), outputpathdicts['f0'].replace('*',fid), f0_min, f0_max, outputpathdicts['spec'].replace('*',fid), outputpathdicts['noise'].replace('*',fid), outputpathdicts['vuv'].replace('*',fid), preproc_hp=preproc_hp)
+    def _analysisfid(self, fid, wav_path, f0_min, f0_max, outputpathdicts, preproc_hp=None, segdur=None):              # pragma: no cover  coverage not detected
+        return self.analysisf(wav_path.replace('*',fid), outputpathdicts['f0'].replace('*',fid), f0_min, f0_max, outputpathdicts['spec'].replace('*',fid), outputpathdicts['noise'].replace('*',fid), outputpathdicts['vuv'].replace('*',fid), preproc_hp=preproc_hp, segdur=segdur)
 
     def synthesis(self, fs, CMP, pp_mcep=False):
         import pyworld as pw
@@ -291,7 +728,7 @@ class VocoderWORLD(VocoderF0Spec):
 
         APER = CMP[:,1+self.spec_size:1+self.spec_size+self.aper_size]
         APER = sp.db2mag(APER)
-        APER = sp.fwbnd2linbnd(APER, fs, self.dftlen)
+        APER = fwbnd2linbnd(APER, fs, self.dftlen)
 
         if 0:
             import matplotlib.pyplot as plt
@@ -311,13 +748,118 @@ class VocoderWORLD(VocoderF0Spec):
 
     # Objective measures
     def objmeasures_add(self, CMP, REF):
-        f0trg = np.exp(REF[:,0])
-        f0gen = np.exp(CMP[:,0])
-        self.features_err.setdefault('F0[Hz]', []).append(np.sqrt(np.mean((f0trg-f0gen)**2)))
-        spectrg = sp.log2db(REF[:,1:1+self.spec_size])
-        specgen = sp.log2db(CMP[:,1:1+self.spec_size])
-        self.features_err.setdefault('SPEC[dB]', []).append(np.sqrt(np.mean((spectrg-specgen)**2, 0)))
-        apertrg = REF[:,1+self.spec_size:1+self.spec_size+self.aper_size]
-        apergen = CMP[:,1+self.spec_size:1+self.spec_size+self.aper_size]
-        self.features_err.setdefault('APER[dB]', []).append(np.sqrt(np.mean((apertrg-apergen)**2, 0)))
-        # TODO Add VUV
+        self.features_err.add('F0[Hz]', np.exp(CMP[:,0])-np.exp(REF[:,0]))
+        self.features_err.add('SPEC[dB]', sp.log2db(CMP[:,1:1+self.spec_size])-sp.log2db(REF[:,1:1+self.spec_size]))
+        self.features_err.add('APER[dB]', CMP[:,1+self.spec_size:1+self.spec_size+self.aper_size]-REF[:,1+self.spec_size:1+self.spec_size+self.aper_size])
+        self.features_err.add('VUV[%]', 100.0*((CMP[:,-1]>0.5)!=(REF[:,-1]>0.5)), stat='mean')
+
+
+def _world_analysis_segment(args):
+    """Runs VocoderWORLD.world_analysis(.) on one segment, in a process of the pool of VocoderWORLD.world_analysis_segments(.)."""
+    vocoder, wav, fs, f0_min, f0_max = args
+    return vocoder.world_analysis(wav, fs, f0_min, f0_max)
+
+def _analysisfid_worker(args):
+    """
+    Runs Vocoder.analysisfid(.) for a single file, in a process of the pool of
+    analysisfids(.).
+    Returns (fid, error message or None, duration of the waveform [s], processing time [s]).
+    """
+    vocoder, fid, wav_path, f0_min, f0_max, outputpathdicts, preproc_hp, resume, segdur = args
+
+    import wave
+    import traceback
+
+    timestart = time.time()
+    try:
+        vocoder.analysisfid(fid, wav_path, f0_min, f0_max, outputpathdicts, preproc_hp=preproc_hp, resume=resume, segdur=segdur)
+    except Exception:
+        return (fid, traceback.format_exc(), 0.0, time.time()-timestart)
+
+    wavdur = 0.0
+    try:
+        fwav = wave.open(wav_path.replace('*',fid), 'r')
+        wavdur = float(fwav.getnframes())/fwav.getframerate()
+        fwav.close()
+    except Exception:                                           # pragma: no cover
+        pass                    # Not a PCM wav file, it just won't be counted in the real-time factor
+
+    return (fid, None, wavdur, time.time()-timestart)
+
+def analysisfids(vocoder, fids, wav_path, f0_min, f0_max, outputpathdicts, preproc_hp=None, nbproc=None, resume=True, nbretries=1, segdur=None):
+    """
+    Extract the vocoder features of all the given files in parallel, using
+    Vocoder.analysisfid(.).
+
+    Parameters
+    ----------
+    nbproc :    Number of processes (number of CPUs if None). If 1, run in the
+                current process, one file after the other.
+    resume :    Skip the files already analysed with the same waveform content
+                and analysis parameters (see Vocoder.analysisfid_iscached(.)),
+                e.g. to continue an interrupted extraction. Otherwise, all the
+                files are re-analysed (and recorded in the cache index).
+    nbretries : Number of times the extraction of a failed file is retried.
+                The failure of a file does not stop the extraction of the others.
+    segdur :    If not None, the long waveforms are analysed by segments of
+                about segdur seconds (VocoderWORLD only, see
+                VocoderWORLD.world_analysis_segments(.)). The segments are
+                analysed in parallel only if nbproc is 1, since the processes
+                of the pool cannot have children. This is useful for a few
+                long recordings, whereas nbproc>1 is better for many files.
+
+    Returns
+    -------
+    The list of file IDs that failed (empty if all went well).
+    """
+    import multiprocessing
+
+    todo = fids
+    if resume:
+        todo = [fid for fid in fids if not vocoder.analysisfid_iscached(fid, wav_path, f0_min, f0_max, outputpathdicts, preproc_hp=preproc_hp, segdur=segdur)]
+        if len(todo)<len(fids): print('Skip {} files already extracted'.format(len(fids)-len(todo)))
+
+    if nbproc is None: nbproc=multiprocessing.cpu_count()
+    print('Extract the features of {} files using {} processes'.format(len(todo), nbproc))
+
+    timestart = time.time()
+    nbdone = 0
+    totwavdur = 0.0
+    totproctime = 0.0
+    pool = multiprocessing.Pool(nbproc) if nbproc>1 else None
+    try:
+        for trial in xrange(1+nbretries):
+            if len(todo)==0: break
+            if trial>0: print('Retry {} failed files (trial {}/{})'.format(len(todo), trial, nbretries))
+
+            jobs = [(vocoder, fid, wav_path, f0_min, f0_max, outputpathdicts, preproc_hp, resume, segdur) for fid in todo]
+            results = pool.imap_unordered(_analysisfid_worker, jobs) if pool is not None else (_analysisfid_worker(job) for job in jobs)
+
+            failed = []
+            for fid, err, wavdur, proctime in results:
+                if err is None:
+                    nbdone += 1
+                    totwavdur += wavdur
+                    totproctime += proctime
+                else:
+                    print('Extraction failed for {}:\n{}'.format(fid, err))
+                    failed.append(fid)
+                elapsed = time.time()-timestart
+                print_tty('\r    {} files extracted ({:.2f} files/s), {} failed   '.format(nbdone, nbdone/elapsed, len(failed)))
+            print_tty('\r                                                                    \r')
+
+            failed = set(failed)
+            todo = [fid for fid in fids if fid in failed]   # In the original order
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    elapsed = time.time()-timestart
+    print('{} files extracted in {} ({:.2f} files/s)'.format(nbdone, time2str(elapsed), nbdone/elapsed if elapsed>0 else 0.0))
+    if totwavdur>0.0:
+        print('    Real-time factor: {:.3f} (wall time), {:.3f} (per process)'.format(elapsed/totwavdur, totproctime/totwavdur))
+    if len(todo)>0:
+        print('Extraction failed for {} files: {}'.format(len(todo), todo))
+
+    return todo